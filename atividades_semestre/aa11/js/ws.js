@@ -24,7 +24,76 @@ document.addEventListener('DOMContentLoaded', () => {
     const websocketHost = window.location.hostname;
     const websocketPort = 8082;
     const websocketUrl = `ws://${websocketHost}:${websocketPort}`;
+    // Fallback for networks whose proxies block the WebSocket upgrade: Server-Sent Events from server.py's
+    // HTTP_STREAM_PORT, used once a WebSocket closes without ever opening (or from the start with
+    // index.html?transport=sse). EventSource reconnects, and resumes from the last event id, on its own.
+    const eventStreamUrl = `http://${websocketHost}:8086/events`;
+    let useEventStream = new URLSearchParams(window.location.search).get('transport') === 'sse';
+    let eventSource = null;
     const cgiScriptUrl = 'py/server_manager.py';
+    // Optional server-side filter, e.g. index.html?type=udp&ip=10.0.0.5 (fields: type, ip, port, prefix).
+    // Without it the server sends every message, as before.
+    const serverSubscription = subscriptionFromQuery();
+    // Optional compact payloads: index.html?encoding=binary (see decodeBinaryMessage). permessage-deflate is
+    // negotiated by the browser on its own.
+    const payloadEncoding = new URLSearchParams(window.location.search).get('encoding');
+    const utf8Decoder = new TextDecoder();
+    // Highest "seq" received so far; on reconnect the server replays whatever was missed after it.
+    let lastSeq = 0;
+
+    function subscriptionFromQuery() {
+        const params = new URLSearchParams(window.location.search);
+        const subscription = {};
+        ['type', 'ip', 'port', 'prefix'].forEach(field => {
+            if (params.get(field)) subscription[field] = params.get(field);
+        });
+        return Object.keys(subscription).length > 0 ? subscription : null;
+    }
+
+    function connectionUrl() {
+        // Filters and the resume cursor go in the handshake, so they apply before the first live message.
+        const params = new URLSearchParams(serverSubscription || {});
+        if (payloadEncoding) params.set('encoding', payloadEncoding);
+        if (lastSeq > 0) params.set('since', lastSeq);
+        const query = params.toString();
+        return query ? `${websocketUrl}/?${query}` : websocketUrl;
+    }
+
+    function decodeBinaryMessage(buffer, start = 0, end = buffer.byteLength) {
+        // Layout from server.py (encode_binary_message), big-endian: u8 version, u64 seq, f64 timestamp (ms),
+        // u16 port, u8 type length, u8 ip length, then type, ip and data.
+        const view = new DataView(buffer, start, end - start);
+        const typeLength = view.getUint8(19);
+        const ipLength = view.getUint8(20);
+        const bytes = new Uint8Array(buffer, start, end - start);
+        let offset = 21;
+        const type = utf8Decoder.decode(bytes.subarray(offset, offset += typeLength));
+        const ip = utf8Decoder.decode(bytes.subarray(offset, offset += ipLength));
+        return {
+            type: type,
+            ip: ip,
+            port: view.getUint16(17),
+            timestamp: new Date(view.getFloat64(9)).toISOString(),
+            data: utf8Decoder.decode(bytes.subarray(offset)),
+            seq: Number(view.getBigUint64(1))
+        };
+    }
+
+    function decodeBinaryFrame(buffer) {
+        // A single message (version 1), or a batch (version 2, see build_batch_frame in server.py):
+        // u32 count, then per message a u32 length and a version-1 message.
+        const view = new DataView(buffer);
+        if (view.getUint8(0) !== 2) return [decodeBinaryMessage(buffer)];
+        const messages = [];
+        let offset = 5;
+        for (let i = view.getUint32(1); i > 0; i--) {
+            const length = view.getUint32(offset);
+            offset += 4;
+            messages.push(decodeBinaryMessage(buffer, offset, offset + length));
+            offset += length;
+        }
+        return messages;
+    }
 
     function logDebug(message, data = null) {
         const timestamp = new Date().toISOString();
@@ -155,6 +224,10 @@ document.addEventListener('DOMContentLoaded', () => {
             disconnectWebSocket(); // Make sure it's marked as disconnected
             return;
         }
+        if (useEventStream) {
+            connectEventStream();
+            return;
+        }
         if (websocket && websocket.readyState === WebSocket.OPEN) {
             logDebug("WS: connectWebSocket() called, but already connected.");
             webSocketVisualState = 'connected';
@@ -169,9 +242,12 @@ document.addEventListener('DOMContentLoaded', () => {
         logDebug(`WS: Attempting to connect to ${websocketUrl}...`);
         webSocketVisualState = 'connecting';
         updateCombinedStatusUI();
-        websocket = new WebSocket(websocketUrl);
+        websocket = new WebSocket(connectionUrl());
+        websocket.binaryType = 'arraybuffer';
+        let opened = false;
 
         websocket.onopen = () => {
+            opened = true;
             logDebug("WS: Connection OPENED successfully!");
             webSocketVisualState = 'connected';
             updateCombinedStatusUI();
@@ -179,14 +255,26 @@ document.addEventListener('DOMContentLoaded', () => {
 
         websocket.onmessage = (event) => {
             try {
+                if (event.data instanceof ArrayBuffer) {
+                    receiveMessages(decodeBinaryFrame(event.data));
+                    return;
+                }
                 const msgData = JSON.parse(event.data);
                 logDebug(`WS: Message received:`, msgData);
                 // Check for specific system messages from server.py
                 if (msgData.type === 'system' && msgData.event === 'connected') {
                     logDebug(`WS: Connection confirmation from server: ${msgData.message}`);
+                    if (msgData.lastSeq < lastSeq) lastSeq = 0; // Server restarted, its numbering starts over
                     // UI already updated by onopen generally
+                } else if (msgData.type === 'system' && msgData.event === 'replay') {
+                    logDebug(`WS: Replaying ${msgData.messages.length} missed message(s)` + (msgData.truncated ? ' (older ones were already discarded)' : ''));
+                    receiveMessages(msgData.messages);
+                } else if (msgData.type === 'system') {
+                    logDebug(`WS: System event '${msgData.event}' from server:`, msgData);
+                } else if (msgData.type === 'batch') {
+                    receiveMessages(msgData.messages);
                 } else {
-                    addMessageToDOM(msgData);
+                    receiveMessages([msgData]);
                 }
             } catch (e) {
                 logDebug(`WS: Error processing received JSON message: ${e} - Raw Data: ${event.data}`, true);
@@ -204,10 +292,62 @@ document.addEventListener('DOMContentLoaded', () => {
             webSocketVisualState = 'disconnected';
             updateCombinedStatusUI(); // Update main UI to reflect WS disconnected
             websocket = null;
+            if (event.code === 1012) {
+                // Server reload: the new process is already listening; reconnect (and resume from lastSeq) after a jittered delay
+                setTimeout(connectWebSocket, 250 + Math.random() * 750);
+            } else if (!opened) {
+                // The handshake never completed (e.g. a proxy that drops upgrades): switch to Server-Sent Events
+                logDebug("WS: Handshake failed; falling back to Server-Sent Events.");
+                useEventStream = true;
+                connectEventStream();
+            }
+        };
+    }
+
+    function connectEventStream() {
+        if (eventSource) return; // Already open, or reconnecting by itself
+        const params = new URLSearchParams(serverSubscription || {});
+        if (lastSeq > 0) params.set('since', lastSeq);
+        const query = params.toString();
+        const url = query ? `${eventStreamUrl}?${query}` : eventStreamUrl;
+        logDebug(`SSE: Connecting to ${url}...`);
+        webSocketVisualState = 'connecting';
+        updateCombinedStatusUI();
+        eventSource = new EventSource(url);
+
+        eventSource.onopen = () => {
+            logDebug("SSE: Event stream OPENED.");
+            webSocketVisualState = 'connected';
+            updateCombinedStatusUI();
+        };
+
+        eventSource.onmessage = (event) => {
+            try {
+                const msgData = JSON.parse(event.data);
+                if (msgData.type === 'system') {
+                    if (msgData.event === 'connected' && msgData.lastSeq < lastSeq) lastSeq = 0; // Server restarted
+                    logDebug(`SSE: System event '${msgData.event}' from server:`, msgData);
+                } else {
+                    receiveMessages([msgData]);
+                }
+            } catch (e) {
+                logDebug(`SSE: Error processing received event: ${e} - Raw Data: ${event.data}`, true);
+            }
+        };
+
+        eventSource.onerror = () => {
+            logDebug("SSE: Event stream interrupted; the browser reconnects on its own.");
+            webSocketVisualState = 'connecting';
+            updateCombinedStatusUI();
         };
     }
     
     function disconnectWebSocket(reason = "Client requested disconnect") {
+        if (eventSource) {
+            logDebug(`SSE: Closing event stream. Reason: ${reason}`);
+            eventSource.close();
+            eventSource = null;
+        }
         if (websocket) {
             logDebug(`WS: Closing WebSocket. Reason: ${reason}`);
             websocket.onclose = null; // Prevent onclose from triggering further actions if we are manually closing
@@ -218,22 +358,46 @@ document.addEventListener('DOMContentLoaded', () => {
         updateCombinedStatusUI(); // Reflect disconnection immediately
     }
 
-    function addMessageToDOM(msgData) {
+    function isNewMessage(msgData) {
+        if (msgData.seq !== undefined) {
+            if (msgData.seq <= lastSeq && messagesStore.some(m => m.seq === msgData.seq)) return false;
+            lastSeq = Math.max(lastSeq, msgData.seq);
+        }
+        return true;
+    }
+
+    function receiveMessages(messages) {
+        // Live messages, batches and replays alike: the whole group goes into the list with one DOM insertion.
+        const fresh = messages.filter(isNewMessage);
+        if (fresh.length > 0) addMessagesToDOM(fresh);
+    }
+
+    function addMessagesToDOM(messages) {
         const noMessagesEl = messageList.querySelector('.no-messages');
         if (noMessagesEl) noMessagesEl.remove();
-        messagesStore.push(msgData); 
-        if (msgData.type === 'tcp') tcpMessages++;
-        else if (msgData.type === 'udp') udpMessages++;
-        totalMessages++;
+        const fragment = document.createDocumentFragment();
+        messages.forEach(msgData => {
+            messagesStore.push(msgData);
+            if (msgData.type === 'tcp') tcpMessages++;
+            else if (msgData.type === 'udp') udpMessages++;
+            totalMessages++;
+            if (currentFilter === 'all' || currentFilter === msgData.type) {
+                fragment.insertBefore(buildMessageElement(msgData), fragment.firstChild); // Newest on top
+            }
+        });
         if(tcpCountEl) tcpCountEl.textContent = tcpMessages;
         if(udpCountEl) udpCountEl.textContent = udpMessages;
         if(totalCountEl) totalCountEl.textContent = totalMessages;
-        if (currentFilter === 'all' || currentFilter === msgData.type) {
-            renderSingleMessage(msgData, true);
-        }
+        messageList.insertBefore(fragment, messageList.firstChild);
     }
     
     function renderSingleMessage(msgData, prepend = true) {
+        const messageDiv = buildMessageElement(msgData);
+        if (prepend) messageList.insertBefore(messageDiv, messageList.firstChild); 
+        else messageList.appendChild(messageDiv);
+    }
+
+    function buildMessageElement(msgData) {
         const messageDiv = document.createElement('div');
         messageDiv.classList.add('message', msgData.type); 
         const parsedDate = new Date(msgData.timestamp);
@@ -246,8 +410,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 <span>${localDate} ${localTime}</span>
             </div>
             <div class="message-content">${escapeHtml(msgData.data)}</div>`;
-        if (prepend) messageList.insertBefore(messageDiv, messageList.firstChild); 
-        else messageList.appendChild(messageDiv);
+        return messageDiv;
     }
 
     function renderAllMessages() {
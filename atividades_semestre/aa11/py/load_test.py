@@ -0,0 +1,650 @@
+#!/usr/bin/python3
+# End-to-end load generator for server.py: TCP/UDP producers at a set rate, WebSocket subscribers measuring
+# fan-out latency, server CPU/RSS sampling, and a JSON result file that later runs can be compared against.
+#
+#   python3 load_test.py --tcp-producers 4 --udp-producers 4 --subscribers 50 --rate 200 --duration 20
+#   python3 load_test.py ... --baseline ../tmp/load_test-20240501-120000.json --max-regression 10
+#   python3 load_test.py --ack-mode cumulative --tcp-framing newline --tcp-port 8084   # a newline-framed listener
+#   python3 load_test.py --encode-benchmark   # per-message payload encoding cost for each JSON backend, no load
+#   python3 load_test.py --tcp-producers 0 --udp-producers 0 --local-producers 1 --local-transport shm   # same-host ingest
+#   python3 load_test.py --cluster 3 --subscribers 30   # 3 peered nodes in a ring: producers on node 0, subscribers spread over all
+import argparse
+import asyncio
+import base64
+import collections
+import datetime
+import json
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import time
+import urllib.request
+
+import psutil
+
+import local_producer
+
+# --- Configuration (same ports as server.py) ---
+CURRENT_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_SCRIPT_PATH = os.path.join(CURRENT_SCRIPT_DIR, "server.py")
+TMP_DIR = os.path.abspath(os.environ.get("RELAY_TMP_DIR") or os.path.join(CURRENT_SCRIPT_DIR, "..", "tmp")) # Resolved as in server.py
+HOST = "127.0.0.1"
+WEBSOCKET_PORT = 8082
+TCP_PORT = 8080
+UDP_PORT = 8081
+METRICS_PORT = 8083
+METRICS_WORKER_PORT_BASE = 8090 # Worker i of a --workers server serves its metrics on this + i
+CLUSTER_PORT_STEP = 100 # --cluster: node i runs with server.py --port-offset i * CLUSTER_PORT_STEP...
+CLUSTER_PEER_PORT = 9000 # ...and accepts peer links on CLUSTER_PEER_PORT + i
+
+SERVER_START_TIMEOUT = 10
+SAMPLE_INTERVAL = 0.5 # Server CPU/RSS sampling period
+PAYLOAD_PREFIX = "bench"
+BINARY_MESSAGE_HEADER = struct.Struct('!BQdHBB') # server.py encode_binary_message
+BINARY_BATCH_HEADER = struct.Struct('!BI') # server.py build_batch_frame
+
+def log(message):
+    print(f"[load_test] {message}", file=sys.stderr, flush=True)
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    def at(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+    return {"count": len(ordered), "p50": at(0.50), "p90": at(0.90), "p99": at(0.99), "p999": at(0.999),
+            "max": round(ordered[-1] * 1000, 3)}
+
+def make_payload(producer_id, counter, size):
+    # "bench <producer>-<n> <monotonic ns>" padded to size; ACKs echo it back, so no per-message bookkeeping.
+    text = f"{PAYLOAD_PREFIX} {producer_id}-{counter} {time.monotonic_ns()} "
+    return (text + "x" * max(0, size - len(text))).encode('utf-8')
+
+def sent_at_ns(text):
+    # None for anything that is not one of our payloads
+    parts = text.split(" ", 3)
+    if len(parts) < 3 or parts[0] != PAYLOAD_PREFIX:
+        return None
+    try:
+        return int(parts[2])
+    except ValueError:
+        return None
+
+def cumulative_ack_count(text):
+    # "<proto> Server ACK: <n> message(s) received, last seq <seq>." -> n; None for a per-message ACK
+    marker = "Server ACK: "
+    start = text.find(marker)
+    if start < 0:
+        return None
+    count = text[start + len(marker):].split(" ", 1)[0]
+    return int(count) if count.isdigit() else None
+
+class RunStats:
+    def __init__(self):
+        self.sent = {"tcp": 0, "udp": 0, "local": 0}
+        self.sent_bytes = {"tcp": 0, "udp": 0, "local": 0}
+        self.acked = {"tcp": 0, "udp": 0, "local": 0} # Local transports have no ACKs: every sent message counts
+        self.ack_latency = {"tcp": [], "udp": []}
+        self.delivered = 0
+        self.frames = 0 # WebSocket data frames received by the subscribers
+        self.delivery_latency = []
+        self.errors = []
+
+    def record_ack(self, protocol, ack_text):
+        start = ack_text.find("'")
+        sent_ns = sent_at_ns(ack_text[start + 1:]) if start >= 0 else None
+        if sent_ns is not None:
+            self.acked[protocol] += 1
+            self.ack_latency[protocol].append((time.monotonic_ns() - sent_ns) / 1e9)
+
+    def record_cumulative_ack(self, protocol, count, sent_ns_list=()):
+        self.acked[protocol] += count
+        now = time.monotonic_ns()
+        self.ack_latency[protocol].extend((now - sent_ns) / 1e9 for sent_ns in sent_ns_list)
+
+# --- Producers ---
+async def paced(rate, deadline):
+    # Yields once per message at `rate` per second; catches up without sleeping when behind.
+    interval = 1.0 / rate
+    next_at = time.monotonic()
+    while time.monotonic() < deadline:
+        delay = next_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        yield
+        next_at += interval
+
+def frame_tcp_payload(payload, framing):
+    if framing == "newline":
+        return payload + b"\n"
+    if framing == "length-prefixed":
+        return struct.pack('!I', len(payload)) + payload
+    return payload
+
+async def tcp_producer(index, args, stats, deadline):
+    # per-message: closed loop, one message then its ACK, so ACKs are never coalesced by the raw (unframed) listener.
+    # cumulative / none: open loop at the set rate (use a framed listener, a raw one may merge messages).
+    producer_id = f"t{index}"
+    try:
+        reader, writer = await asyncio.open_connection(HOST, args.tcp_port)
+    except OSError as e:
+        stats.errors.append(f"tcp producer {index}: {e}")
+        return
+    if args.ack_mode != "per-message":
+        await tcp_producer_open_loop(index, args, stats, deadline, producer_id, reader, writer)
+        return
+    counter = 0
+    try:
+        async for _ in paced(args.rate, deadline):
+            payload = make_payload(producer_id, counter, args.size)
+            writer.write(frame_tcp_payload(payload, args.tcp_framing))
+            counter += 1
+            stats.sent["tcp"] += 1
+            stats.sent_bytes["tcp"] += len(payload)
+            ack = b""
+            while not ack.endswith(b"received."):
+                chunk = await asyncio.wait_for(reader.read(65536), args.ack_timeout)
+                if not chunk:
+                    raise ConnectionError("server closed the connection")
+                ack += chunk
+            stats.record_ack("tcp", ack.decode('utf-8', 'ignore'))
+    except (OSError, asyncio.TimeoutError) as e:
+        stats.errors.append(f"tcp producer {index}: {type(e).__name__}: {e}")
+    finally:
+        writer.close()
+
+async def read_cumulative_acks(reader, stats, unacked):
+    # unacked: send times of the messages not covered by an ACK yet, oldest first (TCP keeps them in order)
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        count = cumulative_ack_count(line.decode('utf-8', 'ignore'))
+        if count:
+            covered = [unacked.popleft() for _ in range(min(count, len(unacked)))]
+            stats.record_cumulative_ack("tcp", count, covered)
+
+async def tcp_producer_open_loop(index, args, stats, deadline, producer_id, reader, writer):
+    unacked = collections.deque()
+    ack_reader = asyncio.ensure_future(read_cumulative_acks(reader, stats, unacked)) if args.ack_mode == "cumulative" else None
+    counter = 0
+    try:
+        async for _ in paced(args.rate, deadline):
+            payload = make_payload(producer_id, counter, args.size)
+            if ack_reader is not None:
+                unacked.append(time.monotonic_ns())
+            writer.write(frame_tcp_payload(payload, args.tcp_framing))
+            await writer.drain()
+            counter += 1
+            stats.sent["tcp"] += 1
+            stats.sent_bytes["tcp"] += len(payload)
+        if ack_reader is not None:
+            ack_deadline = time.monotonic() + args.ack_timeout
+            while unacked and not ack_reader.done() and time.monotonic() < ack_deadline:
+                await asyncio.sleep(0.01)
+            if unacked:
+                stats.errors.append(f"tcp producer {index}: {len(unacked)} message(s) never acknowledged")
+    except OSError as e:
+        stats.errors.append(f"tcp producer {index}: {type(e).__name__}: {e}")
+    finally:
+        if ack_reader is not None:
+            ack_reader.cancel()
+        writer.close()
+
+class UdpAckProtocol(asyncio.DatagramProtocol):
+    def __init__(self, stats):
+        self.stats = stats
+
+    def datagram_received(self, data, addr):
+        text = data.decode('utf-8', 'ignore')
+        count = cumulative_ack_count(text)
+        if count is not None:
+            self.stats.record_cumulative_ack("udp", count)
+        else:
+            self.stats.record_ack("udp", text)
+
+    def error_received(self, exc):
+        self.stats.errors.append(f"udp: {exc}")
+
+async def udp_producer(index, args, stats, deadline):
+    # Open loop: datagrams go out at the set rate and ACKs are matched as they arrive (missing ones count as lost).
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: UdpAckProtocol(stats), remote_addr=(HOST, args.udp_port))
+    producer_id = f"u{index}"
+    counter = 0
+    try:
+        async for _ in paced(args.rate, deadline):
+            payload = make_payload(producer_id, counter, args.size)
+            transport.sendto(payload)
+            counter += 1
+            stats.sent["udp"] += 1
+            stats.sent_bytes["udp"] += len(payload)
+        await asyncio.sleep(args.drain)
+    finally:
+        transport.close()
+
+async def local_producer_task(index, args, stats, deadline):
+    # Open loop over a Unix socket or a shared-memory ring (one ring per producer: producer i uses worker i's ring).
+    path = local_producer.DEFAULT_PATHS[args.local_transport]
+    if args.workers > 1:
+        path += f"-w{index % args.workers}"
+    producer_id = f"l{index}"
+    writer = None
+    try:
+        if args.local_transport == "stream":
+            _, writer = await asyncio.open_unix_connection(path)
+            send = lambda payload: writer.write(payload + b"\n") or True
+        elif args.local_transport == "shm":
+            producer = local_producer.ShmRingWriter(path)
+            send = producer.try_send
+        else:
+            producer = local_producer.UnixDatagramProducer(path)
+            producer.sock.setblocking(False)
+            def send(payload):
+                try:
+                    producer.send(payload)
+                    return True
+                except BlockingIOError:
+                    return False
+    except (OSError, ValueError) as e:
+        stats.errors.append(f"local producer {index}: {e}")
+        return
+    counter = 0
+    try:
+        async for _ in paced(args.rate, deadline):
+            payload = make_payload(producer_id, counter, args.size)
+            while not send(payload): # Ring or socket buffer full: the server is behind
+                await asyncio.sleep(0.001)
+            if writer is not None:
+                await writer.drain()
+            counter += 1
+            stats.sent["local"] += 1
+            stats.acked["local"] += 1
+            stats.sent_bytes["local"] += len(payload)
+    except OSError as e:
+        stats.errors.append(f"local producer {index}: {type(e).__name__}: {e}")
+    finally:
+        if writer is not None:
+            writer.close()
+        else:
+            producer.close()
+
+# --- WebSocket subscribers ---
+def frame_texts(opcode, payload):
+    # The "data" of every message in a text or binary frame, batched (WS_BATCH_WINDOW_MS) or not
+    if opcode == 1:
+        message = json.loads(payload)
+        messages = (message.get("messages") or []) if message.get("type") == "batch" else [message]
+        return [m.get("data") or "" for m in messages]
+    if payload[0] != 2:
+        return [payload[BINARY_MESSAGE_HEADER.size + payload[19] + payload[20]:].decode('utf-8', 'ignore')]
+    texts = []
+    offset = BINARY_BATCH_HEADER.size
+    for _ in range(BINARY_BATCH_HEADER.unpack_from(payload)[1]):
+        length = struct.unpack_from('!I', payload, offset)[0]
+        message = payload[offset + 4:offset + 4 + length]
+        texts.append(message[BINARY_MESSAGE_HEADER.size + message[19] + message[20]:].decode('utf-8', 'ignore'))
+        offset += 4 + length
+    return texts
+
+async def read_ws_frame(reader):
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack('!H', await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', await reader.readexactly(8))[0]
+    return first & 0x0F, await reader.readexactly(length)
+
+def masked_ws_frame(opcode, payload):
+    mask = os.urandom(4)
+    return bytes([0x80 | opcode, 0x80 | len(payload)]) + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+async def ws_subscriber(index, args, stats, ready, stop):
+    try:
+        reader, writer = await asyncio.open_connection(HOST, node_port(args, args.ws_port, index))
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        path = f"/?encoding={args.encoding}"
+        writer.write((f"GET {path} HTTP/1.1\r\nHost: {HOST}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n").encode('ascii'))
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), SERVER_START_TIMEOUT)
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+        stats.errors.append(f"ws subscriber {index}: {type(e).__name__}: {e}")
+        ready.release()
+        return
+    ready.release()
+    try:
+        while not stop.is_set():
+            opcode, payload = await read_ws_frame(reader)
+            if opcode == 9:
+                writer.write(masked_ws_frame(0xA, payload))
+                continue
+            elif opcode == 8:
+                break
+            elif opcode not in (1, 2):
+                continue
+            stats.frames += 1
+            now = time.monotonic_ns()
+            for text in frame_texts(opcode, payload):
+                sent_ns = sent_at_ns(text)
+                if sent_ns is not None:
+                    stats.delivered += 1
+                    stats.delivery_latency.append((now - sent_ns) / 1e9)
+    except (OSError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+# --- Server process ---
+def port_open(port):
+    try:
+        socket.create_connection((HOST, port), timeout=0.2).close()
+        return True
+    except OSError:
+        return False
+
+def node_port(args, port, index):
+    # With --cluster, subscriber (or node) `index` uses node index % cluster's port
+    return port + (index % args.cluster) * CLUSTER_PORT_STEP if args.cluster > 1 else port
+
+def start_server(args, node=0):
+    ws_port = node_port(args, args.ws_port, node)
+    if port_open(ws_port):
+        raise RuntimeError(f"Port {ws_port} is already in use; stop that server or pass --no-start.")
+    command = [sys.executable, SERVER_SCRIPT_PATH]
+    if args.workers > 1:
+        command += ["--workers", str(args.workers)]
+    command += ["--ack-mode", args.ack_mode, "--batch-window-ms", str(args.batch_window_ms), "--json-encoder", args.json_encoder]
+    env = None
+    if args.cluster > 1: # A ring: every node dials the next one, each with its own tmp directory
+        command += ["--port-offset", str(node * CLUSTER_PORT_STEP), "--node-id", f"node-{node}", "--peer-port", str(CLUSTER_PEER_PORT + node),
+                    "--peer", f"{HOST}:{CLUSTER_PEER_PORT + (node + 1) % args.cluster}"]
+        env = dict(os.environ, RELAY_TMP_DIR=os.path.join(TMP_DIR, "cluster", f"node-{node}"))
+    process = subprocess.Popen(command, start_new_session=True, env=env)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while not port_open(ws_port):
+        if process.poll() is not None or time.monotonic() > deadline:
+            process.kill()
+            raise RuntimeError("Server did not start; see message_server_activity.txt in the tmp directory.")
+        time.sleep(0.1)
+    time.sleep(0.5 if args.workers > 1 else 0.1) # Let every worker open its listeners
+    return process
+
+def stop_server(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+def find_server_pid(process):
+    if process is not None:
+        return process.pid
+    pid_file = os.path.join(TMP_DIR, "message_server.pid")
+    try:
+        with open(pid_file) as f:
+            return int(f.read().strip())
+    except (IOError, ValueError):
+        return None
+
+class ResourceSampler:
+    # CPU time and peak RSS of the servers (cluster nodes) and their worker processes, plus this process for reference.
+    def __init__(self, server_pids):
+        self.processes = []
+        for server_pid in server_pids:
+            if server_pid and psutil.pid_exists(server_pid):
+                root = psutil.Process(server_pid)
+                self.processes += [root] + root.children(recursive=True)
+        self.me = psutil.Process()
+        self.peak_rss = 0
+        self.started = time.monotonic()
+        self.cpu_start = self.server_cpu()
+        self.my_cpu_start = sum(self.me.cpu_times()[:2])
+
+    def server_cpu(self):
+        total = 0.0
+        for process in self.processes:
+            try:
+                total += sum(process.cpu_times()[:2])
+            except psutil.Error:
+                pass
+        return total
+
+    def sample(self):
+        rss = 0
+        for process in self.processes:
+            try:
+                rss += process.memory_info().rss
+            except psutil.Error:
+                pass
+        self.peak_rss = max(self.peak_rss, rss)
+
+    async def run(self, stop):
+        while not stop.is_set():
+            self.sample()
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+    def result(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            "processes": len(self.processes),
+            "server_cpu_percent": round(100 * (self.server_cpu() - self.cpu_start) / elapsed, 1),
+            "server_peak_rss_mb": round(self.peak_rss / (1024 * 1024), 1),
+            "load_test_cpu_percent": round(100 * (sum(self.me.cpu_times()[:2]) - self.my_cpu_start) / elapsed, 1),
+        }
+
+def fetch_server_metrics(args):
+    if args.cluster > 1:
+        ports = [node_port(args, args.metrics_port, node) for node in range(args.cluster)]
+    else:
+        ports = [METRICS_WORKER_PORT_BASE + i for i in range(args.workers)] if args.workers > 1 else [args.metrics_port]
+    summaries = []
+    for port in ports:
+        try:
+            with urllib.request.urlopen(f"http://{HOST}:{port}/metrics.json", timeout=1) as response:
+                summaries.append(json.loads(response.read()))
+        except (OSError, ValueError):
+            pass
+    if not summaries:
+        return None
+    keys = ("frames_dropped", "send_errors", "slow_consumers_evicted")
+    totals = {key: sum(summary.get(key, 0) for summary in summaries) for key in keys}
+    totals["acks_sent"] = {protocol: sum(summary.get("acks_sent", {}).get(protocol, 0) for summary in summaries) for protocol in ("tcp", "udp")}
+    if args.cluster > 1:
+        totals["peer"] = {name: sum(summary.get("peer", {}).get(name, 0) for summary in summaries)
+                          for name in ("sent", "received", "forwarded", "duplicates", "loops", "queue_drops")}
+    return totals
+
+# --- Run ---
+async def run_load(args, server_pids):
+    stats = RunStats()
+    stop = asyncio.Event()
+    sampler = ResourceSampler(server_pids)
+    sampler_task = asyncio.ensure_future(sampler.run(stop))
+
+    ready = asyncio.Semaphore(0)
+    subscribers = [asyncio.ensure_future(ws_subscriber(i, args, stats, ready, stop)) for i in range(args.subscribers)]
+    for _ in subscribers:
+        await ready.acquire()
+    await asyncio.sleep(0.2) # Subscriptions are registered once the "connected" message has gone out
+
+    log(f"Running {args.tcp_producers} TCP + {args.udp_producers} UDP + {args.local_producers} {args.local_transport} producer(s) at {args.rate} msg/s each, "
+        f"{args.size} bytes, {args.subscribers} subscriber(s), {args.duration}s")
+    started = time.monotonic()
+    deadline = started + args.duration
+    producers = [tcp_producer(i, args, stats, deadline) for i in range(args.tcp_producers)]
+    producers += [udp_producer(i, args, stats, deadline) for i in range(args.udp_producers)]
+    producers += [local_producer_task(i, args, stats, deadline) for i in range(args.local_producers)]
+    await asyncio.gather(*producers)
+    elapsed = min(time.monotonic(), deadline) - started
+
+    await asyncio.sleep(args.drain) # Deliveries still in flight
+    stop.set()
+    for task in subscribers:
+        task.cancel()
+    await asyncio.gather(*subscribers, return_exceptions=True)
+    sampler_task.cancel()
+
+    sent_total = sum(stats.sent.values())
+    # Without ACKs every sent message is expected (UDP loss then shows up as missing deliveries)
+    confirmed = stats.sent if args.ack_mode == "none" else stats.acked
+    expected_deliveries = sum(confirmed.values()) * args.subscribers
+    return {
+        "ingest": {
+            "sent": stats.sent,
+            "acked": stats.acked,
+            "udp_lost": None if args.ack_mode == "none" else stats.sent["udp"] - stats.acked["udp"],
+            "messages_per_second": round(sent_total / elapsed, 1) if elapsed else 0,
+            "megabytes_per_second": round(sum(stats.sent_bytes.values()) / elapsed / 1e6, 3) if elapsed else 0,
+        },
+        "ack_latency_ms": {protocol: percentiles(samples) for protocol, samples in stats.ack_latency.items()},
+        "fanout": {
+            "delivered": stats.delivered,
+            "expected": expected_deliveries,
+            "missing": max(0, expected_deliveries - stats.delivered),
+            "deliveries_per_second": round(stats.delivered / elapsed, 1) if elapsed else 0,
+            "frames": stats.frames,
+            "latency_ms": percentiles(stats.delivery_latency),
+        },
+        "resources": sampler.result(),
+        "errors": stats.errors[:20],
+        "error_count": len(stats.errors),
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=CURRENT_SCRIPT_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def compare_with_baseline(results, baseline_path, max_regression):
+    # Throughput may not drop, and fan-out p99 / ACK p99 may not grow, by more than max_regression percent.
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    differing = [key for key, value in results["config"].items()
+                 if key not in ("no_start", "max_regression") and baseline.get("config", {}).get(key) != value]
+    if differing:
+        log(f"Warning: baseline was run with different settings ({', '.join(differing)}); figures may not be comparable.")
+    checks = [
+        ("ingest messages/s", ("ingest", "messages_per_second"), True),
+        ("fan-out deliveries/s", ("fanout", "deliveries_per_second"), True),
+        ("fan-out p99 ms", ("fanout", "latency_ms", "p99"), False),
+        ("tcp ACK p99 ms", ("ack_latency_ms", "tcp", "p99"), False),
+        ("udp ACK p99 ms", ("ack_latency_ms", "udp", "p99"), False),
+    ]
+    regressions = []
+    for label, path, higher_is_better in checks:
+        old, new = baseline, results
+        for key in path:
+            old = old.get(key) if isinstance(old, dict) else None
+            new = new.get(key) if isinstance(new, dict) else None
+        if not old or new is None:
+            continue
+        change = 100.0 * (new - old) / old
+        worse = -change if higher_is_better else change
+        marker = "REGRESSION" if worse > max_regression else "ok"
+        log(f"{label}: {old} -> {new} ({change:+.1f}%) {marker}")
+        if worse > max_regression:
+            regressions.append(label)
+    return regressions
+
+def run_encode_benchmark(args):
+    # server.py's stdout goes to /dev/null, so it leaves its figures in a file.
+    subprocess.run([sys.executable, SERVER_SCRIPT_PATH, "--benchmark-encoders", "--json-encoder", args.json_encoder], check=True)
+    with open(os.path.join(TMP_DIR, "encode_benchmark.json")) as f:
+        results = json.load(f)
+    log(f"Payload encoding, {results['messages']} messages of {results['data_bytes']} data bytes per case:")
+    for case, cost in results["ns_per_message"].items():
+        log(f"  {case:<52} {'not installed' if cost is None else f'{cost:>6} ns/message'}")
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Load generator and benchmark for the TCP/UDP to WebSocket relay.")
+    parser.add_argument("--tcp-producers", type=int, default=2)
+    parser.add_argument("--udp-producers", type=int, default=2)
+    parser.add_argument("--local-producers", type=int, default=0,
+                        help="Producers on a server.py local transport (Unix socket or shared-memory ring).")
+    parser.add_argument("--local-transport", choices=tuple(local_producer.PRODUCERS), default="dgram",
+                        help="dgram / stream (Unix sockets) or shm (one ring per worker, so at most --workers producers).")
+    parser.add_argument("--subscribers", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=100, help="Messages per second per producer (default: 100).")
+    parser.add_argument("--size", type=int, default=64, help="Payload size in bytes (default: 64).")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of load (default: 10).")
+    parser.add_argument("--drain", type=float, default=1.0, help="Seconds to wait for late ACKs and deliveries.")
+    parser.add_argument("--ack-timeout", type=float, default=5.0)
+    parser.add_argument("--ack-mode", choices=("per-message", "cumulative", "none"), default="per-message",
+                        help="Server ACK mode; passed as --ack-mode to a server started here (default: per-message).")
+    parser.add_argument("--tcp-framing", choices=("raw", "newline", "length-prefixed"), default="raw",
+                        help="Framing of the listener at --tcp-port (default: raw).")
+    parser.add_argument("--encoding", choices=("json", "binary"), default="json")
+    parser.add_argument("--batch-window-ms", type=float, default=0,
+                        help="Broadcast coalescing window; passed to a server started here (default: 0, off).")
+    parser.add_argument("--json-encoder", choices=("auto", "orjson", "json"), default="auto",
+                        help="Server JSON backend; passed to a server started here (default: auto).")
+    parser.add_argument("--encode-benchmark", action="store_true",
+                        help="Only run server.py's payload encoding micro-benchmark and print it.")
+    parser.add_argument("--workers", type=int, default=1, help="Passed to server.py when it is started here.")
+    parser.add_argument("--cluster", type=int, default=0,
+                        help="Start this many peered server.py nodes (a ring) instead of one; producers use node 0, subscribers all nodes.")
+    parser.add_argument("--no-start", action="store_true", help="Use a server that is already running.")
+    parser.add_argument("--tcp-port", type=int, default=TCP_PORT)
+    parser.add_argument("--udp-port", type=int, default=UDP_PORT)
+    parser.add_argument("--ws-port", type=int, default=WEBSOCKET_PORT)
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT)
+    parser.add_argument("--output", help="Result file (default: ../tmp/load_test-<timestamp>.json).")
+    parser.add_argument("--baseline", help="Earlier result file to compare against.")
+    parser.add_argument("--max-regression", type=float, default=10.0,
+                        help="Percent a throughput or p99 figure may worsen against --baseline before exiting with 1.")
+    return parser.parse_args()
+
+def main():
+    args = parse_command_line()
+    if args.encode_benchmark:
+        run_encode_benchmark(args)
+        return
+    if args.local_transport == "shm" and args.local_producers > args.workers:
+        log("A shared-memory ring takes a single producer: use at most --workers local producers with --local-transport shm.")
+        sys.exit(2)
+    if args.ack_mode != "per-message" and args.tcp_framing == "raw" and args.tcp_producers:
+        log("Warning: open-loop TCP producers on a raw listener may have several messages read as one; use a framed listener.")
+    if args.cluster > 1 and args.workers > 1:
+        log("Cluster peering needs single-process servers: use --cluster without --workers.")
+        sys.exit(2)
+    processes = []
+    try:
+        if not args.no_start:
+            for node in range(max(1, args.cluster)):
+                processes.append(start_server(args, node))
+            if args.cluster > 1:
+                time.sleep(1.0) # Let the nodes link up
+        server_pids = [find_server_pid(process) for process in processes] or [find_server_pid(None)]
+        results = asyncio.run(run_load(args, server_pids))
+        results["server_metrics"] = fetch_server_metrics(args)
+    finally:
+        for process in processes:
+            stop_server(process)
+
+    results = {
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "revision": git_revision(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        **results,
+    }
+    output = args.output or os.path.join(TMP_DIR, f"load_test-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    log(f"Results written to {output}")
+
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.max_regression)
+        if regressions:
+            log(f"Regressions against {args.baseline}: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
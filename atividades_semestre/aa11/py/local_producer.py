@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+# Producer side of server.py's local ingest, for programs on the same host as the relay: a Unix datagram socket,
+# a Unix stream socket (newline framed) or a shared-memory ring. Import ShmRingWriter / UnixDatagramProducer, or
+# send from the command line:
+#
+#   python3 local_producer.py "temperature 21.5"                 # one message over the Unix datagram socket
+#   tail -f sensor.log | python3 local_producer.py --via shm       # every stdin line through the ring
+#   python3 local_producer.py --via stream --path ../tmp/ingest.sock-w0 "hello"   # worker 0 of a --workers group
+import argparse
+import mmap
+import os
+import socket
+import struct
+import sys
+import time
+
+CURRENT_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+TMP_DIR = os.path.abspath(os.environ.get("RELAY_TMP_DIR") or os.path.join(CURRENT_SCRIPT_DIR, "..", "tmp")) # Resolved as in server.py
+DEFAULT_PATHS = { # server.py UNIX_LISTENERS / SHM_RINGS
+    "dgram": os.path.join(TMP_DIR, "ingest.dgram"),
+    "stream": os.path.join(TMP_DIR, "ingest.sock"),
+    "shm": os.path.join(TMP_DIR, "ingest.ring"),
+}
+
+# Ring layout, as in server.py (ShmRingReader)
+SHM_RING_MAGIC = b"RLYRING1"
+SHM_RING_CAPACITY_OFFSET = 8
+SHM_RING_WRITE_OFFSET = 64
+SHM_RING_READ_OFFSET = 128
+SHM_RING_WAITING_OFFSET = 192
+SHM_RING_DATA_OFFSET = 256
+SHM_RING_COUNTER = struct.Struct('<Q')
+SHM_RING_FLAG = struct.Struct('<I')
+SHM_RING_WRAP = 0xFFFFFFFF
+SHM_RING_REOPEN_CHECK = 1.0 # Seconds between checks that the server has not replaced the ring file (restart)
+SEND_TIMEOUT = 5.0 # Longest a blocking send waits for room in the ring
+
+class ShmRingWriter:
+    # The single producer of one ring: write the record, then publish the new write position. Only one process
+    # (and thread) may write to a ring at a time; configure more SHM_RINGS for more producers.
+    def __init__(self, path):
+        self.path = path
+        self.mm = None
+        self.bell = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.bell.setblocking(False)
+        self.open()
+
+    def open(self):
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            size = os.fstat(fd).st_size
+            self.inode = os.fstat(fd).st_ino
+            mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        if mm[:len(SHM_RING_MAGIC)] != SHM_RING_MAGIC:
+            mm.close()
+            raise ValueError(f"{self.path} is not an initialized relay ring")
+        if self.mm is not None:
+            self.mm.close()
+        self.mm = mm
+        self.capacity = SHM_RING_COUNTER.unpack_from(mm, SHM_RING_CAPACITY_OFFSET)[0]
+        self.write_pos = SHM_RING_COUNTER.unpack_from(mm, SHM_RING_WRITE_OFFSET)[0]
+        self.next_reopen_check = time.monotonic() + SHM_RING_REOPEN_CHECK
+
+    def reopen_if_replaced(self):
+        try:
+            replaced = os.stat(self.path).st_ino != self.inode
+        except OSError:
+            return # Server down; keep the old mapping until it is back
+        if replaced:
+            self.open()
+
+    def try_send(self, data):
+        # False when the ring is full (the server is behind); nothing is written then.
+        now = time.monotonic()
+        if now >= self.next_reopen_check:
+            self.next_reopen_check = now + SHM_RING_REOPEN_CHECK
+            self.reopen_if_replaced()
+        mm, capacity = self.mm, self.capacity
+        record = (4 + len(data) + 7) & ~7
+        if record > capacity // 2:
+            raise ValueError(f"message of {len(data)} bytes does not fit a {capacity} byte ring")
+        offset = self.write_pos % capacity
+        padding = capacity - offset if capacity - offset < record else 0
+        if self.write_pos + padding + record - SHM_RING_COUNTER.unpack_from(mm, SHM_RING_READ_OFFSET)[0] > capacity:
+            return False
+        if padding:
+            SHM_RING_FLAG.pack_into(mm, SHM_RING_DATA_OFFSET + offset, SHM_RING_WRAP)
+            offset = 0
+        start = SHM_RING_DATA_OFFSET + offset
+        SHM_RING_FLAG.pack_into(mm, start, len(data))
+        mm[start + 4:start + 4 + len(data)] = data
+        self.write_pos += padding + record
+        SHM_RING_COUNTER.pack_into(mm, SHM_RING_WRITE_OFFSET, self.write_pos)
+        if SHM_RING_FLAG.unpack_from(mm, SHM_RING_WAITING_OFFSET)[0]:
+            SHM_RING_FLAG.pack_into(mm, SHM_RING_WAITING_OFFSET, 0)
+            try:
+                self.bell.sendto(b"\0", self.path + ".bell")
+            except OSError:
+                pass # The server polls an idle ring anyway
+        return True
+
+    def send(self, data, timeout=SEND_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while not self.try_send(data):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"ring {self.path} stayed full for {timeout}s")
+            time.sleep(0.0005)
+
+    def close(self):
+        self.bell.close()
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+class UnixDatagramProducer:
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def send(self, data):
+        self.sock.sendto(data, self.path)
+
+    def close(self):
+        self.sock.close()
+
+class UnixStreamProducer:
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+
+    def send(self, data):
+        self.sock.sendall(data + b"\n") # The default stream listener is newline framed
+
+    def close(self):
+        self.sock.close()
+
+PRODUCERS = {"dgram": UnixDatagramProducer, "stream": UnixStreamProducer, "shm": ShmRingWriter}
+
+def main():
+    parser = argparse.ArgumentParser(description="Send messages to a relay on this host without the loopback IP stack.")
+    parser.add_argument("--via", choices=tuple(PRODUCERS), default="dgram")
+    parser.add_argument("--path", help="Socket or ring file (default: the server's, in ../tmp).")
+    parser.add_argument("messages", nargs="*", help="Messages to send (default: one per line of stdin).")
+    args = parser.parse_args()
+    producer = PRODUCERS[args.via](args.path or DEFAULT_PATHS[args.via])
+    try:
+        for message in args.messages or (line.rstrip("\n") for line in sys.stdin):
+            producer.send(message.encode('utf-8'))
+    finally:
+        producer.close()
+
+if __name__ == "__main__":
+    main()
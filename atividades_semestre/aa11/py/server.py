@@ -7,11 +7,30 @@ import threading
 import json
 import time
 import signal
+import traceback
+import asyncio
+import concurrent.futures
+import resource
+import struct
+import gzip
+import shutil
+import atexit
+import argparse
+import bisect
+import fcntl
+import heapq
+import mmap
+import multiprocessing
+import urllib.parse
+import urllib.request
+import zlib
+from collections import deque
+from itertools import chain, islice
 
 # --- stdout/stderr Redirection (VERY IMPORTANT - MUST BE EARLY) ---
 try:
     _initial_base_path_for_redir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
-    _initial_tmp_dir_for_redir = os.path.join(_initial_base_path_for_redir, "tmp")
+    _initial_tmp_dir_for_redir = os.environ.get("RELAY_TMP_DIR") or os.path.join(_initial_base_path_for_redir, "tmp")
     os.makedirs(_initial_tmp_dir_for_redir, exist_ok=True)
     
     devnull_fd = os.open(os.devnull, os.O_RDWR)
@@ -24,196 +43,3814 @@ except Exception as e_redir:
     # This print goes to original stderr if redirection fails (might show in Apache error log)
     print(f"[{timestamp}] CRITICAL_SERVER_PY_ERROR: Failed to redirect stdout/stderr: {e_redir}", file=sys.__stderr__, flush=True)
 
-from simple_websocket_server import WebSocketServer, WebSocket
+from simple_websocket_server import WebSocketServer, WebSocket, CLOSE, TEXT, BINARY, PING, HEADERB1
 
 # --- Configuration ---
 BASE_PROJECT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..')) 
 PROJECT_SUBDIR_NAME_FOR_LOGGING = os.path.basename(BASE_PROJECT_PATH) 
 
-TMP_DIR = os.path.join(BASE_PROJECT_PATH, "tmp")
+TMP_DIR = os.path.abspath(os.environ.get("RELAY_TMP_DIR") or os.path.join(BASE_PROJECT_PATH, "tmp")) # One per node to run several on a host (with --port-offset)
 PID_FILE = os.path.join(TMP_DIR, "message_server.pid")
 LOCK_FILE = os.path.join(TMP_DIR, "message_server.lock")
 ACTIVITY_LOG = os.path.join(TMP_DIR, "message_server_activity.txt")
+LOG_ROTATE_LOCK_FILE = os.path.join(TMP_DIR, "message_server_activity.rotate.lock")
+WORKERS_FILE = os.path.join(TMP_DIR, "message_server.workers") # Worker PIDs (one per line) in --workers mode
+CONTROL_SOCKET = os.path.join(TMP_DIR, "message_server.control.sock") # status / ready / stop, used by server_manager.py
+JOURNAL_DIR = os.path.join(TMP_DIR, "journal") # Worker i of a --workers group writes to journal/worker-i
 
 WEBSOCKET_PORT = 8082
 TCP_PORT = 8080
 UDP_PORT = 8081
+HTTP_STREAM_PORT = 8086 # Server-Sent Events (/events) and long-poll (/poll) for clients whose proxies block WebSocket upgrades; 0 disables it
 HOST = "0.0.0.0" 
 
+# Activity log (written by a background thread, see ActivityLogWriter)
+LOG_DEBUG, LOG_INFO, LOG_WARNING, LOG_ERROR = 10, 20, 30, 40
+LOG_LEVEL = LOG_DEBUG # Per-message lines (ingest, broadcast) are DEBUG; raise to LOG_INFO to drop them
+LOG_MESSAGE_SAMPLE_EVERY = 1 # Keep 1 of every N per-message lines (1 = all)
+LOG_FLUSH_INTERVAL = 0.25 # Seconds between batched writes
+LOG_QUEUE_MAX_LINES = 100000 # Lines beyond this are counted and dropped instead of buffered
+LOG_ROTATE_MAX_BYTES = 10 * 1024 * 1024 # Rotate the activity log at this size (0 disables rotation)
+LOG_ROTATE_BACKUP_COUNT = 5 # Compressed archives kept: message_server_activity.txt.1.gz ... .N.gz
+
+TCP_LISTEN_BACKLOG = 4096 # Thousands of sensors may (re)connect at the same time
+WS_LISTEN_BACKLOG = 1024
+WS_ACCEPT_BATCH = 64 # Max WebSocket accepts handled per loop wakeup
+TCP_READ_CHUNK_SIZE = 1024 # "raw" framing: one message per read of up to this many bytes (legacy behavior)
+TCP_RECV_BUFFER_SIZE = 65536 # Initial per-connection receive buffer for the framed modes
+TCP_MIN_READ_SIZE = 4096 # Compact/grow the receive buffer when less than this is free
+TCP_MAX_FRAME_SIZE = 1024 * 1024 # Default maximum frame size for the framed modes
+TCP_IDLE_TIMEOUT = 300 # Seconds without data before a TCP producer is disconnected ("idle_timeout" per listener; 0 = never)
+TCP_KEEPALIVE = True # SO_KEEPALIVE on TCP producer connections, so the kernel finds half-open peers...
+TCP_KEEPALIVE_IDLE = 60 # ...probing after this many idle seconds (Linux; elsewhere the system defaults apply)...
+TCP_KEEPALIVE_INTERVAL = 10 # ...every this many seconds...
+TCP_KEEPALIVE_COUNT = 5 # ...and dropping the connection after this many unanswered probes
+TCP_FRAMING_MODES = ("raw", "newline", "length-prefixed") # length-prefixed = 4-byte big-endian length + payload
+TCP_LISTENERS = [
+    {"port": TCP_PORT, "framing": "raw"},
+    # e.g. {"port": 8084, "framing": "newline", "ack": "cumulative"}, {"port": 8085, "framing": "length-prefixed", "max_frame_size": 65536, "ack": "none", "idle_timeout": 30}
+]
+ACK_MODES = ("per-message", "cumulative", "none") # Per listener ("ack" key in TCP_LISTENERS / UDP_LISTENERS)
+ACK_MODE = "per-message" # Listeners without an "ack" key (--ack-mode overrides it)
+ACK_EVERY_MESSAGES = 100 # "cumulative": one ACK per producer after this many messages... ("ack_every" per listener)
+ACK_INTERVAL_MS = 50 # ...or this long after the first unacknowledged one ("ack_interval_ms"); 0 disables either trigger
+WS_MAX_CLIENTS = 50000 # Per process; further connections are closed on accept. Budget: ~3.2 KB RSS per idle client (measured, see ClientConnectionHandler), ~160 MB at the cap, plus kernel socket buffers
+WS_HANDSHAKE_TIMEOUT = 10 # Seconds to complete the WebSocket handshake after connecting
+WS_PING_INTERVAL = 30 # A client silent for this long is pinged (0 = no pings)...
+WS_PING_MISSED_LIMIT = 2 # ...and evicted after this many consecutive unanswered pings
+TIMER_WHEEL_TICK = 1.0 # Resolution (seconds) of the wheel driving idle timeouts, handshake timeouts and pings
+TIMER_WHEEL_SLOTS = 512 # Delays beyond TICK * SLOTS take more than one turn of the wheel
+WS_SEND_QUEUE_MAX_FRAMES = 1000 # Per-client outbound queue bound, in frames...
+WS_SEND_QUEUE_MAX_BYTES = 4 * 1024 * 1024 # ...and in bytes
+WS_SEND_QUEUE_POLICY = "drop-oldest" # When a client's queue is full: "drop-oldest", "drop-newest" or "disconnect"
+WS_WRITEV_BATCH = 64 # Max queued frames gathered into a single sendmsg() call
+WS_MAX_SUBSCRIPTIONS_PER_CLIENT = 64
+WS_PAYLOAD_ENCODINGS = ("json", "binary") # Chosen per client with ?encoding=... in the WebSocket URL
+WS_PERMESSAGE_DEFLATE = True # Accept permessage-deflate (RFC 7692) when the client offers it
+WS_DEFLATE_MIN_BYTES = 128 # Smaller payloads are sent uncompressed (the deflate overhead outweighs the gain)
+WS_DEFLATE_LEVEL = 6
+WS_MAX_INFLATED_BYTES = 1024 * 1024 # Cap on a decompressed client message (they are small control requests)
+WS_BATCH_WINDOW_MS = 0 # Coalesce broadcasts for this long into one frame per client, e.g. 5-50 (0 = one frame per message)
+WS_BATCH_MAX_MESSAGES = 500 # A window is cut short once this many messages are waiting
+HTTP_STREAM_MAX_CLIENTS = 20000 # Per process, event streams and waiting polls together (same send queue limits and policy as WebSocket clients)
+HTTP_REQUEST_TIMEOUT = 10 # Seconds to send the request headers
+HTTP_MAX_REQUEST_BYTES = 8192
+HTTP_STREAM_WRITE_BUFFER = 64 * 1024 # Transport buffer beyond which a stream's events wait in its send queue (and count against its limits)
+SSE_KEEPALIVE_INTERVAL = 15 # A comment line on a stream idle this long, so proxies do not time it out (0 = none)
+SSE_RETRY_MS = 2000 # Reconnect delay suggested to EventSource
+LONG_POLL_TIMEOUT = 25 # Longest a /poll request waits for a message before answering with none
+LONG_POLL_MAX_MESSAGES = 1000 # Per answer; its "lastSeq" then points at the last message returned
+JSON_ENCODERS = ("auto", "orjson", "json") # Backend for broadcast payloads; "auto" = orjson when installed, else the json module
+JSON_ENCODER = "auto" # --json-encoder overrides it
+PAYLOAD_TEMPLATE_CACHE_SIZE = 100000 # Per-source (type, ip, port) payload prefixes kept; the cache is reset beyond this
+ENCODE_BENCHMARK_MESSAGES = 200000 # Messages per case for --benchmark-encoders
+ENCODE_BENCHMARK_FILE = os.path.join(TMP_DIR, "encode_benchmark.json")
+AGGREGATE_WINDOWS = ("tumbling", "sliding") # {"action": "aggregate", "window": ...} or ?aggregate=... ; "off" returns to raw messages
+AGGREGATE_INTERVAL = 1.0 # Seconds per bucket; every aggregate subscriber gets one summary per bucket
+AGGREGATE_SLIDING_BUCKETS = 10 # "sliding": counts over the last N buckets, moved forward one bucket at a time
+AGGREGATE_MAX_SOURCES = 10000 # (type, ip) pairs counted per bucket; further sources are folded into ip "other"
+REPLAY_MAX_MESSAGES = 10000 # Recent broadcasts kept for reconnecting clients...
+REPLAY_MAX_BYTES = 8 * 1024 * 1024 # ...bounded by total encoded size as well
+REPLAY_FRAME_MAX_BYTES = 1024 * 1024 # Larger backlogs are sent as several "replay" frames
+JOURNAL_ENABLED = True # Append every broadcast to the on-disk journal ("history" queries over WebSocket)
+JOURNAL_SEGMENT_BYTES = 64 * 1024 * 1024 # A new segment file is started beyond this size
+JOURNAL_INDEX_INTERVAL_BYTES = 64 * 1024 # One sparse index entry per this much segment data
+JOURNAL_WRITE_BUFFER_BYTES = 256 * 1024
+JOURNAL_FLUSH_INTERVAL = 1.0 # Seconds; queries flush first, so they always see everything broadcast so far
+JOURNAL_WRITE_INTERVAL = 0.05 # Seconds between the writer thread's passes over its queue
+JOURNAL_QUEUE_MAX_RECORDS = 100000 # Records waiting for the writer thread; beyond this (or the byte bound) they are dropped and counted
+JOURNAL_QUEUE_MAX_BYTES = 64 * 1024 * 1024
+JOURNAL_CLOSE_TIMEOUT = 5 # Longest shutdown waits for the writer thread to write out its queue
+JOURNAL_RETENTION_SECONDS = 7 * 24 * 3600 # Segments older than this are deleted (0 = no age limit)...
+JOURNAL_RETENTION_BYTES = 1024 * 1024 * 1024 # ...and the oldest ones beyond this total size (0 = no size limit)
+JOURNAL_RETENTION_CHECK_INTERVAL = 60
+JOURNAL_QUERY_CHUNK_MESSAGES = 500 # A "history" answer is streamed as frames of at most this many messages...
+JOURNAL_QUERY_CHUNK_BYTES = 256 * 1024 # ...or this many bytes
+JOURNAL_QUERY_MAX_MESSAGES = 100000 # Upper bound (and default) for a query's "limit"
+UDP_MAX_DATAGRAM_SIZE = 65535 # Receive buffer per datagram; larger datagrams are counted as truncated
+UDP_RCVBUF_BYTES = 8 * 1024 * 1024 # SO_RCVBUF per UDP socket (capped by net.core.rmem_max)
+UDP_BATCH_SIZE = 256 # Max datagrams drained per socket wakeup
+UDP_REUSE_PORT = False # SO_REUSEPORT even with a single socket (always on when "sockets" > 1)
+UDP_LISTENERS = [
+    {"port": UDP_PORT, "sockets": 1}, # "sockets" > 1 binds that many SO_REUSEPORT sockets; the kernel spreads senders across them
+]
+# Same-host producers, no loopback IP stack: messages get type "unix" / "shm" and ip "local" (port: the producer's
+# PID on stream sockets, else 0). Worker i of a --workers group appends "-wi" to every path. See local_producer.py.
+UNIX_LISTENERS = [
+    {"path": os.path.join(TMP_DIR, "ingest.dgram"), "kind": "datagram"}, # One message per datagram, no ACKs
+    {"path": os.path.join(TMP_DIR, "ingest.sock"), "kind": "stream", "framing": "newline", "ack": "none"}, # Same keys as TCP_LISTENERS
+]
+SHM_RINGS = [
+    {"path": os.path.join(TMP_DIR, "ingest.ring"), "size": 4 * 1024 * 1024}, # One producer per ring (see ShmRingReader)
+]
+SHM_RING_BATCH = 1024 # Max records consumed per wakeup
+SHM_RING_IDLE_POLL = 0.05 # Seconds between looks at an idle ring, in case a doorbell was missed
+STATS_LOG_INTERVAL = 60 # Seconds between ingest counter lines in the activity log
+# Ingest admission control, applied to TCP and UDP alike (each worker process has its own buckets); 0 = unlimited
+INGEST_SOURCE_MESSAGES_PER_SECOND = 0 # Per source IP...
+INGEST_SOURCE_BYTES_PER_SECOND = 0
+INGEST_GLOBAL_MESSAGES_PER_SECOND = 0 # ...and for all sources together
+INGEST_GLOBAL_BYTES_PER_SECOND = 0
+INGEST_BURST_SECONDS = 1.0 # Bucket size: this many seconds' worth of the rate
+INGEST_SHED_POLICY = "drop" # Over the limit: "drop", "sample" (let 1 in INGEST_SHED_SAMPLE_EVERY through) or "disconnect" (TCP; drop for UDP)
+INGEST_SHED_SAMPLE_EVERY = 100
+INGEST_MAX_TRACKED_SOURCES = 100000 # Idle sources (full buckets) are forgotten beyond this
+SHUTDOWN_GRACE_SECONDS = 1.5
+METRICS_HOST = "127.0.0.1" # Prometheus text on /metrics, a JSON summary on /metrics.json
+METRICS_PORT = 8083 # 0 disables the endpoint (for the workers too)
+METRICS_WORKER_PORT_BASE = 8090 # Worker i of a --workers group serves its metrics on METRICS_WORKER_PORT_BASE + i
+METRICS_REQUEST_TIMEOUT = 5
+METRICS_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Diagnostics: SIGUSR1 writes every thread's stack to tmp/stacks-<pid>-<time>.txt, SIGUSR2 starts (or stops early)
+# the sampling profiler, which writes tmp/profile-<pid>-<time>.folded. A --workers supervisor passes both on to its workers.
+PROFILE_DURATION = 30 # Seconds a SIGUSR2 profile runs
+PROFILE_SAMPLE_INTERVAL = 0.005 # Seconds between stack samples (~200 Hz)
+SPANS_ENABLED = False # Stage timing spans at startup; toggled at runtime with the "spans" control action or GET /spans?enable=1|0 on the metrics port
+SPAN_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01, 0.1)
+
+# Multi-process mode (--workers N)
+WORKER_RESTART_DELAY = 1.0 # Seconds before a crashed worker is restarted
+WORKER_MAX_RESTARTS_PER_MINUTE = 10 # Beyond this the supervisor gives up and shuts the group down
+WORKER_SHUTDOWN_TIMEOUT = 5.0 # Seconds to wait for workers after SIGTERM before SIGKILL
+SUPERVISOR_POLL_INTERVAL = 0.5
+CONTROL_LISTEN_BACKLOG = 16
+CONTROL_REQUEST_TIMEOUT = 10 # Also the longest a "ready" request may wait
+CONTROL_MAX_REQUEST_BYTES = 64 * 1024
+CONTROL_METRICS_TIMEOUT = 0.5 # Per worker, when the supervisor collects metrics for "status"
+HANDOFF_TIMEOUT = 10 # Reload: longest the listener handoff between old and new process may take
+HANDOFF_MAX_FDS = 64
+RELOAD_DRAIN_TIMEOUT = 30 # Seconds the old process keeps serving its TCP producers after a handoff
+BUS_SOCKET_BUFFER_BYTES = 4 * 1024 * 1024 # SO_SNDBUF/SO_RCVBUF of each worker's bus socket
+BUS_MAX_MESSAGE_SIZE = 2 * 1024 * 1024
+BUS_RECV_BATCH = 256 # Max bus messages drained per wakeup
+NODE_ID = None # This relay's name in a cluster, unique per node (--node-id); default "<hostname>:<WEBSOCKET_PORT>"
+PEER_HOST = "0.0.0.0"
+PEER_PORT = 0 # Listener for links from other relay nodes (--peer-port); 0 = accept none
+PEERS = [] # "host:port" of other nodes' PEER_PORT, dialed and kept linked (--peer, repeatable). Peering needs a single-process server
+PEER_CONNECT_TIMEOUT = 5
+PEER_RECONNECT_MIN_DELAY = 0.5 # Seconds before redialing a lost peer, doubled after each failed attempt...
+PEER_RECONNECT_MAX_DELAY = 30 # ...up to this
+PEER_HEARTBEAT_INTERVAL = 5 # A link with nothing to send for this long sends a heartbeat...
+PEER_TIMEOUT = 20 # ...and one that received nothing (not even heartbeats) for this long is dropped
+PEER_BATCH_MAX_BYTES = 256 * 1024 # Records queued in one loop iteration go out in one write; sooner once this much is waiting
+PEER_WRITE_BUFFER = 1024 * 1024 # Transport buffer beyond which a link's records wait in its send queue...
+PEER_SEND_QUEUE_MAX_BYTES = 16 * 1024 * 1024 # ...which drops its oldest records beyond this (the peer is not keeping up)
+PEER_MAX_FRAME_BYTES = 4 * 1024 * 1024
+PEER_FORWARD = True # Pass records from one peer on to the others; False for a full mesh, where every node hears from every origin directly
+PEER_MAX_HOPS = 16 # Records are not passed on further than this many links from their origin
+PEER_DEDUP_WINDOW = 65536 # Sequence numbers remembered per origin for duplicate detection...
+PEER_DEDUP_MAX_ORIGINS = 1024 # ...for this many origins (node and boot); the one first heard from longest ago is forgotten first
+
 ws_server_instance = None 
 keep_running = True 
+shutdown_event = None # asyncio.Event, created inside the running loop
+
+connected_ws_clients = set() # Handshaked WebSocket clients; O(1) add/remove, iterated as-is by broadcasts (no snapshot)
+tcp_client_transports = set() # Open TCP producer connections, closed on shutdown
+
+# --- Logging ---
+log_queue = deque() # (epoch seconds, message); append/popleft are atomic, so producers never take a lock
+log_lines_dropped = 0
+message_log_counter = 0
+activity_log_writer = None
+activity_log_atexit_registered = False
+log_source = f"{PROJECT_SUBDIR_NAME_FOR_LOGGING}-Server" # Workers append -w<index>
+
+def log_activity(message, level=LOG_INFO):
+    global log_lines_dropped
+    if level < LOG_LEVEL:
+        return
+    if activity_log_writer is None: # Before the writer starts or after it stopped
+        write_log_line_direct(message)
+        return
+    if len(log_queue) >= LOG_QUEUE_MAX_LINES:
+        log_lines_dropped += 1
+        return
+    log_queue.append((time.time(), message))
+
+def should_log_message():
+    # Guard for the per-message lines, checked before their f-string is built.
+    global message_log_counter
+    if LOG_LEVEL > LOG_DEBUG:
+        return False
+    message_log_counter += 1
+    return message_log_counter % LOG_MESSAGE_SAMPLE_EVERY == 0
+
+def write_log_line_direct(message):
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+    full_message = f"[{timestamp}] ({log_source}) {message}\n"
+    try:
+        os.makedirs(TMP_DIR, exist_ok=True) 
+        with open(ACTIVITY_LOG, "a") as f:
+            f.write(full_message)
+    except Exception as e:
+        original_stderr = sys.__stderr__ # Failsafe if redirection failed
+        print(f"CRITICAL_LOG_ERROR: Error writing to activity log {ACTIVITY_LOG}: {e}", file=original_stderr, flush=True)
+
+class ActivityLogWriter(threading.Thread):
+    # Drains log_queue once per LOG_FLUSH_INTERVAL into a single write on a file that stays open.
+    def __init__(self):
+        super().__init__(name="activity-log-writer", daemon=True)
+        self.stop_requested = threading.Event()
+        self.log_file = None
+        self.log_size = 0
+        self.cached_second = None
+        self.cached_second_text = ""
+
+    def run(self):
+        while not self.stop_requested.wait(LOG_FLUSH_INTERVAL):
+            self.flush()
+        self.flush()
+        self.close_file()
+
+    def flush(self):
+        global log_lines_dropped
+        entries = []
+        try:
+            while True:
+                entries.append(log_queue.popleft())
+        except IndexError:
+            pass
+        if log_lines_dropped:
+            dropped, log_lines_dropped = log_lines_dropped, 0
+            entries.append((time.time(), f"LOG: {dropped} line(s) dropped (log queue full)."))
+        if entries:
+            started = time.perf_counter() if spans_enabled else None
+            self.write("".join([self.format_line(created, message) for created, message in entries]))
+            if started is not None:
+                stage_spans["log"].observe(time.perf_counter() - started)
+
+    def format_line(self, created, message):
+        second = int(created)
+        if second != self.cached_second: # strftime once per second instead of once per line
+            self.cached_second = second
+            self.cached_second_text = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+        millis = int((created - second) * 1000)
+        return f"[{self.cached_second_text}.{millis:03d}] ({log_source}) {message}\n"
+
+    def write(self, text):
+        try:
+            if self.log_file is not None and self.log_file_replaced():
+                self.close_file() # Another worker rotated the log
+            if self.log_file is None:
+                os.makedirs(TMP_DIR, exist_ok=True)
+                self.log_file = open(ACTIVITY_LOG, "a")
+                self.log_size = self.log_file.tell()
+            self.log_file.write(text)
+            self.log_file.flush()
+            self.log_size = self.log_file.tell()
+            if LOG_ROTATE_MAX_BYTES and self.log_size >= LOG_ROTATE_MAX_BYTES:
+                self.rotate()
+        except Exception as e:
+            print(f"CRITICAL_LOG_ERROR: Error writing to activity log {ACTIVITY_LOG}: {e}", file=sys.__stderr__, flush=True)
+            self.close_file()
+
+    def log_file_replaced(self):
+        try:
+            return os.stat(ACTIVITY_LOG).st_ino != os.fstat(self.log_file.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def rotate(self):
+        # Worker processes share the log: one rotates under an flock, the others reopen on the inode change.
+        with open(LOG_ROTATE_LOCK_FILE, "w") as rotate_lock:
+            fcntl.flock(rotate_lock, fcntl.LOCK_EX)
+            replaced = self.log_file_replaced()
+            self.close_file()
+            if not replaced:
+                self.rotate_files()
+
+    def rotate_files(self):
+        for index in range(LOG_ROTATE_BACKUP_COUNT - 1, 0, -1):
+            archive = f"{ACTIVITY_LOG}.{index}.gz"
+            if os.path.exists(archive):
+                os.replace(archive, f"{ACTIVITY_LOG}.{index + 1}.gz")
+        rotated = f"{ACTIVITY_LOG}.1"
+        os.replace(ACTIVITY_LOG, rotated)
+        with open(rotated, "rb") as f_in, gzip.open(f"{rotated}.gz", "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(rotated)
+
+    def close_file(self):
+        if self.log_file is not None:
+            try:
+                self.log_file.close()
+            except OSError:
+                pass
+            self.log_file = None
+
+def start_activity_log_writer():
+    global activity_log_writer, activity_log_atexit_registered
+    if activity_log_writer is None:
+        activity_log_writer = ActivityLogWriter()
+        activity_log_writer.start()
+        if not activity_log_atexit_registered:
+            atexit.register(stop_activity_log_writer) # Also covers the sys.exit() paths before main's finally
+            activity_log_atexit_registered = True
+
+def stop_activity_log_writer():
+    global activity_log_writer
+    writer = activity_log_writer
+    if writer is None:
+        return
+    writer.stop_requested.set()
+    writer.join(timeout=5)
+    activity_log_writer = None
+    try: # Anything queued after the final flush
+        while True:
+            write_log_line_direct(log_queue.popleft()[1])
+    except IndexError:
+        pass
+
+# --- Connection Timers (idle TCP producers, WebSocket handshakes and pings) ---
+reaped_stats = {
+    "tcp_idle": 0, # TCP producers silent for longer than their idle timeout
+    "unix_idle": 0, # The same for Unix-domain stream producers
+    "ws_handshake": 0, # WebSocket connections that did not complete the handshake in WS_HANDSHAKE_TIMEOUT
+    "ws_unresponsive": 0, # WebSocket clients that missed WS_PING_MISSED_LIMIT pings in a row
+    "http_request": 0, # HTTP streaming connections that did not send their request in HTTP_REQUEST_TIMEOUT
+    "peer_timeout": 0 # Peer links that received nothing for PEER_TIMEOUT
+}
+
+class TimerWheel:
+    # Hashed timing wheel shared by every connection: schedule and cancel are O(1) set operations, and one loop
+    # timer per tick serves them all instead of a timer handle per connection. Reads do not reschedule anything:
+    # a connection only records last_activity (the wheel's clock, which is TIMER_WHEEL_TICK coarse), and when its
+    # slot comes up its expire(now) decides whether it really timed out, returning the delay until the next
+    # check or None. Entries need a wheel_slot attribute (None while unscheduled).
+    def __init__(self, tick, slots):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.position = 0
+        self.now = time.monotonic()
+        self.loop = None
+        self.timer = None
+        self.next_tick = 0.0
+
+    def start(self, loop):
+        self.loop = loop
+        self.now = time.monotonic()
+        self.next_tick = loop.time() + self.tick
+        self.timer = loop.call_at(self.next_tick, self.advance)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def schedule(self, entry, delay):
+        # Never early: the entry is looked at between delay and delay + one tick from now (or after a full turn)
+        self.cancel(entry)
+        slot = (self.position + min(len(self.slots) - 1, int(delay / self.tick) + 1)) % len(self.slots)
+        self.slots[slot].add(entry)
+        entry.wheel_slot = slot
+
+    def cancel(self, entry):
+        if entry.wheel_slot is not None:
+            self.slots[entry.wheel_slot].discard(entry)
+            entry.wheel_slot = None
+
+    def advance(self):
+        # On a fixed grid (call_at), so the wheel does not drift by the time a tick takes
+        self.next_tick += self.tick
+        self.timer = self.loop.call_at(self.next_tick, self.advance)
+        self.now = time.monotonic()
+        self.position = (self.position + 1) % len(self.slots)
+        due, self.slots[self.position] = self.slots[self.position], set()
+        for entry in due:
+            entry.wheel_slot = None
+            try:
+                delay = entry.expire(self.now)
+            except Exception as e:
+                log_activity(f"TIMERS: Error in connection timer: {e}")
+                continue
+            if delay is not None:
+                self.schedule(entry, delay)
+
+connection_wheel = TimerWheel(TIMER_WHEEL_TICK, TIMER_WHEEL_SLOTS)
+
+def configure_keepalive(sock):
+    if not TCP_KEEPALIVE or sock is None:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, TCP_KEEPALIVE_IDLE)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, TCP_KEEPALIVE_INTERVAL)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, TCP_KEEPALIVE_COUNT)
+    except OSError as e:
+        log_activity(f"TCP: Could not enable keepalive: {e}")
+
+# --- WebSocket Handling ---
+def build_ws_frame(data, opcode=None, compressed=False):
+    # Same wire format simple_websocket_server produces, built once so a broadcast can share it across clients.
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+        opcode = opcode or TEXT
+    opcode = opcode or BINARY
+    first_byte = 0x80 | opcode | (0x40 if compressed else 0) # RSV1 marks a permessage-deflate payload
+    length = len(data)
+    if length <= 125:
+        header = struct.pack('!BB', first_byte, length)
+    elif length <= 65535:
+        header = struct.pack('!BBH', first_byte, 126, length)
+    else:
+        header = struct.pack('!BBQ', first_byte, 127, length)
+    return header + data
+
+# --- Message Serialization (JSON backend, cached timestamps, payload templates) ---
+COMPACT_JSON_ENCODER = json.JSONEncoder(separators=(',', ':')) # Reused: json.dumps() with options builds one per call
+
+def stdlib_json_dumps(value):
+    return COMPACT_JSON_ENCODER.encode(value).encode('utf-8')
+
+def load_json_encoder(name):
+    # Returns (backend name, dumps, payload encoder); dumps(value) -> compact JSON bytes, the payload encoder
+    # turns a message dict into its broadcast bytes. orjson encodes the whole dict faster than the template
+    # below; with the json module the template is several times faster than dumping the dict.
+    if name not in JSON_ENCODERS:
+        raise ValueError(f"unknown JSON encoder '{name}' (expected one of {', '.join(JSON_ENCODERS)})")
+    if name in ("auto", "orjson"):
+        try:
+            import orjson
+            return "orjson", orjson.dumps, orjson.dumps
+        except ImportError:
+            if name == "orjson":
+                raise ValueError("JSON encoder 'orjson' is not installed")
+    return "json", stdlib_json_dumps, encode_templated_payload
+
+class TimestampCache:
+    # ISO 8601 UTC timestamps with millisecond precision, formatted at most once per millisecond
+    # (the date/time part once per second) instead of a datetime.now().isoformat() per message.
+    __slots__ = ("second", "second_text", "millis", "text")
+
+    def __init__(self):
+        self.second = self.millis = -1
+        self.second_text = self.text = ""
+
+    def now(self):
+        millis = time.time_ns() // 1000000
+        if millis != self.millis:
+            second, fraction = divmod(millis, 1000)
+            if second != self.second:
+                self.second = second
+                self.second_text = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+            self.millis = millis
+            self.text = f"{self.second_text}.{fraction:03d}+00:00"
+        return self.text
+
+    def to_millis(self, timestamp):
+        if timestamp == self.text:
+            return float(self.millis)
+        return datetime.datetime.fromisoformat(timestamp).timestamp() * 1000
+
+utc_timestamps = TimestampCache()
+payload_templates = {} # (type, ip, port) -> b'{"type":...,"ip":...,"port":...,"timestamp":"'
+
+def encode_templated_payload(message_data_dict):
+    # Only data and seq are encoded per message; the source fields come from a template and the timestamp is
+    # ASCII by construction. Same fields, in the same order, as dumping the dict.
+    key = (message_data_dict["type"], message_data_dict["ip"], message_data_dict["port"])
+    prefix = payload_templates.get(key)
+    if prefix is None:
+        if len(payload_templates) >= PAYLOAD_TEMPLATE_CACHE_SIZE:
+            payload_templates.clear()
+        prefix = payload_templates[key] = b'{"type":%s,"ip":%s,"port":%s,"timestamp":"' % (
+            json_dumps(key[0]), json_dumps(key[1]), json_dumps(key[2]))
+    return b'%s%s","data":%s,"seq":%d}' % (
+        prefix, message_data_dict["timestamp"].encode('ascii'), json_dumps(message_data_dict["data"]), message_data_dict["seq"])
+
+json_encoder_name, json_dumps, encode_message_payload = load_json_encoder(JSON_ENCODER)
+
+# --- Payload Encodings (permessage-deflate, binary layout) ---
+DEFLATE_TAIL = b'\x00\x00\xff\xff'
+DEFLATE_EXTENSION_RESPONSE = "permessage-deflate; server_no_context_takeover; client_no_context_takeover"
+
+def deflate_payload(data):
+    # No context takeover: every message is compressed on its own, so one compressed frame serves every client.
+    compressor = zlib.compressobj(WS_DEFLATE_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return compressed[:-len(DEFLATE_TAIL)]
+
+def inflate_payload(data):
+    inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    inflated = inflater.decompress(bytes(data) + DEFLATE_TAIL, WS_MAX_INFLATED_BYTES)
+    if inflater.unconsumed_tail:
+        raise Exception('inflated payload exceeded allowable size')
+    return inflated
+
+def accepts_permessage_deflate(extensions_header):
+    # Accept an offer unless it limits our window (server_max_window_bits < 15), which we do not implement.
+    for offer in (extensions_header or "").split(','):
+        params = [param.strip() for param in offer.split(';')]
+        if params[0] != "permessage-deflate":
+            continue
+        if any(param.startswith("server_max_window_bits=") and param.split('=', 1)[1].strip('"') != "15" for param in params[1:]):
+            continue
+        return True
+    return False
+
+# Binary layout, big-endian: version, seq, timestamp (ms since epoch, float64), port, len(type), len(ip),
+# then the type and ip as ASCII and the data as UTF-8 up to the end of the frame. Mirrored by decodeBinaryMessage in ws.js.
+BINARY_MESSAGE_VERSION = 1
+BINARY_MESSAGE_HEADER = struct.Struct('!BQdHBB')
+
+def encode_binary_message(message_data_dict):
+    msg_type = (message_data_dict.get("type") or "").encode('ascii')
+    ip = str(message_data_dict.get("ip") or "").encode('ascii')
+    timestamp = message_data_dict.get("timestamp")
+    timestamp_ms = utc_timestamps.to_millis(timestamp) if timestamp else 0.0
+    return BINARY_MESSAGE_HEADER.pack(
+        BINARY_MESSAGE_VERSION, message_data_dict.get("seq") or 0, timestamp_ms,
+        message_data_dict.get("port") or 0, len(msg_type), len(ip)
+    ) + msg_type + ip + (message_data_dict.get("data") or "").encode('utf-8')
+
+# Batches (WS_BATCH_WINDOW_MS): JSON is {"type":"batch","messages":[...]}; binary is u8 version 2, u32 count,
+# then per message a u32 length and a version-1 message. Both are unpacked by ws.js.
+BINARY_BATCH_VERSION = 2
+BINARY_BATCH_HEADER = struct.Struct('!BI')
+BINARY_BATCH_LENGTH = struct.Struct('!I')
+
+def build_batch_frame(payload_encoding, entries, binary_cache):
+    # entries: (seq, message_bytes, message_data_dict or None); binary_cache: seq -> encoded message, shared by the batches of one window
+    encoding, deflate = payload_encoding
+    if encoding == "binary":
+        parts = []
+        for seq, message_bytes, message_data_dict in entries:
+            encoded = binary_cache.get(seq)
+            if encoded is None:
+                encoded = binary_cache[seq] = encode_binary_message(message_data_dict or json.loads(message_bytes))
+            parts.append(BINARY_BATCH_LENGTH.pack(len(encoded)))
+            parts.append(encoded)
+        payload, opcode = BINARY_BATCH_HEADER.pack(BINARY_BATCH_VERSION, len(entries)) + b''.join(parts), BINARY
+    else:
+        payload, opcode = b'{"type":"batch","messages":[' + b','.join(entry[1] for entry in entries) + b']}', TEXT
+    if deflate and len(payload) >= WS_DEFLATE_MIN_BYTES:
+        return build_ws_frame(deflate_payload(payload), opcode, compressed=True)
+    return build_ws_frame(payload, opcode)
+
+def build_broadcast_frame(payload_encoding, message_bytes, message_data_dict, seq=None):
+    encoding, deflate = payload_encoding
+    if encoding == "sse":
+        return build_sse_event(seq, message_bytes)
+    if encoding == "poll":
+        return message_bytes # Spliced into the long-poll answer as-is
+    if encoding == "binary":
+        payload, opcode = encode_binary_message(message_data_dict), BINARY
+    else:
+        payload, opcode = message_bytes, TEXT
+    if deflate and len(payload) >= WS_DEFLATE_MIN_BYTES:
+        return build_ws_frame(deflate_payload(payload), opcode, compressed=True)
+    return build_ws_frame(payload, opcode)
+
+NO_SUBSCRIPTIONS = frozenset() # Shared by every client that never subscribed
+PING_FRAME = build_ws_frame(b"", PING)
+
+# ClientConnectionHandler and LoopWebSocketServer rely on simple_websocket_server internals, not only its public
+# API: the connection's _send_message, _parse_message, _handle_packet, _handle_data and _send_buffer, the server's
+# _decorate_socket, the sendq deque and the HEADERB1 parser state. requirements.txt pins the release they were
+# written against (0.4.4); check them against the library's source before upgrading it.
+class ClientConnectionHandler(WebSocket): # Renamed class
+    # WebSocket has no __slots__, so instances still have a __dict__; listing every attribute (the library's and
+    # ours) here keeps it from ever being allocated. Measured on CPython 3.11: ~2.2 KB of Python objects per
+    # connection under tracemalloc (1.5 KB of it the sendq and outbound deques), ~3.4 KB without the slots, and
+    # ~3.2 KB RSS per idle client with 10,000 connected. Setting an attribute missing from this list brings the dict back.
+    __slots__ = (
+        "server", "client", "address", "handshaked", "headerbuffer", "headertoread", "fin", "data", "opcode", "hasmask",
+        "maskarray", "length", "lengtharray", "index", "request", "usingssl", "frag_start", "frag_type", "frag_buffer",
+        "frag_decoder", "closed", "sendq", "state", "maxheader", "maxpayload",
+        "outbound", "outbound_bytes", "overflow_policy", "frames_sent", "frames_dropped", "peak_queue_depth", "evicted",
+        "subscriptions", "payload_encoding", "inbound_compressed", "coalesce", "pending_batch", "history_task", "conn_fileno",
+        "aggregate_window", "last_activity", "pings_unanswered", "wheel_slot",
+    )
+
+    def __init__(self, server, sock, address):
+        super().__init__(server, sock, address)
+        # Data frames wait here (bounded); sendq keeps the handshake, control frames and partially written frames.
+        self.outbound = deque()
+        self.outbound_bytes = 0
+        self.overflow_policy = WS_SEND_QUEUE_POLICY
+        # Lag counters
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.peak_queue_depth = 0
+        self.evicted = False
+        self.subscriptions = NO_SUBSCRIPTIONS # (type, ip, port, prefix) filters, see SubscriptionRouter
+        self.payload_encoding = ("json", False) # (encoding, permessage-deflate), the key broadcasts are cached by
+        self.inbound_compressed = False
+        self.coalesce = WS_BATCH_WINDOW_MS > 0 # ?batch=0 opts out: one frame per message, sent right away
+        self.pending_batch = [] # Broadcasts waiting for the current window (see BroadcastCoalescer)
+        self.history_task = None # Journal query being streamed to this client
+        self.aggregate_window = None # "tumbling" / "sliding": summaries from the WindowAggregator instead of messages
+        self.last_activity = connection_wheel.now # Last frame received, for pings (see expire)
+        self.pings_unanswered = 0
+        self.wheel_slot = None
+
+    def handleMessage(self):
+        if should_log_message():
+            log_activity(f"WS: Message from Client {self.address}: {self.data}", LOG_DEBUG)
+        if isinstance(self.data, str) and self.data.startswith('{'):
+            try:
+                request = json.loads(self.data)
+            except ValueError:
+                return
+            if isinstance(request, dict) and request.get("action"):
+                self.handle_control_request(request)
+
+    def handle_control_request(self, request, quiet=False):
+        action = request["action"]
+        try:
+            if action == "replay":
+                self.send_replay(request)
+                return
+            if action == "history":
+                self.start_history_query(request)
+                return
+            if action == "aggregate":
+                self.set_aggregate_window(request.get("window"))
+                return
+            if self.aggregate_window is not None and action in ("subscribe", "unsubscribe"):
+                raise ValueError("filters do not apply to aggregate summaries; send {\"action\": \"aggregate\", \"window\": \"off\"} first")
+            if action == "subscribe":
+                subscription = parse_subscription(request)
+                if subscription not in self.subscriptions and len(self.subscriptions) >= WS_MAX_SUBSCRIPTIONS_PER_CLIENT:
+                    raise ValueError(f"at most {WS_MAX_SUBSCRIPTIONS_PER_CLIENT} subscriptions per client")
+                subscription_router.subscribe(self, subscription)
+                log_activity(f"WS: Client {self.address} subscribed to {describe_subscription(subscription)}")
+            elif action == "unsubscribe":
+                if request.get("all"):
+                    subscription_router.unsubscribe_all(self)
+                else:
+                    subscription_router.unsubscribe(self, parse_subscription(request))
+                    if not self.subscriptions:
+                        subscription_router.unsubscribe_all(self) # No filters left: back to receiving everything
+            else:
+                raise ValueError(f"unknown action '{action}'")
+        except ValueError as e:
+            self.send_system_event("error", message=str(e), action=action)
+            return
+        if not quiet:
+            self.send_system_event("subscriptions", subscriptions=[describe_subscription(s) for s in self.subscriptions])
+
+    def send_replay(self, request):
+        # {"action": "replay", "since": N} resends everything after seq N; {"action": "replay", "last": K} the last K.
+        try:
+            if request.get("since") is not None:
+                since = int(request["since"])
+                entries = replay_buffer.since(since)
+                truncated = replay_buffer.truncated_after(since)
+            else:
+                entries = replay_buffer.last(int(request.get("last", 0)))
+                truncated = False
+        except (TypeError, ValueError):
+            raise ValueError("'since' and 'last' must be numbers")
+        if self.subscriptions:
+            entries = [entry for entry in entries if subscriptions_match(self.subscriptions, json.loads(entry[1]))]
+        if coalescer.has_pending(self):
+            coalescer.flush() # Whatever is still waiting goes out before the backlog
+        log_activity(f"WS: Replaying {len(entries)} message(s) to {self.address} (truncated: {truncated})")
+        for payload in build_replay_payloads(entries, truncated):
+            self.enqueue_frame(self.build_frame(payload, TEXT))
+
+    def set_aggregate_window(self, window):
+        # Aggregating clients are taken out of message routing altogether; "off" puts them back as unfiltered.
+        if window not in AGGREGATE_WINDOWS and window != "off":
+            raise ValueError(f"'window' must be one of {', '.join(AGGREGATE_WINDOWS)} or off")
+        if window == "off":
+            if self.aggregate_window is not None:
+                window_aggregator.unsubscribe(self)
+                self.aggregate_window = None
+                subscription_router.add_client(self)
+        else:
+            if self.aggregate_window is None:
+                subscription_router.remove_client(self)
+                self.subscriptions = NO_SUBSCRIPTIONS
+            else:
+                window_aggregator.unsubscribe(self)
+            self.aggregate_window = window
+            window_aggregator.subscribe(self)
+        log_activity(f"WS: Client {self.address} aggregate window: {window}")
+        self.send_system_event("aggregate", window=window, interval=AGGREGATE_INTERVAL,
+                               buckets=AGGREGATE_SLIDING_BUCKETS if window == "sliding" else 1)
+
+    def start_history_query(self, request):
+        # {"action": "history", "from": ..., "to": ..., "ip": ..., "type": ..., "limit": N, "id": ...}; from/to are
+        # epoch seconds or ISO 8601. Answered by "history" events streamed in chunks, the last one with "final": true.
+        try:
+            start = parse_journal_time(request.get("from"))
+            end = parse_journal_time(request.get("to"))
+            limit = min(int(request.get("limit") or JOURNAL_QUERY_MAX_MESSAGES), JOURNAL_QUERY_MAX_MESSAGES)
+        except (TypeError, ValueError):
+            raise ValueError("'from' and 'to' must be epoch seconds or ISO 8601 times, 'limit' a number")
+        ip = request.get("ip")
+        if self.history_task is not None:
+            self.history_task.cancel() # One query at a time per client; a new one replaces it
+        log_activity(f"WS: History query from {self.address}: from {start} to {end}, ip {ip}, type {request.get('type')}, limit {limit}")
+        chunks = journal_query_chunks(start, end, str(ip) if ip else None, request.get("type"), limit)
+        self.history_task = self.server.loop.create_task(stream_history(self, request.get("id"), chunks))
+
+    def send_system_event(self, event, **fields):
+        self.sendMessage(json.dumps({"type": "system", "event": event, **fields}))
+
+    def handleConnected(self):
+        log_activity(f"WS: New Client connected: {self.address}")
+        connected_ws_clients.add(self)
+        subscription_router.add_client(self)
+        log_activity(f"WS: Total connected clients: {len(connected_ws_clients)}")
+        # Send a connection confirmation message to this specific client
+        try:
+            self.sendMessage(json.dumps({
+                "type": "system",
+                "event": "connected",
+                "message": "Conectado ao servidor WebSocket!",
+                "clientId": str(self.address), # Example client identifier
+                "lastSeq": replay_buffer.last_seq
+            }))
+        except Exception as e:
+            log_activity(f"WS: Error sending connection confirmation to {self.address}: {e}")
+        self.apply_connect_options()
+        if WS_PING_INTERVAL:
+            connection_wheel.schedule(self, WS_PING_INTERVAL)
+        else:
+            connection_wheel.cancel(self) # Only the handshake timeout was pending
+        # The parsed handshake (headers, raw request) is not needed any more; it is the bulk of an idle connection
+        self.request = None
+        self.headerbuffer = None
+
+    def apply_connect_options(self):
+        # ws://host:port/?type=udp&since=1234 : filters and replay requested in the handshake take effect before
+        # any live message is queued, so the backlog and the live stream neither overlap nor leave a gap.
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(getattr(self.request, 'path', '') or '').query)
+        options = {name: values[-1] for name, values in query.items()}
+        if "encoding" in options:
+            if options["encoding"] in WS_PAYLOAD_ENCODINGS:
+                self.payload_encoding = (options["encoding"], self.payload_encoding[1])
+            else:
+                self.send_system_event("error", message=f"unknown encoding '{options['encoding']}'", action="connect")
+        if options.get("batch") == "0":
+            subscription_router.discard_unfiltered(self)
+            self.coalesce = False
+            subscription_router.add_client(self)
+        if "aggregate" in options:
+            self.handle_control_request({"action": "aggregate", "window": options["aggregate"]})
+        if any(field in options for field in ("type", "ip", "port", "prefix")):
+            self.handle_control_request({"action": "subscribe", **options}, quiet=True)
+        if "since" in options or "last" in options:
+            self.handle_control_request({"action": "replay", **options})
+
+
+    def handleClose(self):
+        log_activity(f"WS: Client disconnected: {self.address} (sent {self.frames_sent}, dropped {self.frames_dropped}, peak queue {self.peak_queue_depth})")
+        connected_ws_clients.discard(self)
+        subscription_router.remove_client(self)
+        coalescer.discard(self)
+        if self.aggregate_window is not None:
+            window_aggregator.unsubscribe(self)
+        if self.history_task is not None:
+            self.history_task.cancel()
+        log_activity(f"WS: Total connected clients: {len(connected_ws_clients)}")
+
+    # simple_websocket_server 0.4 calls the snake_case hooks; the camelCase handlers above stay the implementation.
+    def handle(self):
+        self.handleMessage()
+
+    def connected(self):
+        self.negotiate_extensions()
+        self.handleConnected()
+
+    def handle_close(self):
+        self.handleClose()
+
+    def sendMessage(self, data):
+        self.send_message(data)
+
+    def _send_message(self, fin, opcode, data):
+        # Frames are only queued here; the event loop writes them out (see LoopWebSocketServer).
+        if opcode in (TEXT, BINARY) and fin is False:
+            self.enqueue_frame(self.build_frame(data, opcode))
+            return
+        super()._send_message(fin, opcode, data)
+        self.server.schedule_flush(self)
+
+    def build_frame(self, data, opcode):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if self.payload_encoding[1] and len(data) >= WS_DEFLATE_MIN_BYTES:
+            return build_ws_frame(deflate_payload(data), opcode, compressed=True)
+        return build_ws_frame(data, opcode)
+
+    def negotiate_extensions(self):
+        # The library has already queued its 101 response (last sendq entry); add our extension answer to it.
+        if not WS_PERMESSAGE_DEFLATE or not accepts_permessage_deflate(self.request.headers.get('Sec-WebSocket-Extensions')):
+            return
+        opcode, response = self.sendq.pop()
+        self.sendq.append((opcode, response[:-2] + f"Sec-WebSocket-Extensions: {DEFLATE_EXTENSION_RESPONSE}\r\n\r\n".encode('ascii')))
+        self.payload_encoding = (self.payload_encoding[0], True)
+
+    def _parse_message(self, byte):
+        # The library rejects any RSV bit, so RSV1 (compressed message) is taken off here and undone in _handle_packet.
+        if self.state == HEADERB1 and byte & 0x40 and self.payload_encoding[1]:
+            self.inbound_compressed = True
+            byte &= ~0x40
+        super()._parse_message(byte)
+
+    def _handle_packet(self):
+        self.last_activity = connection_wheel.now # Any frame counts, a pong as well as a message
+        self.pings_unanswered = 0
+        if self.inbound_compressed:
+            self.inbound_compressed = False
+            if not self.fin:
+                raise Exception('fragmented compressed messages are not supported')
+            self.data = bytearray(inflate_payload(self.data))
+        super()._handle_packet()
+
+    def enqueue_frame(self, frame):
+        # Never blocks the caller: a full queue is resolved by the client's overflow policy.
+        if self.evicted:
+            return
+        if len(self.outbound) >= WS_SEND_QUEUE_MAX_FRAMES or self.outbound_bytes + len(frame) > WS_SEND_QUEUE_MAX_BYTES:
+            if self.overflow_policy == "disconnect":
+                self.evict_slow_consumer()
+                return
+            self.frames_dropped += 1
+            relay_stats["frames_dropped"] += 1
+            if self.overflow_policy == "drop-newest" or not self.outbound:
+                return
+            self.outbound_bytes -= len(self.outbound.popleft())
+        self.outbound.append(frame)
+        relay_stats["frames_enqueued"] += 1
+        self.outbound_bytes += len(frame)
+        if len(self.outbound) > self.peak_queue_depth:
+            self.peak_queue_depth = len(self.outbound)
+        self.server.schedule_flush(self)
+
+    def expire(self, now):
+        # Timer wheel callback: handshake deadline before the handshake, then the ping cycle
+        if not self.handshaked:
+            reaped_stats["ws_handshake"] += 1 # Counted, not logged: a connection flood would flood the log
+            self.server.drop_client(self.conn_fileno)
+            return None
+        if not WS_PING_INTERVAL:
+            return None
+        silent = now - self.last_activity
+        if silent < WS_PING_INTERVAL:
+            return WS_PING_INTERVAL - silent
+        if self.pings_unanswered >= WS_PING_MISSED_LIMIT:
+            reaped_stats["ws_unresponsive"] += 1
+            log_activity(f"WS: Evicting {self.address}: no answer to {self.pings_unanswered} ping(s) in {silent:.0f}s.")
+            self.server.drop_client(self.conn_fileno)
+            return None
+        self.pings_unanswered += 1
+        self.sendq.append((PING, PING_FRAME)) # Control frames go ahead of queued data frames
+        self.server.schedule_flush(self)
+        return WS_PING_INTERVAL
+
+    def evict_slow_consumer(self):
+        self.evicted = True
+        self.frames_dropped += len(self.outbound) + 1
+        relay_stats["frames_dropped"] += len(self.outbound) + 1
+        relay_stats["slow_consumers_evicted"] += 1
+        self.outbound.clear()
+        self.outbound_bytes = 0
+        log_activity(f"WS: Evicting slow consumer {self.address} (send queue full).")
+        # Deferred so a broadcast that is iterating connected_ws_clients is not disturbed
+        self.server.loop.call_soon(self.server.drop_client, self.conn_fileno)
+
+class LoopWebSocketServer(WebSocketServer):
+    # Runs simple_websocket_server's connections on the asyncio loop (epoll) instead of its own select() loop,
+    # so WebSocket fan-out and TCP/UDP ingest share one thread and one poller.
+    request_queue_size = WS_LISTEN_BACKLOG
+
+    def __init__(self, host, port, websocketclass, reuse_port=False, sock=None):
+        # Same listening setup as WebSocketServer.__init__ (no TLS), plus SO_REUSEPORT for worker processes.
+        # super().__init__() is not called, since it binds its own socket: every attribute it sets is set here
+        # instead, so a library release that adds one needs it added here too.
+        # sock: an already listening socket inherited from the previous process on reload.
+        self.websocketclass = websocketclass
+        if sock is not None:
+            self.serversocket = sock
+        else:
+            self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                self.serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.serversocket.bind((host, port))
+            self.serversocket.listen(self.request_queue_size)
+        self.select_interval = 0.1
+        self.connections = {}
+        self.listeners = [self.serversocket]
+        self._using_ssl = False
+        self.context = None
+
+    def attach_to_loop(self, loop):
+        self.loop = loop
+        self.pending_flush = set()
+        self.serversocket.setblocking(False)
+        loop.add_reader(self.serversocket.fileno(), self._on_accept_ready)
+
+    def _on_accept_ready(self):
+        for _ in range(WS_ACCEPT_BATCH):
+            try:
+                sock, address = self.serversocket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                log_activity(f"WS: Accept error: {e}")
+                return
+            if len(self.connections) >= WS_MAX_CLIENTS:
+                relay_stats["ws_clients_refused"] += 1 # Counted, not logged: a reconnect storm would flood the log
+                sock.close()
+                continue
+            try:
+                newsock = self._decorate_socket(sock)
+                newsock.setblocking(False)
+                client = self._construct_websocket(newsock, address)
+            except Exception as e:
+                log_activity(f"WS: Error setting up connection from {address}: {e}")
+                sock.close()
+                continue
+            client.conn_fileno = newsock.fileno()
+            self.connections[client.conn_fileno] = client
+            if WS_HANDSHAKE_TIMEOUT:
+                connection_wheel.schedule(client, WS_HANDSHAKE_TIMEOUT)
+            self.loop.add_reader(client.conn_fileno, self._on_client_readable, client.conn_fileno)
+
+    def _on_client_readable(self, fileno):
+        client = self.connections.get(fileno)
+        if client is None:
+            return
+        try:
+            client._handle_data()
+        except Exception:
+            self.drop_client(fileno)
+            return
+        if client.sendq: # Handshake response is queued directly on sendq
+            self.schedule_flush(client)
+
+    def _on_client_writable(self, fileno):
+        client = self.connections.get(fileno)
+        if client is not None:
+            self._flush_client(client)
+
+    def schedule_flush(self, client):
+        # Coalesce every frame queued during this loop iteration into one write pass per client.
+        if not self.pending_flush:
+            self.loop.call_soon(self._flush_pending)
+        self.pending_flush.add(client)
+
+    def _flush_pending(self):
+        clients_to_flush = self.pending_flush
+        self.pending_flush = set()
+        for client in clients_to_flush:
+            self._flush_client(client)
+
+    def _flush_client(self, client):
+        fileno = getattr(client, 'conn_fileno', None)
+        if self.connections.get(fileno) is not client:
+            return
+        try:
+            while client.sendq:
+                opcode, payload = client.sendq.popleft()
+                remaining = client._send_buffer(payload)
+                if remaining is not None:
+                    client.sendq.appendleft((opcode, remaining))
+                    self.loop.add_writer(fileno, self._on_client_writable, fileno)
+                    return
+                if opcode == CLOSE:
+                    raise Exception('received client close')
+            if client.handshaked and not self._write_outbound(client):
+                self.loop.add_writer(fileno, self._on_client_writable, fileno)
+                return
+        except OSError:
+            relay_stats["send_errors"] += 1
+            self.drop_client(fileno)
+            return
+        except Exception:
+            self.drop_client(fileno)
+            return
+        self.loop.remove_writer(fileno)
+
+    def _write_outbound(self, client):
+        # Gathers queued frames into one sendmsg() per batch; returns False when the socket buffer is full.
+        outbound = client.outbound
+        while outbound:
+            frames = list(islice(outbound, WS_WRITEV_BATCH))
+            try:
+                sent = client.client.sendmsg(frames)
+            except (BlockingIOError, InterruptedError):
+                return False
+            for frame in frames:
+                outbound.popleft()
+                client.outbound_bytes -= len(frame)
+                client.frames_sent += 1
+                relay_stats["frames_sent"] += 1
+                if sent < len(frame):
+                    # Partially written: the tail goes to the head of sendq, which is always drained first
+                    client.sendq.appendleft((TEXT, frame[sent:]))
+                    return False
+                sent -= len(frame)
+        return True
+
+    def drop_client(self, fileno):
+        client = self.connections.pop(fileno, None)
+        if client is None:
+            return
+        connection_wheel.cancel(client)
+        self.loop.remove_reader(fileno)
+        self.loop.remove_writer(fileno)
+        self._handle_close(client)
+
+    def detach_listener(self):
+        # Stop accepting and give up the listening socket (reload handoff); clients stay connected.
+        if self.serversocket is None:
+            return None
+        self.loop.remove_reader(self.serversocket.fileno())
+        sock, self.serversocket = self.serversocket, None
+        return sock
+
+    def close_clients(self, status=1000, reason=''):
+        for fileno, client in list(self.connections.items()):
+            client.close(status, reason) # Queues a close frame; give it one non-blocking write attempt
+            self._flush_client(client)
+            self.drop_client(fileno)
+
+    def close(self):
+        if getattr(self, 'loop', None) is None:
+            super().close()
+            return
+        if self.serversocket is not None:
+            self.loop.remove_reader(self.serversocket.fileno())
+            self.serversocket.close()
+        self.close_clients()
+
+# --- HTTP Streaming (Server-Sent Events and long-poll, for clients that cannot open a WebSocket) ---
+# GET /events streams every broadcast as an SSE event ("id: <seq>", "data: <the broadcast JSON>"); EventSource
+# reconnects on its own with Last-Event-ID and gets what it missed from the replay buffer. GET /poll?since=N answers
+# at once with the buffered messages after N, or holds the request until the next one (LONG_POLL_TIMEOUT at most).
+# Both take the WebSocket URL's filters (?type=&ip=&port=&prefix=) and sit in the same SubscriptionRouter as the
+# WebSocket clients, so the broadcast loop builds one event per message and every stream queues the same bytes.
+http_stream_clients = set() # Every connection on HTTP_STREAM_PORT, from accept to close
+http_stream_flush_pending = set()
+http_stream_counts = {"sse": 0, "poll": 0} # Open event streams and waiting polls, for the log and the gauges
+http_stream_stats = {"requests": 0, "bad_requests": 0, "clients_refused": 0, "polls_answered": 0, "keepalives": 0}
+
+SSE_RESPONSE_HEADERS = (
+    b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: keep-alive\r\n"
+    b"X-Accel-Buffering: no\r\nAccess-Control-Allow-Origin: *\r\n\r\n" # X-Accel-Buffering: nginx must not hold events back
+)
+SSE_KEEPALIVE_EVENT = b": keepalive\n\n"
+
+def build_sse_event(seq, message_bytes):
+    return b"id: %d\ndata: %s\n\n" % (seq, message_bytes) # Compact JSON never contains a raw newline
+
+def build_http_response(status, body, content_type="application/json"):
+    return (f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nCache-Control: no-cache\r\n"
+            f"Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n").encode('ascii') + body
+
+def replay_backlog(since, subscription):
+    # Buffered messages after seq `since` that pass the filter, and whether older ones were already discarded
+    entries = replay_buffer.since(since)
+    truncated = replay_buffer.truncated_after(since)
+    if subscription is not None:
+        entries = [entry for entry in entries if subscriptions_match((subscription,), json.loads(entry[1]))]
+    return entries, truncated
+
+def schedule_http_stream_flush(client):
+    # As LoopWebSocketServer.schedule_flush: the events queued during one loop iteration go out in one write.
+    if not http_stream_flush_pending:
+        asyncio.get_running_loop().call_soon(flush_http_streams)
+    http_stream_flush_pending.add(client)
+
+def flush_http_streams():
+    clients = list(http_stream_flush_pending)
+    http_stream_flush_pending.clear()
+    for client in clients:
+        client.write_outbound()
+
+class HttpStreamClient(asyncio.Protocol):
+    # One connection on HTTP_STREAM_PORT, in mode None (reading the request), "sse", "poll" (waiting for a message)
+    # or "done" (answered, closing). Events wait in outbound under the WebSocket queue limits and policy while the
+    # transport holds more than HTTP_STREAM_WRITE_BUFFER; the router and the broadcast loop treat it like a
+    # WebSocket client with the payload encoding "sse" or "poll".
+    __slots__ = (
+        "transport", "address", "request_buffer", "mode", "subscriptions", "payload_encoding", "coalesce", "outbound",
+        "outbound_bytes", "write_paused", "evicted", "frames_sent", "frames_dropped", "peak_queue_depth", "last_write", "wheel_slot",
+    )
+
+    def __init__(self):
+        self.transport = None
+        self.address = None
+        self.request_buffer = bytearray()
+        self.mode = None
+        self.subscriptions = NO_SUBSCRIPTIONS
+        self.payload_encoding = ("sse", False)
+        self.coalesce = False # Never batched: events are small and a loop iteration's worth is written at once anyway
+        self.outbound = deque()
+        self.outbound_bytes = 0
+        self.write_paused = False
+        self.evicted = False
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.peak_queue_depth = 0
+        self.last_write = connection_wheel.now
+        self.wheel_slot = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        if len(http_stream_clients) >= HTTP_STREAM_MAX_CLIENTS:
+            http_stream_stats["clients_refused"] += 1 # Counted, not logged, as for WebSocket clients
+            self.mode = "done"
+            transport.abort()
+            return
+        http_stream_clients.add(self)
+        transport.set_write_buffer_limits(high=HTTP_STREAM_WRITE_BUFFER)
+        configure_keepalive(transport.get_extra_info('socket'))
+        if HTTP_REQUEST_TIMEOUT:
+            connection_wheel.schedule(self, HTTP_REQUEST_TIMEOUT)
+
+    def data_received(self, data):
+        if self.mode is not None:
+            return # Nothing is read after the request headers
+        self.request_buffer += data
+        end = self.request_buffer.find(b"\r\n\r\n")
+        if end < 0:
+            if len(self.request_buffer) > HTTP_MAX_REQUEST_BYTES:
+                self.reject("431 Request Header Fields Too Large", "request headers too large")
+            return
+        head = self.request_buffer[:end].decode('latin-1')
+        self.request_buffer = None
+        http_stream_stats["requests"] += 1
+        try:
+            self.handle_request(head)
+        except ValueError as e:
+            self.reject("400 Bad Request", str(e))
+
+    def handle_request(self, head):
+        request_line, *header_lines = head.split("\r\n")
+        parts = request_line.split()
+        if len(parts) != 3:
+            raise ValueError("malformed request line")
+        method, target, _ = parts
+        url = urllib.parse.urlsplit(target)
+        if url.path not in ("/events", "/poll"):
+            self.reject("404 Not Found", "use /events (Server-Sent Events) or /poll (long-poll)")
+            return
+        if method != "GET":
+            self.reject("405 Method Not Allowed", "only GET is supported")
+            return
+        headers = {}
+        for line in header_lines:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        options = {name: values[-1] for name, values in urllib.parse.parse_qs(url.query).items()}
+        subscription = parse_subscription(options) if any(field in options for field in ("type", "ip", "port", "prefix")) else None
+        since = headers.get("last-event-id") or options.get("since") # An EventSource reconnect sends the header
+        try:
+            since = int(since) if since else None
+        except ValueError:
+            raise ValueError("'since' and Last-Event-ID must be numbers")
+        if url.path == "/events":
+            self.start_stream(subscription, since)
+        else:
+            self.start_poll(subscription, since)
+
+    def start_stream(self, subscription, since):
+        # The backlog is queued before the client joins the router, so backlog and live events neither overlap nor leave a gap
+        self.mode = "sse"
+        connected = {"type": "system", "event": "connected", "lastSeq": replay_buffer.last_seq}
+        entries = ()
+        if since is not None:
+            entries, connected["truncated"] = replay_backlog(since, subscription)
+        # No id on the connected event: the client's Last-Event-ID stays as it was
+        self.transport.write(SSE_RESPONSE_HEADERS + b"retry: %d\n\ndata: %s\n\n" % (SSE_RETRY_MS, json_dumps(connected)))
+        chunk, chunk_bytes = [], 0
+        for seq, message_bytes in entries: # Queued in REPLAY_FRAME_MAX_BYTES pieces, as WebSocket replays are
+            chunk.append(build_sse_event(seq, message_bytes))
+            chunk_bytes += len(chunk[-1])
+            if chunk_bytes >= REPLAY_FRAME_MAX_BYTES:
+                self.enqueue_frame(b"".join(chunk))
+                chunk, chunk_bytes = [], 0
+        if chunk:
+            self.enqueue_frame(b"".join(chunk))
+        self.join_router(subscription)
+        http_stream_counts["sse"] += 1
+        if SSE_KEEPALIVE_INTERVAL:
+            connection_wheel.schedule(self, SSE_KEEPALIVE_INTERVAL)
+        else:
+            connection_wheel.cancel(self)
+        log_activity(f"HTTP: Event stream opened by {self.address} ({len(entries)} replayed). Streams: {http_stream_counts['sse']}")
+
+    def start_poll(self, subscription, since):
+        # Without ?since the poll waits for the next message. Answers carry "lastSeq", the since of the next poll.
+        self.mode = "poll"
+        self.payload_encoding = ("poll", False)
+        if since is not None:
+            entries, truncated = replay_backlog(since, subscription)
+            if entries or truncated:
+                cursor = entries[LONG_POLL_MAX_MESSAGES - 1][0] if len(entries) > LONG_POLL_MAX_MESSAGES else replay_buffer.last_seq
+                self.answer_poll([message_bytes for _, message_bytes in entries[:LONG_POLL_MAX_MESSAGES]], cursor, truncated)
+                return
+        self.join_router(subscription)
+        http_stream_counts["poll"] += 1
+        connection_wheel.schedule(self, LONG_POLL_TIMEOUT)
+
+    def join_router(self, subscription):
+        subscription_router.add_client(self)
+        if subscription is not None:
+            subscription_router.subscribe(self, subscription)
+
+    def answer_poll(self, messages, cursor, truncated):
+        # The stored JSON of each message is spliced in as-is, as in replay frames
+        if self.mode == "poll":
+            http_stream_counts["poll"] -= 1
+        self.mode = "done"
+        body = b'{"messages": [' + b",".join(messages) + b'], "lastSeq": %d, "truncated": %s}' % (cursor, b"true" if truncated else b"false")
+        self.transport.write(build_http_response("200 OK", body))
+        self.transport.close() # The router lets go of us in connection_lost, outside any broadcast loop
+        http_stream_stats["polls_answered"] += 1
+
+    def reject(self, status, message):
+        self.mode = "done"
+        http_stream_stats["bad_requests"] += 1
+        self.transport.write(build_http_response(status, json_dumps({"error": message})))
+        self.transport.close()
+
+    def enqueue_frame(self, frame):
+        # Same contract as ClientConnectionHandler.enqueue_frame; a waiting poll is answered by its first message.
+        if self.mode == "poll":
+            self.answer_poll((frame,), replay_buffer.last_seq, False)
+            return
+        if self.evicted or self.mode != "sse":
+            return
+        if len(self.outbound) >= WS_SEND_QUEUE_MAX_FRAMES or self.outbound_bytes + len(frame) > WS_SEND_QUEUE_MAX_BYTES:
+            if WS_SEND_QUEUE_POLICY == "disconnect":
+                self.evict_slow_consumer()
+                return
+            self.frames_dropped += 1
+            relay_stats["frames_dropped"] += 1
+            if WS_SEND_QUEUE_POLICY == "drop-newest" or not self.outbound:
+                return
+            self.outbound_bytes -= len(self.outbound.popleft())
+        self.outbound.append(frame)
+        relay_stats["frames_enqueued"] += 1
+        self.outbound_bytes += len(frame)
+        if len(self.outbound) > self.peak_queue_depth:
+            self.peak_queue_depth = len(self.outbound)
+        if not self.write_paused:
+            schedule_http_stream_flush(self)
+
+    def write_outbound(self):
+        if self.write_paused or not self.outbound or self.transport.is_closing():
+            return
+        frames, self.outbound = self.outbound, deque()
+        self.outbound_bytes = 0
+        self.transport.writelines(frames) # One send for the batch; pause_writing() stops the next one if it backs up
+        self.frames_sent += len(frames)
+        relay_stats["frames_sent"] += len(frames)
+        self.last_write = connection_wheel.now
+
+    def pause_writing(self):
+        self.write_paused = True
+
+    def resume_writing(self):
+        self.write_paused = False
+        self.write_outbound()
+
+    def evict_slow_consumer(self):
+        self.evicted = True
+        self.frames_dropped += len(self.outbound) + 1
+        relay_stats["frames_dropped"] += len(self.outbound) + 1
+        relay_stats["slow_consumers_evicted"] += 1
+        self.outbound.clear()
+        self.outbound_bytes = 0
+        log_activity(f"HTTP: Evicting slow event stream {self.address} (send queue full).")
+        self.transport.abort() # connection_lost (and the router removal) comes later, outside the broadcast loop
+
+    def expire(self, now):
+        # Timer wheel: request deadline, then the poll timeout or the stream keepalive
+        if self.mode is None:
+            reaped_stats["http_request"] += 1
+            self.mode = "done"
+            self.transport.abort()
+            return None
+        if self.mode == "poll":
+            self.answer_poll((), replay_buffer.last_seq, False)
+            return None
+        if self.mode != "sse" or not SSE_KEEPALIVE_INTERVAL:
+            return None
+        idle = now - self.last_write
+        if idle < SSE_KEEPALIVE_INTERVAL:
+            return SSE_KEEPALIVE_INTERVAL - idle
+        http_stream_stats["keepalives"] += 1
+        self.enqueue_frame(SSE_KEEPALIVE_EVENT)
+        return SSE_KEEPALIVE_INTERVAL
+
+    def connection_lost(self, exc):
+        http_stream_clients.discard(self)
+        http_stream_flush_pending.discard(self)
+        connection_wheel.cancel(self)
+        subscription_router.remove_client(self)
+        if self.mode == "poll":
+            http_stream_counts["poll"] -= 1
+        elif self.mode == "sse":
+            http_stream_counts["sse"] -= 1
+            log_activity(f"HTTP: Event stream closed: {self.address} (sent {self.frames_sent}, dropped {self.frames_dropped}, "
+                         f"peak queue {self.peak_queue_depth}). Streams: {http_stream_counts['sse']}")
+        self.mode = "done"
+
+async def start_http_stream_server(sock=None):
+    # sock: the listening socket inherited from the previous process on reload
+    if not HTTP_STREAM_PORT:
+        if sock is not None:
+            sock.close()
+        return None
+    loop = asyncio.get_running_loop()
+    try:
+        if sock is not None:
+            server = await loop.create_server(HttpStreamClient, sock=sock, backlog=WS_LISTEN_BACKLOG)
+        else:
+            server = await loop.create_server(HttpStreamClient, HOST, HTTP_STREAM_PORT, backlog=WS_LISTEN_BACKLOG,
+                                              reuse_address=True, reuse_port=worker_index is not None)
+    except OSError as e:
+        log_activity(f"HTTP: Could not listen on {HOST}:{HTTP_STREAM_PORT}: {e}")
+        return None
+    log_activity(f"HTTP: Event streams on http://{HOST}:{HTTP_STREAM_PORT}/events, long-poll on /poll{' (inherited)' if sock else ''}")
+    return server
+
+def close_http_stream_clients():
+    # Waiting polls get an empty answer; streams are closed, and EventSource reconnects with its Last-Event-ID.
+    for client in list(http_stream_clients):
+        if client.mode == "poll":
+            client.answer_poll((), replay_buffer.last_seq, False)
+        elif not client.transport.is_closing():
+            client.transport.close()
+
+# --- Metrics (counters and latency histogram, served on METRICS_PORT) ---
+class LatencyHistogram:
+    # Fixed buckets (seconds): observe() is one bisect and a few adds; cumulative counts are built on scrape.
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation, capped at the observed max
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.buckets[index], self.max) if index < len(self.buckets) else self.max
+        return 0.0
+
+    def render(self, name, worker_label=""):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{worker_label}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{worker_label}le="+Inf"}} {self.count}')
+        labels = f'{{{worker_label[:-1]}}}' if worker_label else ""
+        lines.append(f"{name}_sum{labels} {self.sum}")
+        lines.append(f"{name}_count{labels} {self.count}")
+        return lines
+
+relay_stats = {"broadcasts": 0, "batches": 0, "frames_enqueued": 0, "frames_sent": 0, "frames_dropped": 0, "send_errors": 0, "slow_consumers_evicted": 0, "ws_clients_refused": 0, "aggregate_summaries": 0}
+ingress_stats = {} # protocol -> [messages, bytes]
+delivery_latency = LatencyHistogram(METRICS_LATENCY_BUCKETS) # Socket receive to the frame queued for the last recipient
+metrics_started_at = time.time()
+
+memory_baseline_bytes = None # RSS once the listeners are up, before any client; per-client memory is measured above it
+
+def resident_memory_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # Peak, where /proc is missing
+
+def record_memory_baseline():
+    global memory_baseline_bytes
+    memory_baseline_bytes = resident_memory_bytes()
+    log_activity(f"SERVER: Resident memory with no clients: {memory_baseline_bytes / 1e6:.1f} MB.")
+
+def memory_per_client(rss):
+    if memory_baseline_bytes is None or not connected_ws_clients:
+        return 0
+    return max(0, rss - memory_baseline_bytes) // len(connected_ws_clients)
+
+def count_ingress(protocol, nbytes):
+    counters = ingress_stats.get(protocol)
+    if counters is None:
+        counters = ingress_stats[protocol] = [0, 0]
+    counters[0] += 1
+    counters[1] += nbytes
+
+# --- Diagnostics (SIGUSR1 stack dump, SIGUSR2 sampling profiler, stage timing spans) ---
+# The signal handlers are plain signal.signal() handlers, not loop.add_signal_handler(): Python runs them between
+# bytecodes of the main thread, so they still fire while the event loop is stuck in a callback.
+SPAN_STAGES = ("ingest", "encode", "broadcast", "log")
+spans_enabled = SPANS_ENABLED
+# ingest: socket receive to the start of the broadcast (admission, decoding, payload dict); encode: the broadcast
+# payload; broadcast: journal, worker bus and fan-out to the client queues (without WS_BATCH_WINDOW_MS flushes);
+# log: one batched write of the activity log writer thread.
+stage_spans = {stage: LatencyHistogram(SPAN_BUCKETS) for stage in SPAN_STAGES}
+
+def set_spans_enabled(enabled):
+    # Histograms start over on every enable, so a session measures only itself; disabling logs its summary.
+    global spans_enabled
+    if enabled == spans_enabled:
+        return
+    if enabled:
+        for stage in SPAN_STAGES:
+            stage_spans[stage] = LatencyHistogram(SPAN_BUCKETS)
+    spans_enabled = enabled
+    if enabled:
+        log_activity("SPANS: Stage timing enabled.")
+    else:
+        log_activity("SPANS: Stage timing disabled. " + "; ".join(
+            f"{stage} {histogram.count}x p50 {histogram.quantile(0.5) * 1e6:.1f}us p99 {histogram.quantile(0.99) * 1e6:.1f}us"
+            for stage, histogram in stage_spans.items()))
+
+def span_summary():
+    return {
+        stage: {
+            "count": histogram.count,
+            "p50": round(histogram.quantile(0.5) * 1e6, 1),
+            "p99": round(histogram.quantile(0.99) * 1e6, 1),
+            "max": round(histogram.max * 1e6, 1),
+        }
+        for stage, histogram in stage_spans.items() if histogram.count
+    }
+
+def diagnostics_file(kind, extension):
+    return os.path.join(TMP_DIR, f"{kind}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.{extension}")
+
+def dump_stacks(current_frame=None):
+    # Written straight to its own file: the log writer thread may be the one that is stuck.
+    path = diagnostics_file("stacks", "txt")
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    main_ident = threading.main_thread().ident
+    try:
+        tasks = asyncio.all_tasks() # Only when the handler interrupted the running loop (main thread)
+    except RuntimeError:
+        tasks = ()
+    with open(path, "w") as f:
+        f.write(f"# {log_source} PID {os.getpid()}, {datetime.datetime.now().isoformat(timespec='milliseconds')}\n")
+        for ident, frame in sys._current_frames().items():
+            if ident == main_ident and current_frame is not None:
+                frame = current_frame # Where the signal arrived, not this function
+            f.write(f"\nThread {names.get(ident, '?')} ({ident}):\n")
+            f.write("".join(traceback.format_stack(frame)))
+        if tasks:
+            f.write(f"\nasyncio tasks ({len(tasks)}):\n")
+            for task in tasks:
+                task.print_stack(file=f)
+    log_activity(f"DIAG: Stack traces written to {path}")
+
+class SamplingProfiler:
+    # A daemon thread samples every other thread's stack each PROFILE_SAMPLE_INTERVAL and counts identical stacks.
+    # The output is the collapsed format ("thread;outer;...;inner count" per line) read by flamegraph.pl,
+    # speedscope and inferno. Costs one short GIL hold per sample while running, nothing otherwise.
+    def __init__(self):
+        self.thread = None
+        self.stop_requested = None
+
+    def toggle(self, duration=PROFILE_DURATION):
+        if self.thread is not None and self.thread.is_alive():
+            self.stop_requested.set() # The thread writes what it has so far
+            return
+        self.stop_requested = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(duration, self.stop_requested), name="sampling-profiler", daemon=True)
+        self.thread.start()
+        log_activity(f"PROFILE: Sampling every {PROFILE_SAMPLE_INTERVAL * 1000:g} ms for {duration}s (SIGUSR2 again stops early).")
+
+    def run(self, duration, stop_requested):
+        own_ident = threading.get_ident()
+        stacks = {} # (thread ident, innermost code, ..., outermost code) -> samples
+        samples = 0
+        started = time.monotonic()
+        deadline = started + duration
+        while not stop_requested.wait(PROFILE_SAMPLE_INTERVAL) and time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                key = [ident]
+                while frame is not None:
+                    key.append(frame.f_code)
+                    frame = frame.f_back
+                key = tuple(key)
+                stacks[key] = stacks.get(key, 0) + 1
+            samples += 1
+        try:
+            path = self.write(stacks)
+            log_activity(f"PROFILE: {samples} samples over {time.monotonic() - started:.1f}s written to {path}")
+        except OSError as e:
+            log_activity(f"PROFILE: Could not write the profile: {e}")
+
+    def write(self, stacks):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        labels = {}
+        lines = {}
+        for key, count in stacks.items():
+            frames = [names.get(key[0], f"thread-{key[0]}")]
+            for code in reversed(key[1:]):
+                label = labels.get(code)
+                if label is None: # Semicolons separate frames in the collapsed format
+                    label = labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+                frames.append(label)
+            stack = ";".join(frames)
+            lines[stack] = lines.get(stack, 0) + count
+        path = diagnostics_file("profile", "folded")
+        with open(path, "w") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in sorted(lines.items()))
+        return path
+
+profiler = SamplingProfiler()
+
+def diagnostic_signal_handler(signum, frame):
+    supervisor = worker_index is None and worker_count > 1
+    if signum == signal.SIGUSR1:
+        dump_stacks(frame)
+    elif not supervisor:
+        profiler.toggle()
+    if supervisor: # The workers do the relaying; pass the signal on to each of them
+        for pid in read_worker_pids():
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+        log_activity(f"DIAG: {signal.Signals(signum).name} passed on to the workers.")
+
+def install_diagnostic_signals():
+    # Forked workers inherit the handlers; diagnostic_signal_handler() checks which role it is running in.
+    for signum in (signal.SIGUSR1, signal.SIGUSR2):
+        signal.signal(signum, diagnostic_signal_handler)
+
+# --- Replay Buffer (resume after reconnect) ---
+# With --workers, worker i only issues seqs equal to i modulo the worker count, so numbers never collide and no
+# lock is taken. Each worker starts above the highest seq it has seen on the worker bus, which keeps the group's
+# numbering close to arrival order (a client can resume on whichever worker it reconnects to); the seqs skipped
+# that way are gaps, not lost messages.
+SEQUENCE_SLOT_STRIDE = 8 # Values per worker in sequence_slots: 64 bytes, so no two workers write to one cache line
+sequence_slots = None # --workers: multiprocessing.RawArray; each worker's last issued seq, where a restarted one resumes
+last_sequence_number = 0 # Highest seq issued here or, with --workers, seen on the bus
+
+def next_sequence_number():
+    global last_sequence_number
+    if sequence_slots is None:
+        last_sequence_number += 1
+        return last_sequence_number
+    seq = last_sequence_number + 1
+    seq += (worker_index - seq) % worker_count
+    last_sequence_number = seq
+    sequence_slots[worker_index * SEQUENCE_SLOT_STRIDE] = seq
+    return seq
+
+def observe_sequence_number(seq):
+    # A message numbered by another worker
+    global last_sequence_number
+    if seq > last_sequence_number:
+        last_sequence_number = seq
+
+class ReplayBuffer:
+    # Recent broadcasts as (seq, encoded JSON) pairs, bounded by count and by bytes; the oldest entries go first.
+    def __init__(self, max_messages, max_bytes):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.entries = deque()
+        self.total_bytes = 0
+        self.last_seq = 0
+        self.gap_seq = 0 # Messages up to this seq may be missing: evicted, or sent before this process started
+
+    def append(self, seq, message_bytes):
+        self.entries.append((seq, message_bytes))
+        self.total_bytes += len(message_bytes)
+        if seq > self.last_seq:
+            self.last_seq = seq
+        while len(self.entries) > self.max_messages or self.total_bytes > self.max_bytes:
+            evicted_seq, evicted_bytes = self.entries.popleft()
+            self.total_bytes -= len(evicted_bytes)
+            if evicted_seq > self.gap_seq:
+                self.gap_seq = evicted_seq
+
+    def truncated_after(self, seq):
+        # Seqs are not contiguous with --workers, so compare against what was dropped rather than the oldest entry
+        return self.gap_seq > seq
+
+    def since(self, seq):
+        # Worker-bus messages can arrive slightly out of order, so filter instead of bisecting.
+        return [entry for entry in self.entries if entry[0] > seq]
+
+    def last(self, count):
+        if count <= 0:
+            return []
+        return list(islice(reversed(self.entries), count))[::-1]
+
+replay_buffer = ReplayBuffer(REPLAY_MAX_MESSAGES, REPLAY_MAX_BYTES)
+
+def build_replay_payloads(entries, truncated):
+    # The stored JSON is spliced into the batch as-is; large backlogs are split into several frames.
+    frames = []
+    chunk, chunk_bytes = [], 0
+    for _, message_bytes in entries:
+        if chunk and chunk_bytes + len(message_bytes) > REPLAY_FRAME_MAX_BYTES:
+            frames.append(chunk)
+            chunk, chunk_bytes = [], 0
+        chunk.append(message_bytes)
+        chunk_bytes += len(message_bytes) + 1
+    if chunk or not frames:
+        frames.append(chunk)
+    header = b'{"type":"system","event":"replay","truncated":' + (b'true' if truncated else b'false')
+    return [
+        header + b',"final":' + (b'true' if index == len(frames) - 1 else b'false') + b',"messages":[' + b','.join(chunk) + b']}'
+        for index, chunk in enumerate(frames)
+    ]
+
+def subscriptions_match(subscriptions, message_data_dict):
+    # Direct check of one message against a client's filters (the router does the same through its index).
+    data = message_data_dict.get("data") or ""
+    for msg_type, ip, port, prefix in subscriptions:
+        if ((msg_type is None or msg_type == message_data_dict.get("type"))
+                and (ip is None or ip == message_data_dict.get("ip"))
+                and (port is None or port == message_data_dict.get("port"))
+                and data.startswith(prefix)):
+            return True
+    return False
+
+# --- Message Journal (append-only segments, sparse mmap index, time-range queries) ---
+# Each writer (the server, or each worker) owns one directory of segments named after their creation time in
+# microseconds: <name>.seg holds the records, <name>.idx the sparse index. Records are written in arrival order.
+JOURNAL_RECORD_HEADER = struct.Struct('!IIQdB') # payload length, CRC32 of the payload, seq, time.time(), len(ip); then ip and payload (the broadcast JSON)
+JOURNAL_INDEX_ENTRY = struct.Struct('!dQQ') # highest timestamp up to this record, seq, offset of the record in the segment
+
+journal_stats = {"records": 0, "bytes": 0, "segments": 0, "segments_deleted": 0, "write_errors": 0, "queue_drops": 0}
+journal_writer = None
+
+class JournalWriter(threading.Thread):
+    # Segment writes, flushes, rolls and retention all run on this thread, so a slow or stalled disk never holds up
+    # the event loop: the loop only appends (time, seq, ip, payload) to a deque (atomic, no lock), drained every
+    # JOURNAL_WRITE_INTERVAL. The queue is bounded by JOURNAL_QUEUE_MAX_RECORDS and _BYTES; beyond that records are
+    # dropped and counted ("queue_drops") rather than piling up in memory behind a stuck disk.
+    def __init__(self, directory):
+        super().__init__(name="journal-writer", daemon=True)
+        self.directory = directory
+        self.queue = deque()
+        self.queued_bytes_in = 0 # Only the loop thread adds to this...
+        self.queued_bytes_out = 0 # ...and only the writer thread to this, so neither needs a lock
+        self.dropped = 0 # Records dropped since the queue last had room (loop thread)
+        self.flush_requests = deque() # concurrent.futures.Future per history query, answered once what was queued before it is flushed
+        self.wake = threading.Event()
+        self.stop_requested = False
+        self.base = None # Current segment path without extension
+        self.file = None
+        self.index_file = None
+        self.size = 0
+        self.last_indexed = 0
+        self.max_timestamp = 0.0
+        self.failed = False
+
+    def append(self, seq, ip, message_bytes):
+        # Event loop thread
+        if self.failed:
+            return
+        queued_records = len(self.queue)
+        queued_bytes = self.queued_bytes_in - self.queued_bytes_out
+        # Once full, keep dropping until the writer has drained half the queue so the log doesn't flap.
+        if self.dropped:
+            full = queued_records >= JOURNAL_QUEUE_MAX_RECORDS // 2 or queued_bytes >= JOURNAL_QUEUE_MAX_BYTES // 2
+        else:
+            full = queued_records >= JOURNAL_QUEUE_MAX_RECORDS or queued_bytes >= JOURNAL_QUEUE_MAX_BYTES
+        if full:
+            journal_stats["queue_drops"] += 1
+            self.dropped += 1
+            if self.dropped == 1:
+                log_activity("JOURNAL: Writer is behind (queue full); dropping records until it catches up.")
+            return
+        if self.dropped:
+            log_activity(f"JOURNAL: Writer caught up; {self.dropped} record(s) were not journaled.")
+            self.dropped = 0
+        self.queue.append((time.time(), seq, ip, message_bytes))
+        self.queued_bytes_in += len(message_bytes)
+
+    def request_flush(self):
+        # Event loop thread: a future that completes once every record appended so far is flushed to the segment
+        future = concurrent.futures.Future()
+        if self.is_alive():
+            self.flush_requests.append(future)
+            self.wake.set()
+        else:
+            future.set_result(None)
+        return future
+
+    def stop(self):
+        self.stop_requested = True
+        self.wake.set()
+        self.join(JOURNAL_CLOSE_TIMEOUT)
+        if self.is_alive():
+            log_activity(f"JOURNAL: Writer still busy after {JOURNAL_CLOSE_TIMEOUT}s; {len(self.queue)} queued record(s) may be lost.")
+
+    def run(self):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self.roll()
+            log_activity(f"JOURNAL: Writing to {self.base}.seg")
+        except OSError as e:
+            self.failed = True
+            journal_stats["write_errors"] += 1
+            log_activity(f"JOURNAL: Could not open {self.directory} ({e}); running without a journal.")
+        next_flush = time.monotonic() + JOURNAL_FLUSH_INTERVAL
+        next_retention_check = time.monotonic() + JOURNAL_RETENTION_CHECK_INTERVAL
+        while True:
+            stopping = self.stop_requested
+            self.wake.wait(JOURNAL_WRITE_INTERVAL)
+            self.wake.clear()
+            requests = []
+            try:
+                while True:
+                    requests.append(self.flush_requests.popleft()) # Taken before the drain, so it covers their records
+            except IndexError:
+                pass
+            self.write_queued()
+            now = time.monotonic()
+            if requests or stopping or now >= next_flush:
+                next_flush = now + JOURNAL_FLUSH_INTERVAL
+                self.flush()
+                for future in requests:
+                    future.set_result(None)
+            if now >= next_retention_check and not self.failed:
+                next_retention_check = now + JOURNAL_RETENTION_CHECK_INTERVAL
+                self.enforce_retention()
+            if stopping:
+                break
+        self.close()
+
+    def write_queued(self):
+        drained = 0
+        try:
+            while True:
+                timestamp, seq, ip, message_bytes = self.queue.popleft()
+                drained += len(message_bytes)
+                if not self.failed:
+                    self.write_record(timestamp, seq, ip, message_bytes)
+        except IndexError:
+            pass
+        self.queued_bytes_out += drained
+
+    def roll(self):
+        # A new segment is started on open too, so a segment torn by a crash is never appended to.
+        self.close()
+        self.base = os.path.join(self.directory, f"{time.time_ns() // 1000:020d}")
+        self.file = open(self.base + ".seg", "ab", buffering=JOURNAL_WRITE_BUFFER_BYTES)
+        self.index_file = open(self.base + ".idx", "ab")
+        self.size = self.last_indexed = 0
+        self.max_timestamp = 0.0
+        journal_stats["segments"] += 1
+        self.enforce_retention()
+
+    def write_record(self, timestamp, seq, ip, message_bytes):
+        ip_bytes = str(ip or "").encode('ascii', 'replace')[:255]
+        try:
+            if self.size >= JOURNAL_SEGMENT_BYTES:
+                self.roll()
+            if timestamp > self.max_timestamp:
+                self.max_timestamp = timestamp
+            if self.size == 0 or self.size - self.last_indexed >= JOURNAL_INDEX_INTERVAL_BYTES:
+                self.index_file.write(JOURNAL_INDEX_ENTRY.pack(self.max_timestamp, seq, self.size))
+                self.last_indexed = self.size
+            header = JOURNAL_RECORD_HEADER.pack(len(message_bytes), zlib.crc32(message_bytes), seq, timestamp, len(ip_bytes))
+            self.file.write(header)
+            self.file.write(ip_bytes)
+            self.file.write(message_bytes)
+        except OSError as e:
+            # The relay keeps running without its journal rather than failing every broadcast
+            self.failed = True
+            journal_stats["write_errors"] += 1
+            log_activity(f"JOURNAL: Write to {self.base}.seg failed ({e}); journaling stopped.")
+            return
+        self.size += len(header) + len(ip_bytes) + len(message_bytes)
+        journal_stats["records"] += 1
+        journal_stats["bytes"] += len(message_bytes)
+
+    def flush(self):
+        if self.file is None or self.failed:
+            return
+        try:
+            self.file.flush()
+            self.index_file.flush()
+        except OSError as e:
+            self.failed = True
+            journal_stats["write_errors"] += 1
+            log_activity(f"JOURNAL: Flush of {self.base}.seg failed ({e}); journaling stopped.")
+
+    def close(self):
+        for f in (self.file, self.index_file):
+            if f is not None:
+                try:
+                    f.close()
+                except OSError as e:
+                    log_activity(f"JOURNAL: Closing {self.base} failed: {e}")
+        self.file = self.index_file = None
+
+    def enforce_retention(self):
+        segments = journal_segments(self.directory)
+        sizes = {}
+        for base in segments:
+            try:
+                sizes[base] = os.path.getsize(base + ".seg") + os.path.getsize(base + ".idx")
+            except OSError:
+                sizes[base] = 0
+        total = sum(sizes.values())
+        cutoff_us = (time.time() - JOURNAL_RETENTION_SECONDS) * 1e6 if JOURNAL_RETENTION_SECONDS else None
+        for base, following in zip(segments, segments[1:]): # The current (last) segment is never deleted
+            # Everything in a segment was written before the following one was created
+            too_old = cutoff_us is not None and int(os.path.basename(following)) < cutoff_us
+            too_big = JOURNAL_RETENTION_BYTES and total > JOURNAL_RETENTION_BYTES
+            if not (too_old or too_big):
+                break
+            for extension in (".seg", ".idx"):
+                try:
+                    os.remove(base + extension)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    log_activity(f"JOURNAL: Could not delete {base}{extension}: {e}")
+            total -= sizes[base]
+            journal_stats["segments_deleted"] += 1
+            log_activity(f"JOURNAL: Deleted segment {os.path.basename(base)} ({'age' if too_old else 'size'} retention).")
+
+def open_journal():
+    global journal_writer
+    if not JOURNAL_ENABLED:
+        return
+    directory = JOURNAL_DIR if worker_index is None else os.path.join(JOURNAL_DIR, f"worker-{worker_index}")
+    journal_writer = JournalWriter(directory) # Opens its segment on its own thread
+    journal_writer.start()
+
+def close_journal():
+    global journal_writer
+    if journal_writer is not None:
+        journal_writer.stop() # Writes and flushes what is still queued
+        journal_writer = None
+
+def journal_directories():
+    # Every writer's directory, so a query sees what all workers (and earlier --workers runs) ingested
+    directories = [JOURNAL_DIR]
+    try:
+        directories += [os.path.join(JOURNAL_DIR, name) for name in sorted(os.listdir(JOURNAL_DIR)) if name.startswith("worker-")]
+    except OSError:
+        pass
+    return directories
+
+def journal_segments(directory):
+    try:
+        names = sorted(name[:-4] for name in os.listdir(directory) if name.endswith(".seg") and name[:-4].isdigit())
+    except OSError:
+        return []
+    return [os.path.join(directory, name) for name in names]
+
+def journal_scan_offset(base, start):
+    # Bisects the memory-mapped sparse index for the last entry whose running maximum timestamp is below
+    # start: no record before it can be in range, so the scan of the segment starts there.
+    entry_size = JOURNAL_INDEX_ENTRY.size
+    try:
+        with open(base + ".idx", "rb") as f:
+            count = os.fstat(f.fileno()).st_size // entry_size
+            if count == 0:
+                return 0
+            with mmap.mmap(f.fileno(), count * entry_size, access=mmap.ACCESS_READ) as index:
+                low, high = 0, count
+                while low < high:
+                    middle = (low + high) // 2
+                    if JOURNAL_INDEX_ENTRY.unpack_from(index, middle * entry_size)[0] < start:
+                        low = middle + 1
+                    else:
+                        high = middle
+                return JOURNAL_INDEX_ENTRY.unpack_from(index, (low - 1) * entry_size)[2] if low else 0
+    except (OSError, ValueError):
+        return 0
+
+def read_journal_segment(base, start, end, ip):
+    # Yields (timestamp, seq, payload) through a buffered reader; records outside the range are skipped with seek().
+    ip_bytes = ip.encode('ascii', 'replace') if ip is not None else None
+    header_size = JOURNAL_RECORD_HEADER.size
+    try:
+        f = open(base + ".seg", "rb")
+    except OSError: # Deleted by retention meanwhile
+        return
+    with f:
+        if start is not None:
+            f.seek(journal_scan_offset(base, start))
+        while True:
+            header = f.read(header_size)
+            if len(header) < header_size:
+                return
+            length, crc, seq, timestamp, ip_length = JOURNAL_RECORD_HEADER.unpack(header)
+            if end is not None and timestamp > end:
+                return
+            record_ip = f.read(ip_length)
+            if (start is not None and timestamp < start) or (ip_bytes is not None and record_ip != ip_bytes):
+                f.seek(length, os.SEEK_CUR)
+                continue
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return # Torn tail of a segment whose writer crashed
+            yield timestamp, seq, payload
+
+def read_journal_directory(directory, start, end, ip):
+    segments = journal_segments(directory)
+    for index, base in enumerate(segments):
+        if end is not None and int(os.path.basename(base)) > end * 1e6:
+            return # Created after the range ended
+        if start is not None and index + 1 < len(segments) and int(os.path.basename(segments[index + 1])) < start * 1e6:
+            continue # Finished before the range began
+        yield from read_journal_segment(base, start, end, ip)
+
+def journal_query_chunks(start, end, ip, msg_type, limit):
+    # Lists of payloads in time order, merged over every writer's directory; runs in an executor thread.
+    records = heapq.merge(*(read_journal_directory(directory, start, end, ip) for directory in journal_directories()),
+                          key=lambda record: record[0])
+    chunk, chunk_bytes, count = [], 0, 0
+    for _, _, payload in records:
+        if count >= limit:
+            break
+        if msg_type is not None and json.loads(payload).get("type") != msg_type:
+            continue
+        chunk.append(payload)
+        chunk_bytes += len(payload)
+        count += 1
+        if len(chunk) >= JOURNAL_QUERY_CHUNK_MESSAGES or chunk_bytes >= JOURNAL_QUERY_CHUNK_BYTES:
+            yield chunk
+            chunk, chunk_bytes = [], 0
+    if chunk:
+        yield chunk
+
+def parse_journal_time(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+async def stream_history(client, query_id, chunks):
+    # Waits for the journal writer to flush what was broadcast so far, then reads one chunk ahead in an executor (disk
+    # I/O stays off the loop) and waits for the client's send queue to drain to half before queueing more, so a large
+    # answer is neither buffered whole nor shed by the overflow policy.
+    loop = asyncio.get_running_loop()
+    header = b'{"type":"system","event":"history","id":' + json.dumps(query_id).encode('utf-8')
+    count = 0
+    try:
+        if journal_writer is not None:
+            await asyncio.wrap_future(journal_writer.request_flush())
+        elif not await loop.run_in_executor(None, os.path.isdir, JOURNAL_DIR):
+            client.send_system_event("error", message="the message journal is disabled", action="history")
+            return
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        while True:
+            following = await loop.run_in_executor(None, next, chunks, None) if chunk is not None else None
+            while len(client.outbound) > WS_SEND_QUEUE_MAX_FRAMES // 2 or client.outbound_bytes > WS_SEND_QUEUE_MAX_BYTES // 2:
+                if client.evicted or client not in connected_ws_clients:
+                    return
+                await asyncio.sleep(0.01)
+            messages = chunk or []
+            count += len(messages)
+            final = following is None
+            client.enqueue_frame(client.build_frame(
+                header + b',"final":' + (b'true' if final else b'false') + b',"count":' + str(count).encode('ascii')
+                + b',"messages":[' + b','.join(messages) + b']}', TEXT))
+            if final:
+                log_activity(f"WS: History query for {client.address} done: {count} message(s).")
+                return
+            chunk = following
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        log_activity(f"WS: History query for {client.address} failed: {e}")
+        client.send_system_event("error", message=f"history query failed: {e}", action="history")
+    finally:
+        if client.history_task is asyncio.current_task():
+            client.history_task = None
+
+# --- Subscriptions (routing index) ---
+class SubscriptionRouter:
+    # Clients that never subscribed get everything (what js/ws.js expects). A subscription is a filter on any of
+    # type / ip / port / data prefix; all of its fields must match. Filters are indexed by their (type, ip, port)
+    # key with None as wildcard, then by prefix, so routing a message does one dict lookup per filter shape in use
+    # and per distinct prefix length instead of visiting every client. Unfiltered clients that batch are kept apart
+    # (batched_clients): the BroadcastCoalescer sends them the window's shared frame without visiting them per message.
+    FIELDS = ("type", "ip", "port")
+
+    def __init__(self):
+        self.unfiltered_clients = set()
+        self.batched_clients = set()
+        self.buckets = {} # (type, ip, port) -> {prefix: set(clients)}
+        self.prefix_lengths = {} # (type, ip, port) -> {prefix length: number of prefixes with that length}
+        self.shape_counts = {} # (has_type, has_ip, has_port) -> number of buckets with that shape
+
+    def has_filters(self):
+        return bool(self.buckets)
+
+    def add_client(self, client):
+        if client.coalesce:
+            self.batched_clients.add(client)
+            coalescer.joined(client)
+        else:
+            self.unfiltered_clients.add(client)
+
+    def discard_unfiltered(self, client):
+        if client in self.batched_clients:
+            self.batched_clients.discard(client)
+            coalescer.left(client)
+        else:
+            self.unfiltered_clients.discard(client)
+
+    def remove_client(self, client):
+        self.discard_unfiltered(client)
+        for subscription in list(client.subscriptions):
+            self.unsubscribe(client, subscription)
+
+    def subscribe(self, client, subscription):
+        # subscription is a (type, ip, port, prefix) tuple; unused fields are None / ""
+        if subscription in client.subscriptions:
+            return
+        key, prefix = subscription[:3], subscription[3]
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = {}
+            self.prefix_lengths[key] = {}
+            shape = self.key_shape(key)
+            self.shape_counts[shape] = self.shape_counts.get(shape, 0) + 1
+        clients = bucket.get(prefix)
+        if clients is None:
+            clients = bucket[prefix] = set()
+            lengths = self.prefix_lengths[key]
+            lengths[len(prefix)] = lengths.get(len(prefix), 0) + 1
+        clients.add(client)
+        if client.subscriptions is NO_SUBSCRIPTIONS:
+            client.subscriptions = set()
+        client.subscriptions.add(subscription)
+        self.discard_unfiltered(client)
+
+    def unsubscribe(self, client, subscription):
+        if subscription not in client.subscriptions:
+            return
+        client.subscriptions.discard(subscription)
+        key, prefix = subscription[:3], subscription[3]
+        bucket = self.buckets[key]
+        clients = bucket[prefix]
+        clients.discard(client)
+        if not clients:
+            del bucket[prefix]
+            lengths = self.prefix_lengths[key]
+            lengths[len(prefix)] -= 1
+            if not lengths[len(prefix)]:
+                del lengths[len(prefix)]
+        if not bucket:
+            del self.buckets[key]
+            del self.prefix_lengths[key]
+            shape = self.key_shape(key)
+            self.shape_counts[shape] -= 1
+            if not self.shape_counts[shape]:
+                del self.shape_counts[shape]
+
+    def unsubscribe_all(self, client):
+        for subscription in list(client.subscriptions):
+            self.unsubscribe(client, subscription)
+        client.subscriptions = NO_SUBSCRIPTIONS
+        self.add_client(client)
+
+    @staticmethod
+    def key_shape(key):
+        return tuple(field is not None for field in key)
+
+    def match(self, msg_type, ip, port, data):
+        # Returns (every unfiltered client that does not batch, the filtered clients whose filters match). The first is
+        # the live set, not a copy; a client is never in both, and only the (usually few) matching filtered clients are collected.
+        matched = None
+        values = (msg_type, ip, port)
+        for shape in self.shape_counts:
+            key = tuple(value if used else None for value, used in zip(values, shape))
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                continue
+            for length in self.prefix_lengths[key]:
+                clients = bucket.get(data[:length])
+                if clients:
+                    if matched is None:
+                        matched = set(clients)
+                    else:
+                        matched |= clients
+        return self.unfiltered_clients, matched or ()
+
+def parse_subscription(request):
+    # Builds the (type, ip, port, prefix) tuple of a subscribe/unsubscribe request, raising ValueError if invalid.
+    msg_type = request.get("type")
+    ip = request.get("ip")
+    port = request.get("port")
+    prefix = request.get("prefix") or ""
+    if msg_type is not None and not isinstance(msg_type, str):
+        raise ValueError("'type' must be a string")
+    if ip is not None and not isinstance(ip, str):
+        raise ValueError("'ip' must be a string")
+    if port is not None:
+        if isinstance(port, bool) or not isinstance(port, (int, str)) or not str(port).isdigit():
+            raise ValueError("'port' must be a number")
+        port = int(port)
+    if not isinstance(prefix, str):
+        raise ValueError("'prefix' must be a string")
+    return (msg_type.lower() if msg_type else None, ip or None, port, prefix)
+
+def describe_subscription(subscription):
+    return {field: value for field, value in zip(("type", "ip", "port", "prefix"), subscription) if value not in (None, "")}
+
+subscription_router = SubscriptionRouter()
+
+def broadcast_message_to_clients(message_data_dict, received_at=None, from_peer=False):
+    # received_at: time.monotonic() when the message came off its socket (comparable across worker processes)
+    # from_peer: relayed by another node, which passes it on to the rest of the cluster itself
+    if handoff_channel is not None: # Reloaded: the new process numbers and delivers what we still ingest
+        forward_to_successor(message_data_dict, received_at)
+        return None
+    spans = spans_enabled # Read once: the control thread may flip it mid-message
+    if spans:
+        started = time.perf_counter()
+        if received_at is not None:
+            stage_spans["ingest"].observe(time.monotonic() - received_at)
+    seq = message_data_dict["seq"] = next_sequence_number()
+    message_bytes = encode_message_payload(message_data_dict)
+    if spans:
+        encoded = time.perf_counter()
+        stage_spans["encode"].observe(encoded - started)
+    if journal_writer is not None:
+        journal_writer.append(seq, message_data_dict.get("ip"), message_bytes)
+    if bus_socket is not None:
+        publish_to_worker_bus(seq, message_bytes, received_at)
+    if peer_links and not from_peer:
+        publish_to_peers(seq, message_bytes)
+    deliver_to_local_clients(seq, message_bytes, message_data_dict, received_at)
+    if spans:
+        stage_spans["broadcast"].observe(time.perf_counter() - encoded)
+    return seq
+
+def deliver_to_local_clients(seq, message_bytes, message_data_dict=None, received_at=None):
+    replay_buffer.append(seq, message_bytes)
+    relay_stats["broadcasts"] += 1
+    if window_aggregator.active:
+        if message_data_dict is None: # From the worker bus
+            message_data_dict = json.loads(message_bytes)
+        window_aggregator.count(message_data_dict.get("type"), message_data_dict.get("ip"))
+    recipients = subscription_router.unfiltered_clients # Every client when nobody filters (aggregating clients are in neither)
+    batched = subscription_router.batched_clients # Served by the coalescer from its window, not visited here
+    recipient_count = len(recipients) + len(batched)
+    if subscription_router.has_filters():
+        if message_data_dict is None: # From the worker bus: only parsed when someone filters
+            message_data_dict = json.loads(message_bytes)
+        unfiltered, matched = subscription_router.match(
+            message_data_dict.get("type"), message_data_dict.get("ip"), message_data_dict.get("port"),
+            message_data_dict.get("data") or ""
+        )
+        recipient_count = len(unfiltered) + len(batched) + len(matched)
+        recipients = chain(unfiltered, matched) if matched else unfiltered
+
+    if not recipient_count:
+        if should_log_message():
+            log_activity(f"WS_Broadcast: No WebSocket clients to send to. Message: {message_bytes[:100].decode('utf-8', 'ignore')}", LOG_DEBUG)
+        return
+
+    if should_log_message():
+        log_activity(f"WS_Broadcast: Broadcasting to {recipient_count} client(s): {message_bytes[:100].decode('utf-8', 'ignore')}...", LOG_DEBUG)
+    frames = {} # Encoded once per (encoding, deflate), shared by every client's queue
+    entry = None
+    if batched:
+        entry = (seq, message_bytes, message_data_dict)
+        coalescer.add_shared(entry)
+    # Runs on the event loop thread: enqueue_frame only queues the frame, so the recipients cannot change under us.
+    for client in recipients:
+        try:
+            if client.coalesce:
+                if entry is None:
+                    entry = (seq, message_bytes, message_data_dict)
+                coalescer.add(client, entry)
+                continue
+            frame = frames.get(client.payload_encoding)
+            if frame is None:
+                if message_data_dict is None and client.payload_encoding[0] == "binary":
+                    message_data_dict = json.loads(message_bytes)
+                frame = frames[client.payload_encoding] = build_broadcast_frame(client.payload_encoding, message_bytes, message_data_dict, seq)
+            client.enqueue_frame(frame)
+        except Exception as e:
+            relay_stats["send_errors"] += 1
+            log_activity(f"WS_Broadcast: Error sending to WS client {getattr(client, 'address', 'Unknown')}: {e}")
+    if entry is not None:
+        coalescer.message_added(received_at) # Latency is observed when the batch goes out
+    elif received_at is not None:
+        delivery_latency.observe(time.monotonic() - received_at)
+
+class BroadcastCoalescer:
+    # Collects broadcasts for WS_BATCH_WINDOW_MS (or until WS_BATCH_MAX_MESSAGES are waiting), then sends every
+    # client one frame with its messages. Unfiltered clients (subscription_router.batched_clients) all get the
+    # window's shared list, encoded once per (encoding, deflate) and enqueued as-is; only clients whose filters
+    # pick their own messages, or that became unfiltered mid-window, get a frame of their own.
+    def __init__(self, window, max_messages):
+        self.window = window
+        self.max_messages = max_messages
+        self.shared = [] # Every message of the window, for batched_clients
+        self.joined_at = {} # Batched clients that joined mid-window -> index into shared of their first message
+        self.clients = set() # Clients with a non-empty pending_batch
+        self.received_at = [] # Ingress times of the waiting messages, for the latency histogram
+        self.count = 0
+        self.timer = None
+        self.loop = None
+
+    def add(self, client, entry):
+        client.pending_batch.append(entry)
+        self.clients.add(client)
+        if self.loop is None:
+            self.loop = client.server.loop
+
+    def add_shared(self, entry):
+        self.shared.append(entry)
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+
+    def joined(self, client):
+        if self.shared:
+            self.joined_at[client] = len(self.shared)
+
+    def left(self, client):
+        # Subscribed (or went away) mid-window: what it was owed from the shared list becomes its own
+        start = self.joined_at.pop(client, 0)
+        if start < len(self.shared):
+            client.pending_batch[:0] = self.shared[start:]
+            self.clients.add(client)
+
+    def has_pending(self, client):
+        return bool(client.pending_batch) or (bool(self.shared) and client in subscription_router.batched_clients)
+
+    def message_added(self, received_at):
+        self.count += 1
+        if received_at is not None:
+            self.received_at.append(received_at)
+        if self.count >= self.max_messages:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.loop.call_later(self.window, self.flush)
+
+    def discard(self, client):
+        self.clients.discard(client)
+        self.joined_at.pop(client, None)
+        client.pending_batch = []
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        clients, self.clients = self.clients, set()
+        shared, self.shared = self.shared, []
+        joined_at, self.joined_at = self.joined_at, {}
+        received_at, self.received_at = self.received_at, []
+        self.count = 0
+        shared_frames = {} # (encoding, deflate) -> this window's frame for the batched clients
+        single_frames = {} # (encoding, deflate, seq) -> frame of a one-message batch
+        binary_cache = {}
+        if shared:
+            for client in subscription_router.batched_clients:
+                start = joined_at.get(client, 0)
+                if start or client in clients:
+                    client.pending_batch.extend(shared[start:])
+                    clients.add(client)
+                    continue
+                try:
+                    frame = shared_frames.get(client.payload_encoding)
+                    if frame is None:
+                        frame = shared_frames[client.payload_encoding] = self.build_frame(client.payload_encoding, shared, binary_cache, single_frames)
+                    client.enqueue_frame(frame)
+                except Exception as e:
+                    relay_stats["send_errors"] += 1
+                    log_activity(f"WS_Broadcast: Error sending batch to WS client {getattr(client, 'address', 'Unknown')}: {e}")
+        for client in clients:
+            entries, client.pending_batch = client.pending_batch, []
+            if not entries:
+                continue
+            try:
+                client.enqueue_frame(self.build_frame(client.payload_encoding, entries, binary_cache, single_frames))
+            except Exception as e:
+                relay_stats["send_errors"] += 1
+                log_activity(f"WS_Broadcast: Error sending batch to WS client {getattr(client, 'address', 'Unknown')}: {e}")
+        now = time.monotonic()
+        for ingress_time in received_at:
+            delivery_latency.observe(now - ingress_time)
+
+    @staticmethod
+    def build_frame(payload_encoding, entries, binary_cache, single_frames):
+        if len(entries) > 1:
+            relay_stats["batches"] += 1
+            return build_batch_frame(payload_encoding, entries, binary_cache)
+        # A quiet window: the plain message frame, as without coalescing
+        seq, message_bytes, message_data_dict = entries[0]
+        key = (payload_encoding, seq)
+        frame = single_frames.get(key)
+        if frame is None:
+            if message_data_dict is None and payload_encoding[0] == "binary":
+                message_data_dict = json.loads(message_bytes)
+            frame = single_frames[key] = build_broadcast_frame(payload_encoding, message_bytes, message_data_dict, seq)
+        return frame
+
+coalescer = BroadcastCoalescer(WS_BATCH_WINDOW_MS / 1000.0, WS_BATCH_MAX_MESSAGES)
+
+# --- Windowed Aggregation (per-source message counts for dashboards) ---
+class WindowAggregator:
+    # Counts messages per (type, ip) into the current bucket: one dict update per message. Every
+    # AGGREGATE_INTERVAL the bucket is closed and a summary goes to the subscribers of each window kind:
+    #   tumbling: the bucket that just closed;
+    #   sliding:  the last AGGREGATE_SLIDING_BUCKETS buckets, kept as running totals (the closed bucket is added,
+    #             the one leaving the window subtracted), so a tick costs O(sources in those two buckets).
+    # A bucket holds at most AGGREGATE_MAX_SOURCES keys, so memory is bounded by that times the sliding length.
+    # Counting only happens while someone is subscribed.
+    def __init__(self, interval, sliding_buckets, max_sources):
+        self.interval = interval
+        self.max_sources = max_sources
+        self.subscribers = {window: set() for window in AGGREGATE_WINDOWS}
+        self.active = False
+        self.current = {} # (type, ip) -> messages in the open bucket
+        self.buckets = deque(maxlen=sliding_buckets) # (counts, start time) of the closed buckets inside the sliding window
+        self.sliding_totals = {} # (type, ip) -> messages over self.buckets
+        self.bucket_started = 0.0
+        self.timer = None
+        self.loop = None
+        self.next_tick = 0.0
+
+    def subscribe(self, client):
+        self.subscribers[client.aggregate_window].add(client)
+        if not self.active:
+            self.active = True
+            self.loop = client.server.loop
+            self.bucket_started = time.time()
+            self.next_tick = self.loop.time() + self.interval
+            self.timer = self.loop.call_at(self.next_tick, self.tick)
+
+    def unsubscribe(self, client):
+        self.subscribers[client.aggregate_window].discard(client)
+        if self.active and not any(self.subscribers.values()):
+            self.active = False
+            self.timer.cancel()
+            self.timer = None
+            self.current = {}
+            self.buckets.clear()
+            self.sliding_totals = {}
+
+    def count(self, msg_type, ip):
+        key = (msg_type, ip)
+        current = self.current
+        if key not in current and len(current) >= self.max_sources:
+            key = (msg_type, "other")
+        current[key] = current.get(key, 0) + 1
+
+    def tick(self):
+        # Scheduled on a fixed grid (call_at), so buckets do not drift by the time the tick itself takes.
+        self.next_tick += self.interval
+        self.timer = self.loop.call_at(self.next_tick, self.tick)
+        now = time.time()
+        bucket, self.current = self.current, {}
+        started, self.bucket_started = self.bucket_started, now
+        if self.subscribers["tumbling"]:
+            self.publish("tumbling", bucket, started, now, 1)
+        if len(self.buckets) == self.buckets.maxlen:
+            totals = self.sliding_totals
+            for key, messages in self.buckets[0][0].items():
+                remaining = totals[key] - messages
+                if remaining:
+                    totals[key] = remaining
+                else:
+                    del totals[key]
+        self.buckets.append((bucket, started))
+        for key, messages in bucket.items():
+            self.sliding_totals[key] = self.sliding_totals.get(key, 0) + messages
+        if self.subscribers["sliding"]:
+            self.publish("sliding", self.sliding_totals, self.buckets[0][1], now, len(self.buckets))
+
+    def publish(self, window, counts, started, ended, buckets):
+        protocols = {}
+        for (msg_type, ip), messages in counts.items():
+            protocols[msg_type] = protocols.get(msg_type, 0) + messages
+        # Sources as [type, ip, messages]; a rate is messages / seconds.
+        payload = json_dumps({
+            "type": "aggregate", "window": window, "start": round(started, 3), "end": round(ended, 3),
+            "seconds": round(ended - started, 3), "buckets": buckets, "protocols": protocols,
+            "sources": [[msg_type, ip, messages] for (msg_type, ip), messages in counts.items()],
+        })
+        frames = {} # By permessage-deflate
+        for client in self.subscribers[window]:
+            deflate = client.payload_encoding[1]
+            frame = frames.get(deflate)
+            if frame is None:
+                frame = frames[deflate] = build_broadcast_frame(("json", deflate), payload, None)
+            client.enqueue_frame(frame)
+        relay_stats["aggregate_summaries"] += len(self.subscribers[window])
+
+window_aggregator = WindowAggregator(AGGREGATE_INTERVAL, AGGREGATE_SLIDING_BUCKETS, AGGREGATE_MAX_SOURCES)
+
+def build_message_payload(msg_type, addr, message_text):
+    return {
+        "type": msg_type, "ip": addr[0], "port": addr[1],
+        "timestamp": utc_timestamps.now(),
+        "data": message_text
+    }
+
+# --- Ingest Admission (per-source token buckets, global ceiling, load shedding) ---
+shed_stats = {
+    "messages": 0, "bytes": 0, # Over a limit and dropped
+    "sampled": 0, # Over a limit but let through by the "sample" policy
+    "disconnects": 0 # TCP connections closed by the "disconnect" policy
+}
+
+class TokenBuckets:
+    # A message bucket and a byte bucket refilled together; take() draws from both or from neither.
+    __slots__ = ("message_rate", "byte_rate", "message_capacity", "byte_capacity", "messages", "bytes", "updated", "shed")
+
+    def __init__(self, message_rate, byte_rate, now):
+        self.message_rate = message_rate
+        self.byte_rate = byte_rate
+        self.message_capacity = max(1.0, message_rate * INGEST_BURST_SECONDS)
+        self.byte_capacity = byte_rate * INGEST_BURST_SECONDS
+        self.messages = self.message_capacity
+        self.bytes = self.byte_capacity
+        self.updated = now
+        self.shed = 0 # Since the last shed report
+
+    def take(self, nbytes, now):
+        elapsed = now - self.updated
+        self.updated = now
+        if self.message_rate:
+            self.messages = min(self.message_capacity, self.messages + elapsed * self.message_rate)
+            if self.messages < 1:
+                return False
+        if self.byte_rate:
+            self.bytes = min(self.byte_capacity, self.bytes + elapsed * self.byte_rate)
+            if self.bytes < min(nbytes, self.byte_capacity): # A message larger than the bucket passes only when it is full
+                return False
+            self.bytes -= nbytes
+        self.messages -= 1
+        return True
+
+    def idle(self, now):
+        return now - self.updated >= INGEST_BURST_SECONDS # Refilled to the top by now
+
+class IngestAdmission:
+    # Decides, before a message is decoded, logged or broadcast, whether it is admitted. Shed messages are only
+    # counted; log_stats_periodically reports them, with the worst sources, once per STATS_LOG_INTERVAL.
+    def __init__(self):
+        self.per_source = bool(INGEST_SOURCE_MESSAGES_PER_SECOND or INGEST_SOURCE_BYTES_PER_SECOND)
+        self.sources = {} # source IP -> TokenBuckets
+        self.global_buckets = None
+        if INGEST_GLOBAL_MESSAGES_PER_SECOND or INGEST_GLOBAL_BYTES_PER_SECOND:
+            self.global_buckets = TokenBuckets(INGEST_GLOBAL_MESSAGES_PER_SECOND, INGEST_GLOBAL_BYTES_PER_SECOND, time.monotonic())
+        self.enabled = self.per_source or self.global_buckets is not None
+        self.shedding = False # Something was shed since the last report
+
+    def admit(self, protocol, ip, nbytes):
+        now = time.monotonic()
+        if self.per_source:
+            buckets = self.sources.get(ip)
+            if buckets is None:
+                if len(self.sources) >= INGEST_MAX_TRACKED_SOURCES:
+                    self.forget_idle_sources(now)
+                buckets = self.sources[ip] = TokenBuckets(INGEST_SOURCE_MESSAGES_PER_SECOND, INGEST_SOURCE_BYTES_PER_SECOND, now)
+            if not buckets.take(nbytes, now):
+                return self.shed(protocol, ip, nbytes, buckets)
+        if self.global_buckets is not None and not self.global_buckets.take(nbytes, now):
+            return self.shed(protocol, ip, nbytes, self.global_buckets)
+        return True
+
+    def shed(self, protocol, ip, nbytes, buckets):
+        buckets.shed += 1
+        if INGEST_SHED_POLICY == "sample" and buckets.shed % INGEST_SHED_SAMPLE_EVERY == 0:
+            shed_stats["sampled"] += 1
+            return True
+        shed_stats["messages"] += 1
+        shed_stats["bytes"] += nbytes
+        if not self.shedding:
+            self.shedding = True
+            log_activity(f"INGEST: Shedding load ({protocol} from {ip} over its limit, policy {INGEST_SHED_POLICY}); "
+                         f"counted until the next stats line.")
+        return False
+
+    def forget_idle_sources(self, now):
+        self.sources = {ip: buckets for ip, buckets in self.sources.items() if not buckets.idle(now)}
+        if len(self.sources) >= INGEST_MAX_TRACKED_SOURCES: # All busy (or spoofed UDP sources): start over
+            self.sources = {}
+
+    def take_shed_report(self):
+        if not self.shedding:
+            return None
+        self.shedding = False
+        top = sorted(((buckets.shed, ip) for ip, buckets in self.sources.items() if buckets.shed), reverse=True)[:5]
+        for buckets in self.sources.values():
+            buckets.shed = 0
+        global_shed = 0
+        if self.global_buckets is not None:
+            global_shed, self.global_buckets.shed = self.global_buckets.shed, 0
+        sources = ", ".join(f"{ip} ({count})" for count, ip in top)
+        return (f"Shed so far: {', '.join(f'{name} {value}' for name, value in shed_stats.items())}. "
+                f"Last interval: top sources {sources or '-'}, global ceiling {global_shed}.")
+
+ingest_admission = IngestAdmission()
+
+# --- Producer ACKs ("per-message", "cumulative" or "none", chosen per listener) ---
+ack_stats = {} # protocol -> ACKs sent
+
+def count_ack(protocol):
+    ack_stats[protocol] = ack_stats.get(protocol, 0) + 1
+
+def ack_policy(listener):
+    mode = listener.get("ack", ACK_MODE)
+    if mode not in ACK_MODES:
+        raise ValueError(f"unknown ACK mode: {mode}")
+    every = listener.get("ack_every", ACK_EVERY_MESSAGES)
+    interval = listener.get("ack_interval_ms", ACK_INTERVAL_MS) / 1000.0
+    if mode == "cumulative" and not every and not interval:
+        raise ValueError("cumulative ACKs need ack_every or ack_interval_ms")
+    return mode, every, interval
+
+def describe_ack_policy(policy):
+    mode, every, interval = policy
+    if mode != "cumulative":
+        return mode
+    return f"cumulative every {every or '-'} msgs / {round(interval * 1000) or '-'} ms"
+
+def format_cumulative_ack(protocol, count, last_seq):
+    # last_seq is missing while a reloaded process only forwards to its successor
+    seq_text = f", last seq {last_seq}" if last_seq is not None else ""
+    return f"{protocol} Server ACK: {count} message(s) received{seq_text}.\n".encode('utf-8')
+
+class CumulativeAck:
+    # Messages from one producer not acknowledged yet: they get a single ACK once `every` of them
+    # arrived or `interval` seconds after the first one, whichever comes first.
+    __slots__ = ("loop", "send", "every", "interval", "pending", "last_seq", "timer")
+
+    def __init__(self, loop, send, every, interval):
+        self.loop = loop
+        self.send = send # send(count, last_seq)
+        self.every = every
+        self.interval = interval
+        self.pending = 0
+        self.last_seq = None
+        self.timer = None
+
+    def add(self, seq):
+        self.pending += 1
+        if seq is not None:
+            self.last_seq = seq
+        if self.every and self.pending >= self.every:
+            self.flush()
+        elif self.timer is None and self.interval:
+            self.timer = self.loop.call_later(self.interval, self.flush)
+
+    def flush(self):
+        self.cancel()
+        if self.pending:
+            count, self.pending = self.pending, 0
+            self.send(count, self.last_seq)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+# --- TCP Ingest (asyncio buffered protocol + framing) ---
+class FramingError(Exception):
+    pass
+
+class TcpFrameParser:
+    # Incremental framing over one reusable bytearray: the transport recv_into()s straight into it and
+    # frames are handed out as memoryview slices, so no bytes object is created per received chunk.
+    LENGTH_PREFIX = struct.Struct('!I')
+
+    def __init__(self, framing, max_frame_size):
+        if framing not in TCP_FRAMING_MODES:
+            raise ValueError(f"unknown TCP framing mode: {framing}")
+        self.framing = framing
+        self.max_frame_size = max_frame_size
+        self.read_size = TCP_READ_CHUNK_SIZE if framing == "raw" else TCP_RECV_BUFFER_SIZE
+        self.buffer = bytearray(self.read_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # First unconsumed byte
+        self.end = 0 # End of received data
+        self.scan_from = 0 # Newline mode: where the next b'\n' search resumes
+
+    def get_buffer(self):
+        if len(self.buffer) - self.end < TCP_MIN_READ_SIZE:
+            self._make_room()
+        if self.framing == "raw":
+            return self.view[self.end:self.end + self.read_size]
+        return self.view[self.end:]
+
+    def _make_room(self):
+        pending = self.end - self.start
+        needed = pending + TCP_MIN_READ_SIZE
+        if self.framing == "length-prefixed" and pending >= 4:
+            needed = max(needed, 4 + self.LENGTH_PREFIX.unpack_from(self.buffer, self.start)[0])
+        if needed > len(self.buffer):
+            # Grow into a new buffer; the old one may still be exported to the transport
+            new_buffer = bytearray(max(needed, 2 * len(self.buffer)))
+            new_buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = new_buffer
+            self.view = memoryview(new_buffer)
+        elif self.start:
+            self.view[:pending] = self.view[self.start:self.end] # Only the partial frame moves
+        self.scan_from -= self.start
+        self.start = 0
+        self.end = pending
+
+    def feed(self, nbytes):
+        # Yields every complete frame; the views are only valid until the next iteration.
+        self.end += nbytes
+        if self.framing == "raw":
+            frame_start, self.start = self.start, self.end
+            yield self.view[frame_start:self.end]
+        elif self.framing == "newline":
+            yield from self._newline_frames()
+        else:
+            yield from self._length_prefixed_frames()
+        if self.start == self.end:
+            self.start = self.end = self.scan_from = 0
+
+    def _newline_frames(self):
+        while True:
+            newline = self.buffer.find(b'\n', max(self.start, self.scan_from), self.end)
+            if newline < 0:
+                self.scan_from = self.end
+                if self.end - self.start > self.max_frame_size:
+                    raise FramingError(f"line exceeds max frame size ({self.max_frame_size} bytes)")
+                return
+            frame_start = self.start
+            self.start = self.scan_from = newline + 1
+            if newline > frame_start:
+                yield self.view[frame_start:newline]
+
+    def _length_prefixed_frames(self):
+        while self.end - self.start >= 4:
+            length = self.LENGTH_PREFIX.unpack_from(self.buffer, self.start)[0]
+            if length > self.max_frame_size:
+                raise FramingError(f"frame of {length} bytes exceeds max frame size ({self.max_frame_size} bytes)")
+            frame_end = self.start + 4 + length
+            if frame_end > self.end:
+                return
+            frame_start = self.start + 4
+            self.start = frame_end
+            yield self.view[frame_start:frame_end]
+
+class TcpIngestProtocol(asyncio.BufferedProtocol):
+    # Also serves Unix-domain stream producers (UnixStreamIngestProtocol), hence the per-class names below
+    protocol = "tcp" # "type" of the messages, and the metrics label
+    label = "TCP" # Log and ACK prefix
+    ack_format = b"TCP Server ACK: '%s' received."
+    keepalive = True
+
+    def __init__(self, framing, max_frame_size, ack_policy, idle_timeout):
+        self.parser = TcpFrameParser(framing, max_frame_size)
+        self.ack_mode, self.ack_every, self.ack_interval = ack_policy
+        self.cumulative_ack = None
+        self.transport = None
+        self.addr = None
+        self.idle_timeout = idle_timeout
+        self.last_activity = connection_wheel.now
+        self.wheel_slot = None
+        self.write_paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = self.peer_address(transport)
+        tcp_client_transports.add(transport)
+        if self.ack_mode == "cumulative":
+            self.cumulative_ack = CumulativeAck(asyncio.get_running_loop(), self.send_cumulative_ack, self.ack_every, self.ack_interval)
+        if self.keepalive:
+            configure_keepalive(transport.get_extra_info('socket'))
+        if self.idle_timeout:
+            connection_wheel.schedule(self, self.idle_timeout)
+        log_activity(f"{self.label}: Accepted connection from {self.addr[0]}:{self.addr[1]}")
+
+    def peer_address(self, transport):
+        return transport.get_extra_info('peername')
+
+    def get_buffer(self, sizehint):
+        return self.parser.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.last_activity = connection_wheel.now
+        try:
+            for frame in self.parser.feed(nbytes):
+                if not self.handle_frame(frame):
+                    return
+        except FramingError as e:
+            log_activity(f"{self.label}: Framing error from {self.addr[0]}:{self.addr[1]}: {e}. Closing connection.")
+            self.transport.close()
+        except Exception as e:
+            log_activity(f"{self.label}: Error handling client {self.addr[0]}:{self.addr[1]}: {e}")
+            self.transport.close()
+
+    def handle_frame(self, frame):
+        received_at = time.monotonic()
+        count_ingress(self.protocol, len(frame))
+        addr = self.addr
+        if ingest_admission.enabled and not ingest_admission.admit(self.protocol, addr[0], len(frame)):
+            if INGEST_SHED_POLICY == "disconnect":
+                shed_stats["disconnects"] += 1
+                log_activity(f"{self.label}: Closing {addr[0]}:{addr[1]}: over its ingest rate limit.")
+                self.transport.close()
+                return False
+            return True
+        message_text = str(frame, 'utf-8', 'ignore').strip()
+        if should_log_message():
+            log_activity(f"{self.label}: Received from {addr[0]}:{addr[1]} - '{message_text}'", LOG_DEBUG)
+
+        seq = broadcast_message_to_clients(build_message_payload(self.protocol, addr, message_text), received_at)
+        if self.ack_mode == "per-message":
+            self.transport.write(self.ack_format % message_text.encode('utf-8'))
+            count_ack(self.protocol)
+        elif self.cumulative_ack is not None:
+            self.cumulative_ack.add(seq)
+        if message_text.lower() in ['exit', 'quit']:
+            if self.cumulative_ack is not None:
+                self.cumulative_ack.flush()
+            self.transport.close()
+            return False
+        return True
+
+    def send_cumulative_ack(self, count, last_seq):
+        if not self.transport.is_closing():
+            self.transport.write(format_cumulative_ack(self.label, count, last_seq))
+            count_ack(self.protocol)
+
+    def expire(self, now):
+        # Timer wheel callback
+        idle = now - self.last_activity
+        if idle < self.idle_timeout:
+            return self.idle_timeout - idle
+        reaped_stats[f"{self.protocol}_idle"] += 1
+        log_activity(f"{self.label}: Closing {self.addr[0]}:{self.addr[1]}: no data for {idle:.0f}s.")
+        self.transport.close()
+        return None
+
+    # A producer that stops reading its ACKs only stalls itself: stop reading from it until they drain.
+    def pause_writing(self):
+        self.write_paused = True
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.write_paused = False
+        if not successor_write_paused(): # Still held back by a slow successor after a reload handoff
+            self.transport.resume_reading()
+
+    def eof_received(self):
+        log_activity(f"{self.label}: Connection closed by {self.addr[0]}:{self.addr[1]}")
+        if self.cumulative_ack is not None:
+            self.cumulative_ack.flush() # Our side is still writable: acknowledge the tail before closing
+        return False
+
+    def connection_lost(self, exc):
+        tcp_client_transports.discard(self.transport)
+        connection_wheel.cancel(self)
+        if self.cumulative_ack is not None:
+            self.cumulative_ack.cancel()
+        if isinstance(exc, ConnectionResetError):
+            log_activity(f"{self.label}: Connection reset by {self.addr[0]}:{self.addr[1]}")
+        elif exc is not None:
+            log_activity(f"{self.label}: Socket error with client {self.addr[0]}:{self.addr[1]}: {exc}")
+        log_activity(f"{self.label}: Handler for {self.addr[0]}:{self.addr[1]} finished.")
+
+async def start_tcp_listeners(inherited=None):
+    # inherited: {port: listening socket} handed over by the previous process on reload
+    loop = asyncio.get_running_loop()
+    inherited = dict(inherited or {})
+    servers = []
+    for listener in TCP_LISTENERS:
+        port = listener["port"]
+        framing = listener.get("framing", "raw")
+        max_frame_size = listener.get("max_frame_size", TCP_MAX_FRAME_SIZE)
+        idle_timeout = listener.get("idle_timeout", TCP_IDLE_TIMEOUT)
+        try:
+            policy = ack_policy(listener)
+        except ValueError as e:
+            log_activity(f"TCP: Listener on port {port} not started: {e}")
+            continue
+        protocol_factory = lambda framing=framing, max_frame_size=max_frame_size, policy=policy, idle_timeout=idle_timeout: \
+            TcpIngestProtocol(framing, max_frame_size, policy, idle_timeout)
+        sock = inherited.pop(port, None)
+        log_activity(f"TCP: Listener starting on {HOST}:{port} (framing: {framing}, ACK: {describe_ack_policy(policy)}, "
+                     f"idle timeout: {f'{idle_timeout}s' if idle_timeout else 'none'}{', inherited' if sock else ''})")
+        try:
+            if sock is not None:
+                servers.append(await loop.create_server(protocol_factory, sock=sock, backlog=TCP_LISTEN_BACKLOG))
+            else:
+                servers.append(await loop.create_server(
+                    protocol_factory, HOST, port,
+                    backlog=TCP_LISTEN_BACKLOG, reuse_address=True, reuse_port=worker_index is not None
+                ))
+        except Exception as e:
+            log_activity(f"TCP: Bind/listen error on port {port}: {e}")
+    for port, sock in inherited.items():
+        log_activity(f"TCP: Inherited listener on port {port} is no longer configured; closing it.")
+        sock.close()
+    return servers
+
+# --- UDP Ingest (batched recvmsg_into on one or more SO_REUSEPORT sockets) ---
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40 if sys.platform.startswith('linux') else None)
+
+udp_stats = {
+    "datagrams": 0, "bytes": 0,
+    "truncated": 0, # Larger than UDP_MAX_DATAGRAM_SIZE; dropped instead of broadcast cut short
+    "overruns": 0, # Dropped by the kernel because a socket receive buffer was full (SO_RXQ_OVFL)
+    "ack_drops": 0, # ACKs not sent because the socket send buffer was full
+    "full_batches": 0 # Wakeups that hit UDP_BATCH_SIZE with datagrams possibly still queued
+}
+
+class UdpIngestEngine:
+    def __init__(self, port, socket_count, ack_policy):
+        self.port = port
+        self.socket_count = socket_count
+        self.ack_mode, self.ack_every, self.ack_interval = ack_policy
+        self.pending_acks = {} # "cumulative": source address -> CumulativeAck, only while something is unacknowledged
+        self.sockets = []
+        self.loop = None
+        self.view = memoryview(bytearray(UDP_MAX_DATAGRAM_SIZE)) # Reused for every datagram
+        self.ancbufsize = socket.CMSG_SPACE(4) if SO_RXQ_OVFL else 0
+        self.kernel_drop_totals = {} # fileno -> last cumulative SO_RXQ_OVFL value
+
+    def open(self, loop, inherited=None):
+        self.loop = loop
+        if inherited:
+            # Already bound and configured by the previous process; datagrams queued meanwhile are still there
+            for sock in inherited:
+                sock.setblocking(False)
+                self.sockets.append(sock)
+                loop.add_reader(sock.fileno(), self._on_readable, sock)
+            log_activity(f"UDP: {len(inherited)} inherited socket(s) on port {self.port}.")
+            return
+        for _ in range(self.socket_count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                if self.socket_count > 1 or UDP_REUSE_PORT or worker_index is not None:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF_BYTES)
+                if SO_RXQ_OVFL:
+                    try:
+                        sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+                    except OSError:
+                        self.ancbufsize = 0
+                sock.bind((HOST, self.port))
+                sock.setblocking(False)
+            except Exception:
+                sock.close()
+                self.close()
+                raise
+            self.sockets.append(sock)
+            loop.add_reader(sock.fileno(), self._on_readable, sock)
+        effective_rcvbuf = self.sockets[0].getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        log_activity(f"UDP: {self.socket_count} socket(s) on port {self.port}, SO_RCVBUF {effective_rcvbuf} bytes (requested {UDP_RCVBUF_BYTES}).")
 
-connected_ws_clients = [] # Our own list to manage client WebSocket handler instances
-clients_list_lock = threading.Lock()
+    def close(self):
+        for sock in self.detach():
+            sock.close()
 
-# --- Logging ---
-def log_activity(message):
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-    full_message = f"[{timestamp}] ({PROJECT_SUBDIR_NAME_FOR_LOGGING}-Server) {message}\n"
-    try:
-        os.makedirs(TMP_DIR, exist_ok=True) 
-        with open(ACTIVITY_LOG, "a") as f:
-            f.write(full_message)
-    except Exception as e:
-        original_stderr = sys.__stderr__ # Failsafe if redirection failed
-        print(f"CRITICAL_LOG_ERROR: Error writing to activity log {ACTIVITY_LOG}: {e}", file=original_stderr, flush=True)
+    def detach(self):
+        # Stop reading and hand the sockets to the caller (close(), or the reload handoff).
+        for pending in list(self.pending_acks.values()):
+            pending.flush()
+        sockets, self.sockets = self.sockets, []
+        for sock in sockets:
+            if self.loop:
+                self.loop.remove_reader(sock.fileno())
+        return sockets
 
-# --- WebSocket Handling ---
-class ClientConnectionHandler(WebSocket): # Renamed class
-    def handleMessage(self):
-        log_activity(f"WS: Message from Client {self.address}: {self.data}")
-        # Example: if client sends a ping, server could send a pong
-        # if self.data == 'ping':
-        #     self.sendMessage('pong')
+    def _on_readable(self, sock):
+        # Drain up to UDP_BATCH_SIZE datagrams per wakeup instead of one per loop iteration.
+        view = self.view
+        for _ in range(UDP_BATCH_SIZE):
+            try:
+                nbytes, ancdata, flags, addr = sock.recvmsg_into([view], self.ancbufsize)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                log_activity(f"UDP: Socket error: {e}")
+                return
+            if ancdata:
+                self._account_kernel_drops(sock, ancdata)
+            if flags & socket.MSG_TRUNC:
+                udp_stats["truncated"] += 1
+                continue
+            udp_stats["datagrams"] += 1
+            udp_stats["bytes"] += nbytes
+            try:
+                self.handle_datagram(sock, view[:nbytes], addr)
+            except Exception as e:
+                log_activity(f"UDP: Listener error: {e}")
+        udp_stats["full_batches"] += 1
 
-    def handleConnected(self):
-        log_activity(f"WS: New Client connected: {self.address}")
-        with clients_list_lock:
-            connected_ws_clients.append(self) 
-        log_activity(f"WS: Total connected clients: {len(connected_ws_clients)}")
-        # Send a connection confirmation message to this specific client
+    def _account_kernel_drops(self, sock, ancdata):
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and len(data) >= 4:
+                total = struct.unpack('=I', data[:4])[0]
+                previous = self.kernel_drop_totals.get(sock.fileno(), 0)
+                if total > previous:
+                    udp_stats["overruns"] += total - previous
+                    self.kernel_drop_totals[sock.fileno()] = total
+
+    def handle_datagram(self, sock, data, addr):
+        received_at = time.monotonic()
+        count_ingress("udp", len(data))
+        if ingest_admission.enabled and not ingest_admission.admit("udp", addr[0], len(data)):
+            return
+        message_text = str(data, 'utf-8', 'ignore').strip()
+        if should_log_message():
+            log_activity(f"UDP: Received from {addr[0]}:{addr[1]} - '{message_text}'", LOG_DEBUG)
+
+        seq = broadcast_message_to_clients(build_message_payload("udp", addr, message_text), received_at)
+        if self.ack_mode == "per-message":
+            self.send_ack(sock, b"UDP Server ACK: '%s' received." % message_text.encode('utf-8'), addr)
+        elif self.ack_mode == "cumulative":
+            pending = self.pending_acks.get(addr)
+            if pending is None:
+                send = lambda count, last_seq, sock=sock, addr=addr: self.send_cumulative_ack(sock, addr, count, last_seq)
+                pending = self.pending_acks[addr] = CumulativeAck(self.loop, send, self.ack_every, self.ack_interval)
+            pending.add(seq)
+
+    def send_cumulative_ack(self, sock, addr, count, last_seq):
+        self.pending_acks.pop(addr, None)
+        self.send_ack(sock, format_cumulative_ack("UDP", count, last_seq), addr)
+
+    def send_ack(self, sock, data, addr):
         try:
-            self.sendMessage(json.dumps({
-                "type": "system",
-                "event": "connected",
-                "message": "Conectado ao servidor WebSocket!",
-                "clientId": str(self.address) # Example client identifier
-            }))
+            sock.sendto(data, addr)
+            count_ack("udp")
+        except (BlockingIOError, InterruptedError):
+            udp_stats["ack_drops"] += 1
+        except OSError as e:
+            log_activity(f"UDP: ACK to {addr[0]}:{addr[1]} failed: {e}")
+
+def format_udp_stats():
+    return ", ".join(f"{name} {value}" for name, value in udp_stats.items())
+
+async def start_udp_listeners(inherited=None):
+    # inherited: {port: [sockets]} handed over by the previous process on reload
+    loop = asyncio.get_running_loop()
+    inherited = dict(inherited or {})
+    engines = []
+    for listener in UDP_LISTENERS:
+        port = listener["port"]
+        try:
+            policy = ack_policy(listener)
+        except ValueError as e:
+            log_activity(f"UDP: Listener on port {port} not started: {e}")
+            continue
+        log_activity(f"UDP: Listener starting on {HOST}:{port} (ACK: {describe_ack_policy(policy)})")
+        engine = UdpIngestEngine(port, listener.get("sockets", 1), policy)
+        try:
+            engine.open(loop, inherited.pop(port, None))
+            engines.append(engine)
         except Exception as e:
-            log_activity(f"WS: Error sending connection confirmation to {self.address}: {e}")
+            log_activity(f"UDP: Bind error on port {port}: {e}")
+    for port, socks in inherited.items():
+        log_activity(f"UDP: Inherited socket(s) on port {port} no longer configured; closing them.")
+        for sock in socks:
+            sock.close()
+    return engines
 
+# --- Local Ingest (Unix-domain sockets and shared-memory rings, for producers on this host) ---
+SHM_RING_MAGIC = b"RLYRING1"
+SHM_RING_CAPACITY_OFFSET = 8 # u64, bytes in the data area (a multiple of 8)
+SHM_RING_WRITE_OFFSET = 64 # u64, total bytes ever written; only the producer stores it
+SHM_RING_READ_OFFSET = 128 # u64, total bytes ever consumed; only the server stores it
+SHM_RING_WAITING_OFFSET = 192 # u32, 1 while the server waits for a doorbell
+SHM_RING_DATA_OFFSET = 256 # Counters on separate cache lines, then the data area
+SHM_RING_COUNTER = struct.Struct('<Q')
+SHM_RING_FLAG = struct.Struct('<I')
+SHM_RING_WRAP = 0xFFFFFFFF # Record length meaning "continue at the start of the data area"
 
-    def handleClose(self):
-        log_activity(f"WS: Client disconnected: {self.address}")
-        with clients_list_lock:
-            if self in connected_ws_clients:
-                connected_ws_clients.remove(self) 
-        log_activity(f"WS: Total connected clients: {len(connected_ws_clients)}")
+local_stats = {
+    "truncated": 0, # Unix datagrams larger than UDP_MAX_DATAGRAM_SIZE
+    "ring_doorbells": 0, # Wakeups by a producer instead of the idle poll
+    "ring_corrupt": 0 # Invalid record lengths; the ring was skipped to the producer's position
+}
+
+def local_ingest_path(path):
+    return path if worker_index is None else f"{path}-w{worker_index}"
+
+def bind_unix_socket(path, kind):
+    # A stale socket file from an earlier run (or the process we take over from) is replaced.
+    sock = socket.socket(socket.AF_UNIX, kind)
+    try:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        sock.bind(path)
+        sock.setblocking(False)
+    except Exception:
+        sock.close()
+        raise
+    return sock, os.stat(path).st_ino
 
-def broadcast_message_to_clients(message_data_dict):
-    global connected_ws_clients, clients_list_lock
-    message_json = json.dumps(message_data_dict)
-    clients_to_notify = []
-    with clients_list_lock: 
-        clients_to_notify = list(connected_ws_clients)
+def unlink_if_ours(path, inode):
+    # After a reload the path may already belong to our successor
+    try:
+        if os.stat(path).st_ino == inode:
+            os.unlink(path)
+    except OSError:
+        pass
+
+def peer_pid(sock):
+    try:
+        return struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))[0]
+    except (AttributeError, OSError):
+        return 0
 
-    if not clients_to_notify:
-        log_activity(f"WS_Broadcast: No WebSocket clients to send to. Message: {message_json[:100]}")
+def ingest_local_message(protocol, data, addr):
+    received_at = time.monotonic()
+    count_ingress(protocol, len(data))
+    if ingest_admission.enabled and not ingest_admission.admit(protocol, addr[0], len(data)):
         return
+    message_text = str(data, 'utf-8', 'ignore').strip()
+    if should_log_message():
+        log_activity(f"{protocol.upper()}: Received from local producer - '{message_text}'", LOG_DEBUG)
+    broadcast_message_to_clients(build_message_payload(protocol, addr, message_text), received_at)
 
-    log_activity(f"WS_Broadcast: Broadcasting to {len(clients_to_notify)} client(s): {message_json[:100]}...")
-    for client in clients_to_notify:
-        try:
-            client.sendMessage(message_json)
-        except Exception as e:
-            log_activity(f"WS_Broadcast: Error sending to WS client {getattr(client, 'address', 'Unknown')}: {e}")
+class UnixStreamIngestProtocol(TcpIngestProtocol):
+    protocol = "unix"
+    label = "UNIX"
+    ack_format = b"UNIX Server ACK: '%s' received."
+    keepalive = False
+
+    def peer_address(self, transport):
+        return ("local", peer_pid(transport.get_extra_info('socket')))
+
+class UnixDatagramIngest:
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+        self.inode = None
+        self.loop = None
+        self.view = memoryview(bytearray(UDP_MAX_DATAGRAM_SIZE))
 
-# --- TCP Client Handler & Listener Thread ---
-def handle_tcp_client_connection(conn, addr):
-    log_activity(f"TCP: Handling connection from {addr[0]}:{addr[1]}")
-    with conn:
-        while keep_running: 
+    def open(self, loop):
+        self.loop = loop
+        self.sock, self.inode = bind_unix_socket(self.path, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF_BYTES)
+        loop.add_reader(self.sock.fileno(), self._on_readable)
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+        unlink_if_ours(self.path, self.inode)
+
+    def _on_readable(self):
+        view = self.view
+        for _ in range(UDP_BATCH_SIZE):
             try:
-                data = conn.recv(1024)
-                if not data:
-                    log_activity(f"TCP: Connection closed by {addr[0]}:{addr[1]}")
-                    break
-                if not keep_running: break 
-                message_text = data.decode('utf-8', errors='ignore').strip()
-                log_activity(f"TCP: Received from {addr[0]}:{addr[1]} - '{message_text}'")
-                
-                msg_payload = {
-                    "type": "tcp", "ip": addr[0], "port": addr[1],
-                    "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                    "data": message_text
-                }
-                broadcast_message_to_clients(msg_payload)
-                conn.sendall(f"TCP Server ACK: '{message_text}' received.".encode('utf-8'))
-                if message_text.lower() in ['exit', 'quit']:
-                    break
-            except ConnectionResetError:
-                log_activity(f"TCP: Connection reset by {addr[0]}:{addr[1]}")
-                break
-            except socket.error as e: 
-                log_activity(f"TCP: Socket error with client {addr[0]}:{addr[1]}: {e}")
-                break 
+                nbytes, _, flags, _ = self.sock.recvmsg_into([view])
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                log_activity(f"UNIX: Socket error on {self.path}: {e}")
+                return
+            if flags & socket.MSG_TRUNC:
+                local_stats["truncated"] += 1
+                continue
+            try:
+                ingest_local_message("unix", view[:nbytes], ("local", 0))
             except Exception as e:
-                log_activity(f"TCP: Error handling client {addr[0]}:{addr[1]}: {e}")
-                break
-    log_activity(f"TCP: Handler for {addr[0]}:{addr[1]} finished.")
+                log_activity(f"UNIX: Listener error: {e}")
 
-def tcp_listener_main_loop(): 
-    global keep_running
-    log_activity(f"TCP: Listener starting on {HOST}:{TCP_PORT}")
-    tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    try:
-        tcp_sock.bind((HOST, TCP_PORT))
-        tcp_sock.listen(5)
-        tcp_sock.settimeout(1.0) 
-    except Exception as e:
-        log_activity(f"TCP: Bind/listen error: {e}")
-        return
+class ShmRingReader:
+    # Single-producer, single-consumer ring in a memory-mapped file; no locks and no syscall per message.
+    # A record is a u32 length and the payload, padded to 8 bytes; a length of SHM_RING_WRAP sends the reader back
+    # to the start of the data area. The producer writes a record and then stores the new write position, the
+    # server consumes up to it and stores its read position once per batch (the producer's free-space check).
+    # An idle server sets the waiting flag and sleeps on a Unix datagram "doorbell" (path + ".bell") that a producer
+    # rings when it finds the flag set; SHM_RING_IDLE_POLL covers a doorbell lost to the flag race.
+    # The file is created fresh at startup: producers (local_producer.ShmRingWriter) reattach when it is replaced.
+    def __init__(self, path, size):
+        self.path = path
+        self.capacity = size - size % 8
+        self.mm = None
+        self.inode = None
+        self.bell = None
+        self.bell_inode = None
+        self.loop = None
+        self.read_pos = 0
+        self.timer = None
 
-    while keep_running: 
+    def open(self, loop):
+        self.loop = loop
         try:
-            conn, addr = tcp_sock.accept()
-            if not keep_running: 
-                conn.close()
+            os.unlink(self.path) # A new inode: producers still mapping the old file are not overwritten
+        except FileNotFoundError:
+            pass
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            os.ftruncate(fd, SHM_RING_DATA_OFFSET + self.capacity)
+            self.mm = mmap.mmap(fd, SHM_RING_DATA_OFFSET + self.capacity)
+            self.inode = os.fstat(fd).st_ino
+        finally:
+            os.close(fd)
+        SHM_RING_COUNTER.pack_into(self.mm, SHM_RING_CAPACITY_OFFSET, self.capacity)
+        self.mm[0:len(SHM_RING_MAGIC)] = SHM_RING_MAGIC # Last: producers check it before using the ring
+        self.bell, self.bell_inode = bind_unix_socket(self.path + ".bell", socket.SOCK_DGRAM)
+        loop.add_reader(self.bell.fileno(), self._on_doorbell)
+        self.schedule(SHM_RING_IDLE_POLL)
+
+    def close(self):
+        if self.mm is None:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.loop.remove_reader(self.bell.fileno())
+        self.bell.close()
+        unlink_if_ours(self.path + ".bell", self.bell_inode)
+        unlink_if_ours(self.path, self.inode)
+        self.mm.close()
+        self.mm = None
+
+    def schedule(self, delay):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.loop.call_later(delay, self.drain) if delay else self.loop.call_soon(self.drain)
+
+    def _on_doorbell(self):
+        try:
+            while self.bell.recv(64):
+                local_stats["ring_doorbells"] += 1
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            log_activity(f"SHM: Doorbell error on {self.path}: {e}")
+        self.drain()
+
+    def drain(self):
+        if self.timer is not None:
+            self.timer.cancel() # Run early by the doorbell: drop the pending poll, or it starts a second chain
+            self.timer = None
+        mm, capacity = self.mm, self.capacity
+        if mm is None:
+            return
+        if SHM_RING_FLAG.unpack_from(mm, SHM_RING_WAITING_OFFSET)[0]:
+            SHM_RING_FLAG.pack_into(mm, SHM_RING_WAITING_OFFSET, 0)
+        write_pos = SHM_RING_COUNTER.unpack_from(mm, SHM_RING_WRITE_OFFSET)[0]
+        read_pos = self.read_pos
+        for _ in range(SHM_RING_BATCH):
+            if read_pos >= write_pos:
                 break
-            log_activity(f"TCP: Accepted connection from {addr[0]}:{addr[1]}")
-            client_conn_thread = threading.Thread(target=handle_tcp_client_connection, args=(conn, addr), daemon=True)
-            client_conn_thread.start()
-        except socket.timeout: 
-            continue 
-        except socket.error as e:
-             log_activity(f"TCP: Accept error: {e}. Listener loop terminating ({keep_running}).")
-             break 
+            offset = read_pos % capacity
+            length = SHM_RING_FLAG.unpack_from(mm, SHM_RING_DATA_OFFSET + offset)[0]
+            if length == SHM_RING_WRAP:
+                read_pos += capacity - offset
+                continue
+            if offset + 4 + length > capacity or read_pos + 4 + length > write_pos:
+                local_stats["ring_corrupt"] += 1
+                log_activity(f"SHM: Invalid record length {length} at {read_pos} in {self.path}; skipping to {write_pos}.")
+                read_pos = write_pos
+                break
+            start = SHM_RING_DATA_OFFSET + offset + 4
+            data = mm[start:start + length]
+            read_pos += (4 + length + 7) & ~7
+            try:
+                ingest_local_message("shm", data, ("local", 0))
+            except Exception as e:
+                log_activity(f"SHM: Ingest error: {e}")
+        self.read_pos = read_pos
+        SHM_RING_COUNTER.pack_into(mm, SHM_RING_READ_OFFSET, read_pos)
+        if read_pos < write_pos:
+            self.schedule(0) # Batch limit: let the rest of the loop run first
+            return
+        # Going idle: raise the flag, then look once more, since the producer may have published in between
+        SHM_RING_FLAG.pack_into(mm, SHM_RING_WAITING_OFFSET, 1)
+        if SHM_RING_COUNTER.unpack_from(mm, SHM_RING_WRITE_OFFSET)[0] != read_pos:
+            self.schedule(0)
+        else:
+            self.schedule(SHM_RING_IDLE_POLL)
+
+async def start_local_listeners():
+    loop = asyncio.get_running_loop()
+    stream_servers, endpoints = [], []
+    for listener in UNIX_LISTENERS:
+        path = local_ingest_path(listener["path"])
+        try:
+            if listener.get("kind", "datagram") == "stream":
+                framing = listener.get("framing", "newline")
+                max_frame_size = listener.get("max_frame_size", TCP_MAX_FRAME_SIZE)
+                idle_timeout = listener.get("idle_timeout", TCP_IDLE_TIMEOUT)
+                policy = ack_policy(listener)
+                sock, inode = bind_unix_socket(path, socket.SOCK_STREAM)
+                protocol_factory = lambda framing=framing, max_frame_size=max_frame_size, policy=policy, idle_timeout=idle_timeout: \
+                    UnixStreamIngestProtocol(framing, max_frame_size, policy, idle_timeout)
+                server = await loop.create_unix_server(protocol_factory, sock=sock, backlog=TCP_LISTEN_BACKLOG)
+                server.unix_path = (path, inode)
+                stream_servers.append(server)
+                log_activity(f"UNIX: Stream listener on {path} (framing: {framing}, ACK: {describe_ack_policy(policy)})")
+            else:
+                endpoint = UnixDatagramIngest(path)
+                endpoint.open(loop)
+                endpoints.append(endpoint)
+                log_activity(f"UNIX: Datagram listener on {path}")
         except Exception as e:
-            log_activity(f"TCP: Unexpected error in accept loop: {e}")
-            if not keep_running : break 
-            time.sleep(0.1) 
-    log_activity("TCP: Listener thread loop finished.")
-    if tcp_sock: tcp_sock.close()
-    log_activity("TCP: Listener socket closed.")
-
-# --- UDP Listener Thread ---
-def udp_listener_main_loop(): 
-    global keep_running
-    log_activity(f"UDP: Listener starting on {HOST}:{UDP_PORT}")
-    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            log_activity(f"UNIX: Listener on {path} not started: {e}")
+    for ring in SHM_RINGS:
+        path = local_ingest_path(ring["path"])
+        reader = ShmRingReader(path, ring.get("size", 4 * 1024 * 1024))
+        try:
+            reader.open(loop)
+            endpoints.append(reader)
+            log_activity(f"SHM: Ring {path} ({reader.capacity} bytes, doorbell {path}.bell)")
+        except Exception as e:
+            log_activity(f"SHM: Ring {path} not started: {e}")
+    return stream_servers, endpoints
+
+def stop_local_listeners(stream_servers, endpoints):
+    # Established stream connections are left to the caller (they are in tcp_client_transports)
+    for server in stream_servers:
+        server.close()
+        unlink_if_ours(*server.unix_path)
+    for endpoint in endpoints:
+        endpoint.close()
+
+async def log_stats_periodically():
+    last_logged = None
+    last_reaped = dict(reaped_stats)
+    while True:
+        await asyncio.sleep(STATS_LOG_INTERVAL)
+        current = format_udp_stats()
+        if current != last_logged:
+            log_activity(f"UDP: Stats: {current}")
+            last_logged = current
+        if reaped_stats != last_reaped:
+            log_activity("TIMERS: Connections reaped so far: " + ", ".join(f"{reason} {count}" for reason, count in reaped_stats.items()))
+            last_reaped = dict(reaped_stats)
+        shed_report = ingest_admission.take_shed_report()
+        if shed_report:
+            log_activity(f"INGEST: {shed_report}")
+
+def metrics_summary():
+    rss = resident_memory_bytes()
+    return {
+        "pid": os.getpid(),
+        "worker": worker_index,
+        "uptime_seconds": round(time.time() - metrics_started_at, 1),
+        "messages_in": {protocol: counters[0] for protocol, counters in list(ingress_stats.items())},
+        "bytes_in": {protocol: counters[1] for protocol, counters in list(ingress_stats.items())},
+        "acks_sent": dict(ack_stats),
+        "shed": dict(shed_stats),
+        "journal": dict(journal_stats),
+        "reaped": dict(reaped_stats),
+        "local": dict(local_stats),
+        "http": dict(http_stream_stats),
+        "peer": dict(peer_stats),
+        **relay_stats,
+        "ws_clients": len(connected_ws_clients),
+        "http_streams": http_stream_counts["sse"],
+        "peer_links": len(peer_links),
+        "tcp_connections": len(tcp_client_transports),
+        "resident_memory_bytes": rss,
+        "ws_memory_per_client_bytes": memory_per_client(rss),
+        "latency_ms": {
+            "count": delivery_latency.count,
+            "p50": round(delivery_latency.quantile(0.5) * 1000, 3),
+            "p99": round(delivery_latency.quantile(0.99) * 1000, 3),
+            "max": round(delivery_latency.max * 1000, 3),
+        },
+        "stage_us": span_summary(), # Only stages timed since spans were last enabled
+    }
+
+def render_metrics():
+    worker_label = f'worker="{worker_index}",' if worker_index is not None else ""
+    labels = f'{{{worker_label[:-1]}}}' if worker_label else ""
+    lines = [
+        "# HELP relay_messages_received_total Messages ingested, by protocol.",
+        "# TYPE relay_messages_received_total counter",
+    ]
+    lines += [f'relay_messages_received_total{{{worker_label}protocol="{protocol}"}} {counters[0]}' for protocol, counters in ingress_stats.items()]
+    lines += ["# HELP relay_bytes_received_total Payload bytes ingested, by protocol.", "# TYPE relay_bytes_received_total counter"]
+    lines += [f'relay_bytes_received_total{{{worker_label}protocol="{protocol}"}} {counters[1]}' for protocol, counters in ingress_stats.items()]
+    lines += ["# HELP relay_acks_sent_total ACKs sent to producers, by protocol.", "# TYPE relay_acks_sent_total counter"]
+    lines += [f'relay_acks_sent_total{{{worker_label}protocol="{protocol}"}} {count}' for protocol, count in ack_stats.items()]
+    for name, value in relay_stats.items():
+        lines += [f"# TYPE relay_{name}_total counter", f"relay_{name}_total{labels} {value}"]
+    for name, value in udp_stats.items():
+        lines += [f"# TYPE relay_udp_{name}_total counter", f"relay_udp_{name}_total{labels} {value}"]
+    for name, value in shed_stats.items():
+        lines += [f"# TYPE relay_shed_{name}_total counter", f"relay_shed_{name}_total{labels} {value}"]
+    for name, value in journal_stats.items():
+        lines += [f"# TYPE relay_journal_{name}_total counter", f"relay_journal_{name}_total{labels} {value}"]
+    lines += ["# HELP relay_connections_reaped_total Connections closed by a timeout, by reason.", "# TYPE relay_connections_reaped_total counter"]
+    lines += [f'relay_connections_reaped_total{{{worker_label}reason="{reason}"}} {count}' for reason, count in reaped_stats.items()]
+    for name, value in bus_stats.items():
+        lines += [f"# TYPE relay_bus_{name}_total counter", f"relay_bus_{name}_total{labels} {value}"]
+    for name, value in local_stats.items():
+        lines += [f"# TYPE relay_local_{name}_total counter", f"relay_local_{name}_total{labels} {value}"]
+    for name, value in http_stream_stats.items():
+        lines += [f"# TYPE relay_http_{name}_total counter", f"relay_http_{name}_total{labels} {value}"]
+    for name, value in peer_stats.items():
+        lines += [f"# TYPE relay_peer_{name}_total counter", f"relay_peer_{name}_total{labels} {value}"]
+    rss = resident_memory_bytes()
+    gauges = {
+        "ws_clients": len(connected_ws_clients),
+        "ws_queued_frames": sum(len(client.outbound) for client in connected_ws_clients),
+        "http_streams": http_stream_counts["sse"],
+        "http_polls_waiting": http_stream_counts["poll"],
+        "peer_links": len(peer_links),
+        "peer_queued_bytes": sum(link.outbound_bytes for link in peer_links.values()),
+        "tcp_connections": len(tcp_client_transports),
+        "replay_buffer_messages": len(replay_buffer.entries),
+        "aggregate_clients": sum(len(clients) for clients in window_aggregator.subscribers.values()),
+        "resident_memory_bytes": rss,
+        "ws_memory_per_client_bytes": memory_per_client(rss), # RSS growth since startup over the connected clients
+    }
+    for name, value in gauges.items():
+        lines += [f"# TYPE relay_{name} gauge", f"relay_{name}{labels} {value}"]
+    lines += [
+        "# HELP relay_delivery_latency_seconds Socket receive to the broadcast frame queued for its last WebSocket recipient.",
+        "# TYPE relay_delivery_latency_seconds histogram",
+    ]
+    lines += delivery_latency.render("relay_delivery_latency_seconds", worker_label)
+    if any(histogram.count for histogram in stage_spans.values()):
+        lines += ["# HELP relay_stage_seconds Time spent per pipeline stage (while spans are enabled).", "# TYPE relay_stage_seconds histogram"]
+        for stage, histogram in stage_spans.items():
+            lines += histogram.render("relay_stage_seconds", f'{worker_label}stage="{stage}",')
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics_request(reader, writer):
     try:
-        udp_sock.bind((HOST, UDP_PORT))
-        udp_sock.settimeout(1.0) 
-    except Exception as e:
-        log_activity(f"UDP: Bind error: {e}")
+        request_line = await asyncio.wait_for(reader.readline(), METRICS_REQUEST_TIMEOUT)
+        while (await asyncio.wait_for(reader.readline(), METRICS_REQUEST_TIMEOUT)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        path, _, query = parts[1].partition('?') if len(parts) > 1 else ("", "", "")
+        if path == "/metrics":
+            status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", render_metrics().encode('utf-8')
+        elif path == "/metrics.json":
+            status, content_type, body = "200 OK", "application/json", json.dumps(metrics_summary()).encode('utf-8')
+        elif path == "/spans": # ?enable=1 or ?enable=0; without it, just the current state
+            enable = urllib.parse.parse_qs(query).get("enable")
+            if enable:
+                set_spans_enabled(enable[0] not in ("0", "false", "off"))
+            status, content_type, body = "200 OK", "application/json", json.dumps({"pid": os.getpid(), "spans": spans_enabled}).encode('utf-8')
+        else:
+            status, content_type, body = "404 Not Found", "text/plain", b"Not found\n"
+        writer.write(f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('ascii') + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+def worker_metrics_port(index):
+    return METRICS_WORKER_PORT_BASE + index
+
+async def start_metrics_server(sock=None):
+    if not METRICS_PORT:
+        if sock is not None:
+            sock.close()
+        return None
+    port = METRICS_PORT if worker_index is None else worker_metrics_port(worker_index)
+    try:
+        if sock is not None:
+            server = await asyncio.start_server(handle_metrics_request, sock=sock)
+        else:
+            server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, port)
+    except OSError as e:
+        log_activity(f"METRICS: Could not listen on {METRICS_HOST}:{port}: {e}")
+        return None
+    log_activity(f"METRICS: Serving http://{METRICS_HOST}:{port}/metrics")
+    return server
+
+# --- Worker Bus (multi-process mode) ---
+# Every worker binds a Unix datagram socket; a message ingested by one worker is sent to all the others,
+# which hand it straight to their own WebSocket clients (never back onto the bus).
+worker_index = None # None when running as a single process
+worker_count = 1
+supervisor_pid = None
+bus_socket = None
+bus_peer_paths = []
+bus_stats = {"sent": 0, "received": 0, "send_drops": 0}
+
+def bus_socket_path(index):
+    return os.path.join(TMP_DIR, f"message_bus.{index}.sock")
+
+def open_worker_bus(loop):
+    global bus_socket, bus_peer_paths
+    path = bus_socket_path(worker_index)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, BUS_SOCKET_BUFFER_BYTES)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BUS_SOCKET_BUFFER_BYTES)
+    sock.bind(path)
+    sock.setblocking(False)
+    bus_socket = sock
+    bus_peer_paths = [bus_socket_path(index) for index in range(worker_count) if index != worker_index]
+    loop.add_reader(sock.fileno(), on_bus_readable)
+    log_activity(f"BUS: Worker {worker_index} listening on {path} ({len(bus_peer_paths)} peer(s)).")
+
+def close_worker_bus(loop):
+    global bus_socket
+    if bus_socket is None:
         return
+    loop.remove_reader(bus_socket.fileno())
+    bus_socket.close()
+    bus_socket = None
+    try:
+        os.unlink(bus_socket_path(worker_index))
+    except OSError:
+        pass
+    log_activity("BUS: Closed. Stats: " + ", ".join(f"{name} {value}" for name, value in bus_stats.items()))
 
-    while keep_running:
+# Sequence number (so receivers can fill their replay buffer without parsing JSON) and ingress time (monotonic, NaN if unknown)
+BUS_HEADER = struct.Struct('!Qd')
+
+def publish_to_worker_bus(seq, message_bytes, received_at=None):
+    packet = BUS_HEADER.pack(seq, float('nan') if received_at is None else received_at) + message_bytes
+    for path in bus_peer_paths:
         try:
-            data, addr = udp_sock.recvfrom(1024)
-            message_text = data.decode('utf-8', errors='ignore').strip()
-            log_activity(f"UDP: Received from {addr[0]}:{addr[1]} - '{message_text}'")
-
-            msg_payload = {
-                "type": "udp", "ip": addr[0], "port": addr[1],
-                "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                "data": message_text
-            }
-            broadcast_message_to_clients(msg_payload)
-            udp_sock.sendto(f"UDP Server ACK: '{message_text}' received.".encode('utf-8'), addr)
-        except socket.timeout:
-            continue 
-        except socket.error as e:
-            log_activity(f"UDP: Socket error: {e}. Listener loop terminating ({keep_running}).")
-            break
-        except Exception as e:
-            log_activity(f"UDP: Listener error: {e}")
-            if not keep_running: break 
-            time.sleep(0.1)
-    log_activity("UDP: Listener thread loop finished.")
-    if udp_sock: udp_sock.close()
-    log_activity("UDP: Listener socket closed.")
+            bus_socket.sendto(packet, path)
+            bus_stats["sent"] += 1
+        except (BlockingIOError, FileNotFoundError, ConnectionRefusedError):
+            bus_stats["send_drops"] += 1 # Peer is restarting or its bus buffer is full
+        except OSError as e:
+            bus_stats["send_drops"] += 1
+            log_activity(f"BUS: Send to {path} failed: {e}")
+
+def on_bus_readable():
+    for _ in range(BUS_RECV_BATCH):
+        try:
+            packet = bus_socket.recv(BUS_MAX_MESSAGE_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            log_activity(f"BUS: Receive error: {e}")
+            return
+        bus_stats["received"] += 1
+        seq, received_at = BUS_HEADER.unpack_from(packet)
+        observe_sequence_number(seq)
+        deliver_to_local_clients(seq, packet[BUS_HEADER.size:], None, None if received_at != received_at else received_at)
+
+async def watch_supervisor():
+    # Workers follow the supervisor down if it dies without stopping them (e.g. SIGKILL).
+    while True:
+        await asyncio.sleep(1.0)
+        if os.getppid() != supervisor_pid:
+            request_shutdown("Supervisor is gone")
+            return
+
+# --- Cluster Peering (federated relay nodes: --peer, --peer-port) ---
+# Nodes are linked by persistent TCP connections. A message ingested here goes to every linked node, which delivers
+# it to its own clients (under its own sequence number) and passes it on over its other links, so any connected
+# topology (a chain, a ring, a full mesh) reaches every node. Records carry their origin (node id and boot epoch) and
+# the origin's sequence number: a node delivers and passes on a record only the first time it sees it, which ends
+# loops and drops the copies that arrive over a second path. Per link, the records queued during one loop iteration
+# go out in one write; a link whose peer stops reading keeps up to PEER_SEND_QUEUE_MAX_BYTES and then drops its
+# oldest records, so a slow node never holds up ingest or the other links.
+PEER_FRAME_HEADER = struct.Struct('!BI') # kind, body length
+PEER_HELLO = 1 # Body: {"node": ..., "epoch": ..., "version": ...}; the first frame each way
+PEER_MESSAGE = 2
+PEER_HEARTBEAT = 3 # Empty body
+PEER_MESSAGE_HEADER = struct.Struct('!QQBB') # origin epoch, origin seq, hops so far, len(origin node id); then the id and the origin's broadcast JSON
+PEER_PROTOCOL_VERSION = 1
+PEER_HEARTBEAT_FRAME = PEER_FRAME_HEADER.pack(PEER_HEARTBEAT, 0)
+node_id = None # NODE_ID once the cluster is started
+node_id_bytes = b""
+node_epoch = 0 # time.time_ns() at startup: a restarted node is a new origin, whose sequence numbers start over
+peer_links = {} # node id -> established PeerLink
+peer_connections = set() # Every PeerLink, from connect (or accept) to close
+peer_address_nodes = {} # (host, port) we dial -> node id last seen there
+peer_dialers = [] # One task per PEERS entry
+peer_stats = {"sent": 0, "received": 0, "forwarded": 0, "duplicates": 0, "loops": 0, "queue_drops": 0, "bad_records": 0, "links_opened": 0, "links_refused": 0}
+
+class PeerDedup:
+    # Per origin (node id, epoch): the highest sequence number seen and the numbers seen within PEER_DEDUP_WINDOW
+    # below it. Records overtake each other on different paths, so no arrival order is assumed; anything older
+    # than the window counts as seen. The set is pruned once it holds two windows' worth, so a check is O(1) amortized.
+    def __init__(self, window, max_origins):
+        self.window = window
+        self.max_origins = max_origins
+        self.origins = {} # (node id, epoch) -> [highest seq, seqs seen above highest - window]
+
+    def first_sighting(self, origin, seq):
+        state = self.origins.get(origin)
+        if state is None:
+            if len(self.origins) >= self.max_origins:
+                del self.origins[next(iter(self.origins))]
+            self.origins[origin] = [seq, {seq}]
+            return True
+        highest, seen = state
+        if seq > highest:
+            state[0] = seq
+            seen.add(seq)
+            if len(seen) > 2 * self.window:
+                floor = seq - self.window
+                state[1] = {number for number in seen if number > floor}
+            return True
+        if seq <= highest - self.window or seq in seen:
+            return False
+        seen.add(seq)
+        return True
+
+peer_dedup = PeerDedup(PEER_DEDUP_WINDOW, PEER_DEDUP_MAX_ORIGINS)
+
+def build_peer_record(origin, epoch, seq, hops, payload):
+    return b"".join((
+        PEER_FRAME_HEADER.pack(PEER_MESSAGE, PEER_MESSAGE_HEADER.size + len(origin) + len(payload)),
+        PEER_MESSAGE_HEADER.pack(epoch, seq, hops, len(origin)), origin, payload,
+    ))
+
+def publish_to_peers(seq, message_bytes):
+    # One record for every link: our sequence number is the origin sequence number
+    record = build_peer_record(node_id_bytes, node_epoch, seq, 0, message_bytes)
+    for link in peer_links.values():
+        link.send_record(record)
+
+def receive_peer_record(link, body):
+    received_at = time.monotonic()
+    peer_stats["received"] += 1
+    link.records_received += 1
+    epoch, origin_seq, hops, origin_length = PEER_MESSAGE_HEADER.unpack_from(body)
+    payload_start = PEER_MESSAGE_HEADER.size + origin_length
+    origin = body[PEER_MESSAGE_HEADER.size:payload_start]
+    if origin == node_id_bytes:
+        peer_stats["loops"] += 1 # Our own message, back around a cycle
+        return
+    if not peer_dedup.first_sighting((origin, epoch), origin_seq):
+        peer_stats["duplicates"] += 1 # Already here over another path
+        return
+    payload = body[payload_start:]
+    if PEER_FORWARD and hops + 1 < PEER_MAX_HOPS and len(peer_links) > 1:
+        record = build_peer_record(origin, epoch, origin_seq, hops + 1, payload)
+        for other in peer_links.values():
+            if other is not link:
+                other.send_record(record)
+        peer_stats["forwarded"] += 1
+    try:
+        message_data_dict = json.loads(payload)
+        message_data_dict.pop("seq") # Renumbered here, so local clients resume by our sequence numbers
+        count_ingress("peer", len(payload))
+        broadcast_message_to_clients(message_data_dict, received_at, from_peer=True)
+    except (ValueError, KeyError, TypeError, AttributeError, UnicodeError) as e:
+        peer_stats["bad_records"] += 1
+        log_activity(f"PEER: Bad record from node {link.node}: {e}")
+
+class PeerLink(asyncio.Protocol):
+    # One connection to another node, dialed by us (address set) or accepted on PEER_PORT. Each side opens with a
+    # hello; records only flow once the peer's hello has arrived. Two nodes that dial each other end up with two
+    # connections: both sides keep the one dialed by the node with the smaller id, so they agree without a round trip.
+    def __init__(self, address=None):
+        self.address = address # (host, port) when we dialed
+        self.transport = None
+        self.remote = None
+        self.node = None # The peer's node id, once linked
+        self.buffer = bytearray()
+        self.outbound = deque()
+        self.outbound_bytes = 0
+        self.flush_scheduled = False
+        self.write_paused = False
+        self.records_sent = 0
+        self.records_received = 0
+        self.records_dropped = 0
+        self.dropped_while_paused = 0
+        self.last_received = self.last_sent = connection_wheel.now
+        self.wheel_slot = None
+        self.closed = asyncio.get_running_loop().create_future() # Result: whether the link was established
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.remote = transport.get_extra_info('peername')
+        peer_connections.add(self)
+        transport.set_write_buffer_limits(high=PEER_WRITE_BUFFER)
+        configure_keepalive(transport.get_extra_info('socket'))
+        hello = json.dumps({"node": node_id, "epoch": node_epoch, "version": PEER_PROTOCOL_VERSION}).encode('utf-8')
+        transport.write(PEER_FRAME_HEADER.pack(PEER_HELLO, len(hello)) + hello)
+        connection_wheel.schedule(self, PEER_HEARTBEAT_INTERVAL)
+
+    def data_received(self, data):
+        self.last_received = connection_wheel.now
+        buffer = self.buffer
+        buffer += data
+        offset = 0
+        try:
+            while len(buffer) - offset >= PEER_FRAME_HEADER.size:
+                kind, length = PEER_FRAME_HEADER.unpack_from(buffer, offset)
+                if length > PEER_MAX_FRAME_BYTES:
+                    raise ValueError(f"frame of {length} bytes exceeds PEER_MAX_FRAME_BYTES")
+                end = offset + PEER_FRAME_HEADER.size + length
+                if end > len(buffer):
+                    break
+                body = bytes(buffer[offset + PEER_FRAME_HEADER.size:end])
+                offset = end
+                if kind == PEER_MESSAGE and self.node is not None:
+                    receive_peer_record(self, body)
+                elif kind == PEER_HELLO and self.node is None:
+                    self.handle_hello(body)
+                elif kind != PEER_HEARTBEAT:
+                    raise ValueError(f"unexpected frame kind {kind}")
+                if self.transport.is_closing():
+                    return
+        except (ValueError, KeyError, TypeError, struct.error) as e:
+            peer_stats["bad_records"] += 1
+            log_activity(f"PEER: Protocol error from {self.remote}: {e}. Closing the link.")
+            self.transport.abort()
+            return
+        del buffer[:offset]
+
+    def handle_hello(self, body):
+        hello = json.loads(body)
+        if hello.get("version") != PEER_PROTOCOL_VERSION:
+            raise ValueError(f"protocol version {hello.get('version')}, expected {PEER_PROTOCOL_VERSION}")
+        node = str(hello["node"])
+        if self.address is not None:
+            peer_address_nodes[self.address] = node
+        if node == node_id:
+            self.refuse(node, "it is this node (check --peer and --node-id)")
+            return
+        existing = peer_links.get(node)
+        if existing is not None:
+            dialer, existing_dialer = self.dialer_node(node), existing.dialer_node(node)
+            if dialer != existing_dialer and existing_dialer < dialer:
+                self.refuse(node, "already linked")
+                return
+            existing.close_link() # Same dialer: the old connection is half dead; else ours was dialed by the smaller id
+        self.node = node
+        peer_links[node] = self
+        peer_stats["links_opened"] += 1
+        log_activity(f"PEER: Linked to node {node} at {self.remote} ({'dialed' if self.address else 'accepted'}). Links: {len(peer_links)}")
+
+    def dialer_node(self, node):
+        return node_id if self.address is not None else node
+
+    def refuse(self, node, reason):
+        peer_stats["links_refused"] += 1
+        log_activity(f"PEER: Not linking to node {node} at {self.remote}: {reason}.")
+        self.transport.close()
+
+    def send_record(self, record):
+        self.outbound.append(record)
+        self.outbound_bytes += len(record)
+        if self.write_paused:
+            while self.outbound_bytes > PEER_SEND_QUEUE_MAX_BYTES:
+                self.outbound_bytes -= len(self.outbound.popleft())
+                self.records_dropped += 1
+                self.dropped_while_paused += 1
+                peer_stats["queue_drops"] += 1
+                if self.dropped_while_paused == 1:
+                    log_activity(f"PEER: Link to node {self.node} is backed up ({PEER_SEND_QUEUE_MAX_BYTES} bytes queued); dropping its oldest records.")
+        elif self.outbound_bytes >= PEER_BATCH_MAX_BYTES:
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        if self.write_paused or not self.outbound or self.transport.is_closing():
+            return
+        records, self.outbound = self.outbound, deque()
+        self.outbound_bytes = 0
+        self.transport.writelines(records)
+        self.records_sent += len(records)
+        peer_stats["sent"] += len(records)
+        self.last_sent = connection_wheel.now
+
+    def pause_writing(self):
+        self.write_paused = True
+
+    def resume_writing(self):
+        self.write_paused = False
+        if self.dropped_while_paused:
+            log_activity(f"PEER: Link to node {self.node} caught up; {self.dropped_while_paused} record(s) were dropped.")
+            self.dropped_while_paused = 0
+        self.flush()
+
+    def close_link(self):
+        self.flush()
+        self.transport.close()
+
+    def expire(self, now):
+        # Timer wheel: drop a silent link (no hello, records or heartbeats), else keep ours alive
+        if now - self.last_received >= PEER_TIMEOUT:
+            reaped_stats["peer_timeout"] += 1
+            log_activity(f"PEER: Nothing from {self.node or self.remote} for {PEER_TIMEOUT}s; dropping the link.")
+            self.transport.abort()
+            return None
+        if now - self.last_sent >= PEER_HEARTBEAT_INTERVAL and not self.write_paused:
+            self.transport.write(PEER_HEARTBEAT_FRAME)
+            self.last_sent = now
+        return PEER_HEARTBEAT_INTERVAL
+
+    def connection_lost(self, exc):
+        peer_connections.discard(self)
+        connection_wheel.cancel(self)
+        if self.node is not None and peer_links.get(self.node) is self:
+            del peer_links[self.node]
+            log_activity(f"PEER: Link to node {self.node} closed{f' ({exc})' if exc else ''} (sent {self.records_sent}, "
+                         f"received {self.records_received}, dropped {self.records_dropped}). Links: {len(peer_links)}")
+        if not self.closed.done():
+            self.closed.set_result(self.node is not None)
+
+async def dial_peer(host, port):
+    # Keeps a link to the node at host:port, redialing with exponential backoff. While that node is linked the
+    # other way (it dialed us) there is nothing to do but check again later.
+    loop = asyncio.get_running_loop()
+    address = (host, port)
+    delay = PEER_RECONNECT_MIN_DELAY
+    while True:
+        node = peer_address_nodes.get(address)
+        if node is not None and node in peer_links:
+            delay = PEER_RECONNECT_MIN_DELAY
+        else:
+            try:
+                _, link = await asyncio.wait_for(loop.create_connection(lambda: PeerLink(address), host, port), PEER_CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as e:
+                if delay == PEER_RECONNECT_MIN_DELAY: # Logged once per outage
+                    log_activity(f"PEER: Could not connect to {host}:{port} ({e or 'timed out'}); retrying every {PEER_RECONNECT_MAX_DELAY}s at most.")
+            else:
+                if await link.closed:
+                    delay = PEER_RECONNECT_MIN_DELAY
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, PEER_RECONNECT_MAX_DELAY)
+
+def parse_peer_address(text):
+    host, _, port = text.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"peer '{text}' is not host:port")
+    return host.strip("[]"), int(port)
+
+async def start_cluster(sock=None):
+    # sock: the PEER_PORT listener inherited from the previous process on reload
+    global node_id, node_id_bytes, node_epoch
+    if not PEER_PORT and not PEERS:
+        if sock is not None:
+            sock.close()
+        return None
+    node_id = NODE_ID or f"{socket.gethostname()}:{WEBSOCKET_PORT}"
+    node_id_bytes = node_id.encode('utf-8')[:255]
+    node_epoch = time.time_ns()
+    loop = asyncio.get_running_loop()
+    server = None
+    if sock is not None or PEER_PORT:
+        try:
+            if sock is not None:
+                server = await loop.create_server(PeerLink, sock=sock)
+            else:
+                server = await loop.create_server(PeerLink, PEER_HOST, PEER_PORT, reuse_address=True)
+        except OSError as e:
+            log_activity(f"PEER: Could not listen on {PEER_HOST}:{PEER_PORT}: {e}")
+    for text in PEERS:
+        peer_dialers.append(asyncio.ensure_future(dial_peer(*parse_peer_address(text))))
+    log_activity(f"PEER: Node {node_id} {f'accepting links on {PEER_HOST}:{PEER_PORT}' if server else 'not accepting links'}"
+                 f"{' (inherited)' if sock else ''}; dialing {', '.join(PEERS) or 'no one'}.")
+    return server
+
+def close_peer_links():
+    for task in peer_dialers:
+        task.cancel()
+    peer_dialers.clear()
+    for link in list(peer_connections):
+        link.close_link()
 
 # --- Process Management Functions (PID, Lock) ---
 def create_lock_file():
@@ -263,56 +3900,857 @@ def write_pid_file():
 def remove_pid_file():
     if os.path.exists(PID_FILE):
         try: 
+            with open(PID_FILE, 'r') as pf:
+                if pf.read().strip() != str(os.getpid()):
+                    return # Rewritten by the process that took over on reload
             os.remove(PID_FILE)
             log_activity(f"PID: File {PID_FILE} removed.")
         except OSError as e: 
             log_activity(f"PID: Error removing PID file {PID_FILE}: {e}")
 
+# --- Worker Group Supervision (--workers N) ---
+def write_workers_file(workers):
+    try:
+        with open(WORKERS_FILE, "w") as f:
+            f.write("".join(f"{pid}\n" for pid in workers))
+    except IOError as e:
+        log_activity(f"SUPERVISOR: Unable to write workers file {WORKERS_FILE}: {e}")
+
+def remove_workers_file():
+    if os.path.exists(WORKERS_FILE):
+        try:
+            os.remove(WORKERS_FILE)
+        except OSError as e:
+            log_activity(f"SUPERVISOR: Error removing workers file {WORKERS_FILE}: {e}")
+
+def spawn_worker(index, count):
+    # The log writer thread is stopped around fork() so the child never inherits it mid-write.
+    stop_activity_log_writer()
+    pid = os.fork()
+    if pid == 0:
+        run_worker(index, count) # Never returns
+    start_activity_log_writer()
+    log_activity(f"SUPERVISOR: Worker {index} started with PID {pid}.")
+    return pid
+
+def run_worker(index, count):
+    global worker_index, worker_count, supervisor_pid, log_source, keep_running, last_sequence_number
+    worker_index, worker_count, supervisor_pid = index, count, os.getppid()
+    # A restarted worker carries on above every seq the group has issued; whatever came before is not in its replay buffer
+    last_sequence_number = replay_buffer.gap_seq = max(sequence_slots[::SEQUENCE_SLOT_STRIDE])
+    log_source = f"{PROJECT_SUBDIR_NAME_FOR_LOGGING}-Server-w{index}"
+    keep_running = True
+    log_queue.clear() # Lines queued by the supervisor belong to the supervisor
+    if control_server:
+        control_server.sock.close() # The supervisor's listening socket; its thread did not survive fork()
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    start_activity_log_writer()
+    exit_code = 0
+    try:
+        log_activity(f"SERVER: Worker {index}/{count} starting. PID: {os.getpid()}")
+        asyncio.run(serve_relay())
+        log_activity(f"SERVER: Worker {index} finished.")
+    except Exception as e:
+        log_activity(f"SERVER: Worker {index} critical error: {e}")
+        exit_code = 1
+    finally:
+        stop_activity_log_writer()
+        os._exit(exit_code) # Never fall back into the supervisor's code (PID/lock cleanup)
+
+def supervise_workers(count):
+    global keep_running, sequence_slots, worker_count
+    worker_count = count
+    sequence_slots = multiprocessing.RawArray('Q', count * SEQUENCE_SLOT_STRIDE) # See next_sequence_number()
+    signal.signal(signal.SIGINT, signal_handler_function)
+    signal.signal(signal.SIGTERM, signal_handler_function)
+    workers = {} # pid -> index
+    restart_times = deque()
+    for index in range(count):
+        workers[spawn_worker(index, count)] = index
+    write_workers_file(workers)
+    log_activity(f"SUPERVISOR: {count} workers running.")
+
+    while keep_running:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid, status = 0, 0
+        if pid == 0:
+            time.sleep(SUPERVISOR_POLL_INTERVAL)
+            continue
+        index = workers.pop(pid, None)
+        if index is None or not keep_running:
+            continue
+        log_activity(f"SUPERVISOR: Worker {index} (PID {pid}) exited with status {status}. Restarting in {WORKER_RESTART_DELAY}s.")
+        now = time.monotonic()
+        restart_times.append(now)
+        while restart_times and now - restart_times[0] > 60:
+            restart_times.popleft()
+        if len(restart_times) > WORKER_MAX_RESTARTS_PER_MINUTE:
+            log_activity("SUPERVISOR: Workers are crash-looping. Shutting the group down.")
+            keep_running = False
+            break
+        time.sleep(WORKER_RESTART_DELAY)
+        if keep_running:
+            workers[spawn_worker(index, count)] = index
+            write_workers_file(workers)
+
+    stop_workers(workers)
+    remove_workers_file()
+
+def stop_workers(workers):
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+    while workers and time.monotonic() < deadline:
+        for pid in list(workers):
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+            if done:
+                workers.pop(pid)
+        if workers:
+            time.sleep(0.1)
+    for pid, index in workers.items():
+        log_activity(f"SUPERVISOR: Worker {index} (PID {pid}) did not stop in time. Sending SIGKILL.")
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+    log_activity("SUPERVISOR: All workers stopped.")
+
+# --- Control Socket (status / ready / stop for server_manager.py) ---
+# One JSON request per connection, newline-terminated ({"action": "status"} or just "status"), one JSON line back.
+# Served by a thread in the supervisor or single-process server, so it answers even while the event loop is busy.
+server_ready = threading.Event() # Set once the listeners are up (in --workers mode: once every worker reported in)
+ready_worker_pids = set()
+relay_loop = None # Event loop of a single-process server, for handing stop requests over to it
+control_server = None
+server_started_at = time.time()
+
+class ControlServer:
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path) # We hold the lock file, so any socket left here is stale
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(CONTROL_LISTEN_BACKLOG)
+        self.thread = threading.Thread(target=self.run, name="control-socket", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        log_activity(f"CONTROL: Listening on {self.path}")
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return # Socket closed
+            # "ready" may wait for the listeners, so each request gets its own short-lived thread
+            threading.Thread(target=self.serve_connection, args=(conn,), daemon=True).start()
+
+    def serve_connection(self, conn):
+        keep_open = False
+        try:
+            conn.settimeout(CONTROL_REQUEST_TIMEOUT)
+            data = b""
+            while b"\n" not in data and len(data) < CONTROL_MAX_REQUEST_BYTES:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            line = data.split(b"\n", 1)[0].strip()
+            try:
+                request = json.loads(line) if line.startswith(b"{") else {"action": line.decode('ascii', 'ignore')}
+            except ValueError:
+                request = {}
+            if request.get("action") == "handoff":
+                keep_open = True # Becomes the forwarding channel (handle_handoff_request closes it on failure)
+                handle_handoff_request(conn)
+                return
+            try:
+                response = handle_control_command(request)
+            except (TypeError, ValueError) as e:
+                response = {"status": "error", "message": f"Bad control request: {e}"}
+            conn.sendall(json.dumps(response).encode('utf-8') + b"\n")
+        except OSError as e:
+            log_activity(f"CONTROL: Request failed: {e}", LOG_WARNING)
+        finally:
+            if not keep_open:
+                conn.close()
+
+    def close(self):
+        self.sock.close()
+        if handed_off:
+            return # The path now belongs to the new process
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def handle_control_command(request):
+    action = request.get("action")
+    if action == "status":
+        return control_status()
+    if action == "ready":
+        timeout = min(float(request.get("timeout", 0)), CONTROL_REQUEST_TIMEOUT)
+        return {"ready": server_ready.wait(timeout), "pid": os.getpid()}
+    if action == "stop":
+        log_activity("CONTROL: Stop requested.")
+        if relay_loop is not None:
+            relay_loop.call_soon_threadsafe(request_shutdown, "Stop requested on the control socket")
+        else:
+            request_shutdown("Stop requested on the control socket")
+        return {"status": "stopping", "pid": os.getpid()}
+    if action == "spans":
+        return control_spans(request.get("enable"))
+    if action == "worker-ready":
+        ready_worker_pids.add(request.get("pid"))
+        if len(ready_worker_pids) >= worker_count:
+            server_ready.set()
+        return {"ok": True}
+    return {"status": "error", "message": f"Unknown control action: {action}"}
+
+def control_status():
+    status = {
+        "status": "running",
+        "pid": os.getpid(),
+        "uptime_seconds": round(time.time() - server_started_at, 1),
+        "ready": server_ready.is_set(),
+    }
+    if worker_count > 1:
+        status["workers"] = read_worker_pids()
+        summaries = [summary for summary in (fetch_worker_metrics(index) for index in range(worker_count)) if summary]
+        metrics = aggregate_metrics(summaries) if summaries else None
+    else:
+        metrics = metrics_summary()
+    if node_id is not None:
+        status["cluster"] = {"node": node_id, "links": sorted(peer_links)}
+    if metrics:
+        status["clients"] = metrics.get("ws_clients", 0)
+        status["metrics"] = metrics
+    return status
+
+def control_spans(enable):
+    # Workers are reached through their metrics endpoints; enable None only reports the current state.
+    if worker_count <= 1:
+        if enable is not None:
+            set_spans_enabled(bool(enable))
+        return {"pid": os.getpid(), "spans": spans_enabled}
+    query = "" if enable is None else f"?enable={int(bool(enable))}"
+    states = {}
+    for index in range(worker_count):
+        url = f"http://{METRICS_HOST}:{worker_metrics_port(index)}/spans{query}"
+        try:
+            with urllib.request.urlopen(url, timeout=CONTROL_METRICS_TIMEOUT) as response:
+                states[index] = json.loads(response.read())["spans"]
+        except (OSError, ValueError, KeyError):
+            states[index] = None # Not answering (restarting, or METRICS_PORT = 0)
+    return {"pid": os.getpid(), "spans": states}
+
+def read_worker_pids():
+    try:
+        with open(WORKERS_FILE) as f:
+            return [int(line) for line in f.read().split()]
+    except (IOError, ValueError):
+        return []
+
+def fetch_worker_metrics(index):
+    url = f"http://{METRICS_HOST}:{worker_metrics_port(index)}/metrics.json"
+    try:
+        with urllib.request.urlopen(url, timeout=CONTROL_METRICS_TIMEOUT) as response:
+            return json.loads(response.read())
+    except (OSError, ValueError):
+        return None
+
+def aggregate_metrics(summaries):
+    # Counters are summed over workers; latency and memory per client report the worst worker.
+    total = {}
+    for summary in summaries:
+        for name, value in summary.items():
+            if name in ("pid", "worker", "uptime_seconds"):
+                continue
+            if name == "latency_ms":
+                latency = total.setdefault(name, {"count": 0, "p50": 0, "p99": 0, "max": 0})
+                latency["count"] += value["count"]
+                for key in ("p50", "p99", "max"):
+                    latency[key] = max(latency[key], value[key])
+            elif name == "ws_memory_per_client_bytes":
+                total[name] = max(total.get(name, 0), value)
+            elif name == "stage_us":
+                stages = total.setdefault(name, {})
+                for stage, span in value.items():
+                    merged = stages.setdefault(stage, {"count": 0, "p50": 0, "p99": 0, "max": 0})
+                    merged["count"] += span["count"]
+                    for key in ("p50", "p99", "max"):
+                        merged[key] = max(merged[key], span[key])
+            elif isinstance(value, dict):
+                counts = total.setdefault(name, {})
+                for key, count in value.items():
+                    counts[key] = counts.get(key, 0) + count
+            else:
+                total[name] = total.get(name, 0) + value
+    total["uptime_seconds"] = max(summary["uptime_seconds"] for summary in summaries)
+    return total
+
+def start_control_server():
+    global control_server
+    try:
+        control_server = ControlServer(CONTROL_SOCKET)
+        control_server.start()
+    except OSError as e:
+        log_activity(f"CONTROL: Could not open {CONTROL_SOCKET}: {e}")
+        control_server = None
+
+def stop_control_server():
+    global control_server
+    if control_server:
+        control_server.close()
+        control_server = None
+
+def send_control_request(request, timeout=CONTROL_REQUEST_TIMEOUT):
+    # Used by workers to report readiness to their supervisor.
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(CONTROL_SOCKET)
+            sock.sendall(json.dumps(request).encode('utf-8') + b"\n")
+            return json.loads(sock.makefile('rb').readline() or b"null")
+    except (OSError, ValueError) as e:
+        log_activity(f"CONTROL: Request {request.get('action')} failed: {e}")
+        return None
+
+# --- Graceful Reload (listening-socket handoff, --takeover) ---
+# The new process connects to the running one's control socket and sends {"action": "handoff"}. On its event loop
+# the old process stops reading its listeners and passes them over (SCM_RIGHTS), followed by its sequence number
+# and replay buffer, so neither queued connections nor queued datagrams are lost. The old process then closes its
+# WebSocket clients with 1012 (they reconnect, with their resume cursor, to the new process). It keeps serving the
+# TCP producers it already has, for up to RELOAD_DRAIN_TIMEOUT, and forwards their messages over the same connection.
+handoff_channel = None # Old process: connection to the successor; broadcasts are forwarded there
+handed_off = False
+relay_listeners = {} # Set by serve_relay(): {"tcp": [...], "udp": [...], "metrics": server, "http": server, "peer": server, "local": (servers, endpoints)}
+predecessor_channel = None # New process: connection to the draining predecessor
+predecessor_buffer = bytearray()
+
+async def hand_off_listeners(conn):
+    global handoff_channel, handed_off
+    listeners, fds = [], []
+    ws_sock = ws_server_instance.detach_listener() if ws_server_instance else None
+    if ws_sock is not None:
+        listeners.append({"kind": "ws", "port": ws_sock.getsockname()[1]})
+        fds.append(ws_sock.detach())
+    for tcp_server in relay_listeners.get("tcp", []):
+        for transport_sock in tcp_server.sockets:
+            listeners.append({"kind": "tcp", "port": transport_sock.getsockname()[1]})
+            fds.append(os.dup(transport_sock.fileno()))
+        tcp_server.close() # Stops accepting; established connections stay with us
+    for engine in relay_listeners.get("udp", []):
+        for sock in engine.detach():
+            listeners.append({"kind": "udp", "port": engine.port})
+            fds.append(sock.detach())
+    # Unix sockets and rings are not handed over: the successor binds new ones at the same paths
+    stop_local_listeners(*relay_listeners.get("local", ((), ())))
+    for kind in ("metrics", "http", "peer"):
+        server = relay_listeners.get(kind)
+        if server:
+            for transport_sock in server.sockets:
+                listeners.append({"kind": kind, "port": transport_sock.getsockname()[1]})
+                fds.append(os.dup(transport_sock.fileno()))
+            server.close()
+
+    entries = list(replay_buffer.entries)
+    header = {"status": "ok", "pid": os.getpid(), "listeners": listeners, "last_seq": last_sequence_number, "replay": len(entries),
+              "replay_gap": replay_buffer.gap_seq}
+    try:
+        # Only the header (which carries the descriptors) goes out directly; it fits an empty socket buffer
+        conn.settimeout(HANDOFF_TIMEOUT)
+        socket.send_fds(conn, [json.dumps(header).encode('utf-8') + b"\n"], fds)
+    finally:
+        for fd in fds:
+            os.close(fd)
+    conn.setblocking(False)
+    _, handoff_channel = await asyncio.get_running_loop().create_unix_connection(SuccessorChannel, sock=conn)
+    handoff_channel.transport.writelines([b"[%d, %s]\n" % (seq, json.dumps(message_bytes.decode('utf-8')).encode('utf-8'))
+                                          for seq, message_bytes in entries])
+    handed_off = True
+    log_activity(f"RELOAD: Handed {len(listeners)} listening socket(s) and {len(entries)} replay message(s) to the new process. Draining.")
+    if ws_server_instance:
+        ws_server_instance.close_clients(1012, "Server restarting")
+    close_http_stream_clients()
+    close_peer_links() # The peers redial, and reach the new process on the inherited PEER_PORT
+    asyncio.ensure_future(drain_after_handoff())
+
+async def drain_after_handoff():
+    global handoff_channel
+    deadline = time.monotonic() + RELOAD_DRAIN_TIMEOUT
+    while tcp_client_transports and time.monotonic() < deadline:
+        await asyncio.sleep(0.2)
+    if tcp_client_transports:
+        log_activity(f"RELOAD: Closing {len(tcp_client_transports)} TCP connection(s) still open after {RELOAD_DRAIN_TIMEOUT}s.")
+    # Whatever is still buffered for the successor goes out before we exit
+    while handoff_channel is not None and handoff_channel.transport.get_write_buffer_size() and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    if handoff_channel is not None:
+        channel, handoff_channel = handoff_channel, None
+        channel.transport.close()
+    request_shutdown("Drained after handing over to the new process")
+
+class SuccessorChannel(asyncio.Protocol):
+    # Old process: the handoff connection once the descriptors are across. Forwarded messages are written without
+    # blocking; when the new process falls behind, the TCP producers we are still draining stop being read until
+    # it catches up, so the backlog is bounded by what those producers had in flight.
+    def __init__(self):
+        self.transport = None
+        self.write_paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def pause_writing(self):
+        if not self.write_paused:
+            self.write_paused = True
+            log_activity(f"RELOAD: The new process is behind; pausing {len(tcp_client_transports)} TCP producer(s).")
+            for transport in tcp_client_transports:
+                transport.pause_reading()
+
+    def resume_writing(self):
+        self.write_paused = False
+        for transport in tcp_client_transports:
+            if not transport.get_protocol().write_paused and not transport.is_closing():
+                transport.resume_reading()
+
+    def data_received(self, data):
+        pass
+
+    def connection_lost(self, exc):
+        global handoff_channel
+        if handoff_channel is self:
+            log_activity(f"RELOAD: Lost the connection to the new process ({exc or 'closed by peer'}); dropping the channel.")
+            handoff_channel = None
+        self.resume_writing()
+
+def successor_write_paused():
+    return handoff_channel is not None and handoff_channel.write_paused
+
+def forward_to_successor(message_data_dict, received_at):
+    if not handoff_channel.transport.is_closing():
+        handoff_channel.transport.write(json.dumps({"message": message_data_dict, "received_at": received_at}).encode('utf-8') + b"\n")
+
+def handle_handoff_request(conn):
+    # Called on the control-socket thread; the work itself happens on the event loop.
+    if relay_loop is None or not server_ready.is_set() or handed_off:
+        conn.sendall(json.dumps({"status": "error", "message": "Handoff needs a running single-process server."}).encode('utf-8') + b"\n")
+        conn.close()
+        return
+    log_activity("RELOAD: Handoff requested by a new process.")
+    try:
+        asyncio.run_coroutine_threadsafe(hand_off_listeners(conn), relay_loop).result(HANDOFF_TIMEOUT)
+    except Exception as e:
+        log_activity(f"RELOAD: Handoff failed: {e}")
+        conn.close()
+
+def receive_handoff():
+    # --takeover: returns the inherited listening sockets as {"ws": sock, "tcp": {port: sock}, "udp": {port: [socks]}, "metrics": sock, "http": sock, "peer": sock}.
+    global predecessor_channel, last_sequence_number
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(HANDOFF_TIMEOUT)
+    sock.connect(CONTROL_SOCKET)
+    sock.sendall(b'{"action": "handoff"}\n')
+    data, fds, _, _ = socket.recv_fds(sock, 65536, HANDOFF_MAX_FDS)
+    buffer = bytearray(data)
+
+    def read_line():
+        while b"\n" not in buffer:
+            chunk = sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("previous server closed the handoff connection")
+            buffer.extend(chunk)
+        line, _, rest = bytes(buffer).partition(b"\n")
+        buffer[:] = rest
+        return line
+
+    header = json.loads(read_line())
+    if header.get("status") != "ok":
+        raise RuntimeError(header.get("message", "handoff refused"))
+    inherited = {"ws": None, "tcp": {}, "udp": {}, "metrics": None, "http": None, "peer": None}
+    for listener, fd in zip(header["listeners"], fds):
+        family, kind = (socket.AF_INET, socket.SOCK_DGRAM) if listener["kind"] == "udp" else (socket.AF_INET, socket.SOCK_STREAM)
+        inherited_sock = socket.socket(family, kind, fileno=fd)
+        if listener["kind"] in ("ws", "metrics", "http", "peer"):
+            inherited[listener["kind"]] = inherited_sock
+        elif listener["kind"] == "tcp":
+            inherited["tcp"][listener["port"]] = inherited_sock
+        else:
+            inherited["udp"].setdefault(listener["port"], []).append(inherited_sock)
+    for _ in range(header["replay"]):
+        seq, message = json.loads(read_line())
+        replay_buffer.append(seq, message.encode('utf-8'))
+    last_sequence_number = header["last_seq"]
+    replay_buffer.gap_seq = header.get("replay_gap", replay_buffer.entries[0][0] - 1 if replay_buffer.entries else last_sequence_number)
+    predecessor_channel = sock
+    predecessor_buffer.extend(buffer)
+    log_activity(f"RELOAD: Took over {len(fds)} listening socket(s) and {header['replay']} replay message(s) from PID {header['pid']}.")
+    return inherited
+
+def attach_predecessor_channel(loop):
+    if predecessor_channel is None:
+        return
+    predecessor_channel.setblocking(False)
+    loop.add_reader(predecessor_channel.fileno(), on_predecessor_readable)
+    if predecessor_buffer:
+        loop.call_soon(deliver_forwarded_messages)
+
+def on_predecessor_readable():
+    global predecessor_channel
+    try:
+        chunk = predecessor_channel.recv(65536)
+    except (BlockingIOError, InterruptedError):
+        return
+    except OSError:
+        chunk = b""
+    if not chunk:
+        log_activity("RELOAD: Previous process finished draining.")
+        asyncio.get_running_loop().remove_reader(predecessor_channel.fileno())
+        predecessor_channel.close()
+        predecessor_channel = None
+        return
+    predecessor_buffer.extend(chunk)
+    deliver_forwarded_messages()
+
+def deliver_forwarded_messages():
+    # Messages the previous process ingested while draining get their sequence number here.
+    lines = predecessor_buffer.split(b"\n")
+    predecessor_buffer[:] = lines.pop()
+    for line in lines:
+        try:
+            forwarded = json.loads(line)
+            forwarded["message"].pop("seq", None)
+            broadcast_message_to_clients(forwarded["message"], forwarded.get("received_at"))
+        except (ValueError, KeyError, TypeError) as e:
+            log_activity(f"RELOAD: Bad forwarded message: {e}")
+
+def take_over_lock_file():
+    try:
+        with open(LOCK_FILE, "w") as f: f.write(str(os.getpid()))
+        log_activity(f"LOCK: File {LOCK_FILE} taken over by PID {os.getpid()}.")
+        return True
+    except IOError as e:
+        log_activity(f"LOCK: Error taking over lock file {LOCK_FILE}: {e}")
+        return False
+
 # --- Signal Handling for Graceful Shutdown ---
 def signal_handler_function(signum, frame):
-    global keep_running, ws_server_instance
     signal_name = signal.Signals(signum).name
     log_activity(f"SIGNAL: Received {signal_name}. Initiating shutdown...")
+    request_shutdown()
+
+def request_shutdown(reason=None):
+    global keep_running
+    if reason:
+        log_activity(f"SERVER: {reason}. Initiating shutdown...")
     keep_running = False 
-    if ws_server_instance:
-        log_activity("SIGNAL: Closing WebSocket server instance...")
-        ws_server_instance.close() 
+    if shutdown_event:
+        shutdown_event.set() # serve_relay() closes the listeners and WebSocket server
+
+def raise_open_files_limit():
+    # Every TCP producer and WebSocket client is a file descriptor; the default soft limit (1024) is far too low.
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > soft:
+            target = hard if hard != resource.RLIM_INFINITY else 1048576
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            log_activity(f"SERVER: RLIMIT_NOFILE raised from {soft} to {target}.")
+    except (ValueError, OSError) as e:
+        log_activity(f"SERVER: Could not raise RLIMIT_NOFILE: {e}")
 
 # --- Main Server Logic ---
+async def serve_relay(inherited=None):
+    # inherited: listening sockets from receive_handoff() when taking over from a running server
+    global ws_server_instance, shutdown_event, relay_loop
+    inherited = inherited or {}
+    loop = asyncio.get_running_loop()
+    if worker_index is None:
+        relay_loop = loop
+    shutdown_event = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, signal_handler_function, signum, None)
+
+    tcp_servers = []
+    udp_engines = []
+    local_servers, local_endpoints = [], []
+    stats_task = None
+    supervisor_task = None
+    metrics_server = None
+    http_server = None
+    peer_server = None
+    try:
+        ws_server_instance = LoopWebSocketServer(HOST, WEBSOCKET_PORT, ClientConnectionHandler, reuse_port=worker_index is not None,
+                                                 sock=inherited.get("ws")) 
+        ws_server_instance.attach_to_loop(loop)
+        connection_wheel.start(loop)
+        if worker_index is not None:
+            open_worker_bus(loop)
+            supervisor_task = asyncio.ensure_future(watch_supervisor())
+        log_activity(f"WS: Server instance created for ws://{HOST}:{WEBSOCKET_PORT}")
+
+        open_journal() # Before the listeners, so every ingested message is journaled
+        tcp_servers = await start_tcp_listeners(inherited.get("tcp"))
+        udp_engines = await start_udp_listeners(inherited.get("udp"))
+        local_servers, local_endpoints = await start_local_listeners()
+        stats_task = asyncio.ensure_future(log_stats_periodically())
+        metrics_server = await start_metrics_server(inherited.get("metrics"))
+        http_server = await start_http_stream_server(inherited.get("http"))
+        peer_server = await start_cluster(inherited.get("peer"))
+        relay_listeners.update(tcp=tcp_servers, udp=udp_engines, metrics=metrics_server, http=http_server, peer=peer_server,
+                               local=(local_servers, local_endpoints))
+        attach_predecessor_channel(loop)
+        record_memory_baseline()
+        if worker_index is None:
+            server_ready.set()
+        else:
+            await loop.run_in_executor(None, send_control_request, {"action": "worker-ready", "worker": worker_index, "pid": os.getpid()})
+        log_activity("SERVER: TCP and UDP listeners started.")
+
+        log_activity("SERVER: Event loop running (WebSocket, TCP and UDP on one loop)...")
+        await shutdown_event.wait()
+        log_activity("SERVER: Event loop leaving serve state (shutdown requested).")
+    finally:
+        stop_local_listeners(local_servers, local_endpoints)
+        if tcp_servers:
+            for tcp_server in tcp_servers:
+                tcp_server.close()
+            for transport in list(tcp_client_transports):
+                transport.close()
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*(tcp_server.wait_closed() for tcp_server in tcp_servers)),
+                    timeout=SHUTDOWN_GRACE_SECONDS
+                )
+            except asyncio.TimeoutError:
+                log_activity("SERVER: Timed out waiting for TCP connections to close.")
+            log_activity("TCP: Listener socket(s) closed.")
+        if stats_task:
+            stats_task.cancel()
+        connection_wheel.stop()
+        close_journal()
+        if metrics_server:
+            metrics_server.close()
+        if http_server:
+            http_server.close()
+        close_http_stream_clients()
+        if peer_server:
+            peer_server.close()
+        close_peer_links()
+        if supervisor_task:
+            supervisor_task.cancel()
+        close_worker_bus(loop)
+        if udp_engines:
+            for engine in udp_engines:
+                engine.close()
+            log_activity(f"UDP: Listener socket(s) closed. Stats: {format_udp_stats()}")
+        if ws_server_instance:
+            log_activity("SERVER: Closing WebSocket server instance...")
+            ws_server_instance.close() 
+
+# --- Encoder Benchmark (--benchmark-encoders) ---
+def time_per_message(encode_one, count):
+    started = time.perf_counter_ns()
+    for i in range(count):
+        encode_one(i)
+    return (time.perf_counter_ns() - started) / count
+
+def run_encoder_benchmark(count=ENCODE_BENCHMARK_MESSAGES, data_size=64):
+    # Per-message cost of building and encoding one broadcast payload, as broadcast_message_to_clients does,
+    # for the previous path (isoformat per message + json.dumps of the dict) and for every available backend.
+    global json_encoder_name, json_dumps, encode_message_payload
+    addr = ("192.168.10.20", 50123)
+    text = ("sensor reading " * (data_size // 15 + 1))[:data_size]
+
+    def legacy(seq):
+        message = {"type": "tcp", "ip": addr[0], "port": addr[1],
+                   "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(), "data": text}
+        message["seq"] = seq
+        return json.dumps(message).encode('utf-8')
+
+    def dict_dump(seq):
+        message = build_message_payload("tcp", addr, text)
+        message["seq"] = seq
+        return json_dumps(message)
+
+    def templated(seq):
+        message = build_message_payload("tcp", addr, text)
+        message["seq"] = seq
+        return encode_templated_payload(message)
+
+    results = {"messages": count, "data_bytes": data_size, "ns_per_message": {}}
+    results["ns_per_message"]["json, isoformat + dumps(dict) (previous)"] = round(time_per_message(legacy, count))
+    configured = (json_encoder_name, json_dumps, encode_message_payload)
+    try:
+        for name in JSON_ENCODERS[1:]:
+            try:
+                json_encoder_name, json_dumps, encode_message_payload = load_json_encoder(name)
+            except ValueError:
+                results["ns_per_message"][name] = None # Not installed
+                continue
+            payload_templates.clear()
+            used = "dict" if encode_message_payload is json_dumps else "template"
+            results["ns_per_message"][f"{name}, cached timestamp + dumps(dict)" + (" (used)" if used == "dict" else "")] = \
+                round(time_per_message(dict_dump, count))
+            results["ns_per_message"][f"{name}, cached timestamp + template" + (" (used)" if used == "template" else "")] = \
+                round(time_per_message(templated, count))
+    finally:
+        json_encoder_name, json_dumps, encode_message_payload = configured
+        payload_templates.clear()
+    return results
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="TCP/UDP to WebSocket message relay.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes sharing the ports via SO_REUSEPORT (default: 1, no supervisor).")
+    parser.add_argument("--ack-mode", choices=ACK_MODES,
+                        help=f"ACK mode for listeners that do not set one in TCP_LISTENERS/UDP_LISTENERS (default: {ACK_MODE}).")
+    parser.add_argument("--batch-window-ms", type=float,
+                        help=f"Coalesce broadcasts into one frame per client per window (default: {WS_BATCH_WINDOW_MS}, 0 = off).")
+    parser.add_argument("--json-encoder", choices=JSON_ENCODERS,
+                        help=f"JSON backend for broadcast payloads (default: {JSON_ENCODER}).")
+    parser.add_argument("--benchmark-encoders", action="store_true",
+                        help=f"Time the payload encoders, write the results to {ENCODE_BENCHMARK_FILE} and exit.")
+    parser.add_argument("--takeover", action="store_true",
+                        help="Graceful reload: take the listening sockets over from the running server, which then drains and exits.")
+    parser.add_argument("--node-id", help="This node's name in a cluster (default: <hostname>:<WebSocket port>).")
+    parser.add_argument("--peer", action="append", metavar="HOST:PORT",
+                        help="Another relay node's peer port to link to; repeat for several (adds to PEERS).")
+    parser.add_argument("--peer-port", type=int, help=f"Accept links from other nodes on this port (default: {PEER_PORT}, 0 = none).")
+    parser.add_argument("--port-offset", type=int, default=0,
+                        help="Add this to every listening port, to run several nodes on one host (each with its own RELAY_TMP_DIR).")
+    return parser.parse_args()
+
+def apply_port_offset(offset):
+    global WEBSOCKET_PORT, TCP_PORT, UDP_PORT, HTTP_STREAM_PORT, METRICS_PORT, METRICS_WORKER_PORT_BASE, PEER_PORT
+    WEBSOCKET_PORT += offset
+    TCP_PORT += offset
+    UDP_PORT += offset
+    for listener in TCP_LISTENERS + UDP_LISTENERS:
+        listener["port"] += offset
+    # Disabled endpoints (port 0) stay disabled
+    HTTP_STREAM_PORT = HTTP_STREAM_PORT and HTTP_STREAM_PORT + offset
+    METRICS_PORT = METRICS_PORT and METRICS_PORT + offset
+    METRICS_WORKER_PORT_BASE += offset
+    PEER_PORT = PEER_PORT and PEER_PORT + offset
+
+def port_conflicts(workers):
+    # Every port this configuration listens on, by protocol; a port claimed twice would fail to bind in one of its users
+    tcp_ports = [("WebSocket", WEBSOCKET_PORT), ("HTTP streaming", HTTP_STREAM_PORT), ("peer", PEER_PORT)]
+    tcp_ports += [("TCP listener", listener["port"]) for listener in TCP_LISTENERS]
+    if workers > 1:
+        tcp_ports += [(f"worker {index} metrics", worker_metrics_port(index) if METRICS_PORT else 0) for index in range(workers)]
+    else:
+        tcp_ports.append(("metrics", METRICS_PORT))
+    udp_ports = [("UDP listener", listener["port"]) for listener in UDP_LISTENERS]
+    conflicts = []
+    for protocol, ports in (("TCP", tcp_ports), ("UDP", udp_ports)):
+        claimed = {}
+        for name, port in ports:
+            if not port:
+                continue
+            if port in claimed:
+                conflicts.append(f"{protocol} port {port} is configured for both {claimed[port]} and {name}")
+            else:
+                claimed[port] = name
+    return conflicts
+
 def main():
-    global ws_server_instance, keep_running
+    global keep_running, ACK_MODE, WS_BATCH_WINDOW_MS, JSON_ENCODER, json_encoder_name, json_dumps, encode_message_payload
+    global NODE_ID, PEERS, PEER_PORT
         
+    args = parse_command_line()
+    if args.port_offset:
+        apply_port_offset(args.port_offset)
+    if args.node_id:
+        NODE_ID = args.node_id
+    if args.peer:
+        PEERS = PEERS + args.peer
+    if args.peer_port is not None:
+        PEER_PORT = args.peer_port
+    if args.ack_mode:
+        ACK_MODE = args.ack_mode
+    if args.batch_window_ms is not None:
+        WS_BATCH_WINDOW_MS = args.batch_window_ms
+        coalescer.window = WS_BATCH_WINDOW_MS / 1000.0
+    start_activity_log_writer()
+    if args.json_encoder:
+        JSON_ENCODER = args.json_encoder
+        try:
+            json_encoder_name, json_dumps, encode_message_payload = load_json_encoder(JSON_ENCODER)
+        except ValueError as e:
+            log_activity(f"SERVER: {e}. Exiting.")
+            stop_activity_log_writer()
+            sys.exit(1)
+    if args.benchmark_encoders:
+        results = run_encoder_benchmark()
+        with open(ENCODE_BENCHMARK_FILE, "w") as f:
+            json.dump(results, f, indent=2)
+        for case, cost in results["ns_per_message"].items():
+            log_activity(f"BENCHMARK: {case}: {'not installed' if cost is None else f'{cost} ns/message'}")
+        stop_activity_log_writer()
+        return
     log_activity(f"SERVER: Starting up. PID: {os.getpid()}")
     log_activity(f"SERVER: Base Project Path: {BASE_PROJECT_PATH}")
     log_activity(f"SERVER: Temp Dir: {TMP_DIR}")
+    log_activity(f"SERVER: JSON encoder: {json_encoder_name}")
+
+    conflicts = port_conflicts(args.workers)
+    if conflicts:
+        log_activity(f"SERVER: Port conflict: {'; '.join(conflicts)}. Exiting.")
+        stop_activity_log_writer()
+        sys.exit(1)
+    if args.workers > 1 and (PEER_PORT or PEERS):
+        log_activity("PEER: Cluster peering is only supported for a single-process server. Exiting.")
+        stop_activity_log_writer()
+        sys.exit(1)
+    try:
+        for text in PEERS:
+            parse_peer_address(text)
+    except ValueError as e:
+        log_activity(f"PEER: {e}. Exiting.")
+        stop_activity_log_writer()
+        sys.exit(1)
 
-    if not create_lock_file():
+    inherited = None
+    if args.takeover:
+        if args.workers > 1:
+            log_activity("RELOAD: --takeover is only supported for a single-process server. Exiting.")
+            sys.exit(1)
+        try:
+            inherited = receive_handoff()
+        except (OSError, ValueError, RuntimeError) as e:
+            log_activity(f"RELOAD: Takeover failed ({e}). Exiting; the running server keeps serving.")
+            sys.exit(1)
+        take_over_lock_file()
+    elif not create_lock_file():
         log_activity("SERVER: Could not acquire lock. Exiting.")
         sys.exit(1) 
     
     write_pid_file() 
-
-    signal.signal(signal.SIGINT, signal_handler_function)
-    signal.signal(signal.SIGTERM, signal_handler_function)
-
-    tcp_thread = None
-    udp_thread = None
+    raise_open_files_limit()
+    start_control_server()
+    install_diagnostic_signals() # SIGINT/SIGTERM are set up by serve_relay() or supervise_workers()
 
     try:
-        ws_server_instance = WebSocketServer(HOST, WEBSOCKET_PORT, ClientConnectionHandler) 
-        log_activity(f"WS: Server instance created for ws://{HOST}:{WEBSOCKET_PORT}")
-
-        tcp_thread = threading.Thread(target=tcp_listener_main_loop, daemon=True)
-        udp_thread = threading.Thread(target=udp_listener_main_loop, daemon=True)
-
-        tcp_thread.start()
-        udp_thread.start()
-        log_activity("SERVER: TCP and UDP listener threads started.")
-
-        log_activity("WS: Entering serve_forever loop...")
-        ws_server_instance.serve_forever() 
-
-        log_activity("WS: Exited serve_forever loop (server was closed by signal).")
+        if args.workers > 1:
+            log_activity(f"SERVER: Supervising {args.workers} worker processes.")
+            supervise_workers(args.workers)
+        else:
+            asyncio.run(serve_relay(inherited))
+            log_activity("SERVER: Event loop finished.")
 
     except SystemExit: 
         log_activity("SERVER: SystemExit caught. Proceeding with cleanup.")
@@ -323,17 +4761,12 @@ def main():
     finally:
         log_activity("SERVER: Entering finally block for cleanup.")
         keep_running = False 
-        
-        if tcp_thread and tcp_thread.is_alive():
-            log_activity("SERVER: Waiting for TCP thread to finish...")
-            tcp_thread.join(timeout=1.5)
-        if udp_thread and udp_thread.is_alive():
-            log_activity("SERVER: Waiting for UDP thread to finish...")
-            udp_thread.join(timeout=1.5)
+        stop_control_server()
             
         remove_pid_file()
         remove_lock_file() 
         log_activity("SERVER: Shutdown complete.")
+        stop_activity_log_writer() # Flushes every queued line before the process exits
 
 if __name__ == "__main__":
     main()
@@ -1,11 +1,12 @@
 #!/usr/bin/python3
-import cgi
 import json
 import os
+import signal
+import socket
 import subprocess
 import sys
-import psutil 
 import time
+import urllib.parse
 
 # --- Configuration ---
 # Assumes this script is in /var/www/html/aa/aa11/py/
@@ -15,14 +16,23 @@ SERVER_SCRIPT_PATH = os.path.join(CURRENT_SCRIPT_DIR, "server.py")
 PROJECT_ROOT_PATH = os.path.abspath(os.path.join(CURRENT_SCRIPT_DIR, '..')) # Should be /var/www/html/aa/aa11
 PROJECT_SUBDIR_NAME_FOR_LOGGING = os.path.basename(PROJECT_ROOT_PATH) # Should be "aa11"
 
-TMP_DIR = os.path.join(PROJECT_ROOT_PATH, "tmp")
+TMP_DIR = os.path.abspath(os.environ.get("RELAY_TMP_DIR") or os.path.join(PROJECT_ROOT_PATH, "tmp")) # Same rule as server.py, which it launches with this environment
 PID_FILE = os.path.join(TMP_DIR, "message_server.pid")
 LOCK_FILE = os.path.join(TMP_DIR, "message_server.lock")
+WORKERS_FILE = os.path.join(TMP_DIR, "message_server.workers") # Written by server.py in --workers mode
+CONTROL_SOCKET = os.path.join(TMP_DIR, "message_server.control.sock") # server.py answers status / ready / stop here
 # ACTIVITY_LOG is managed by server.py; this script might check it.
 ACTIVITY_LOG_SERVER = os.path.join(TMP_DIR, "message_server_activity.txt")
 
 
 PYTHON_EXECUTABLE = sys.executable 
+SERVER_ARGS = [] # Extra server.py arguments, e.g. ["--workers", "4"] to use one worker process per core
+CONTROL_TIMEOUT = 2.0 # For status and stop requests on the control socket
+SERVER_START_TIMEOUT = 10.0 # Longest start_server() waits for the server to report ready
+SERVER_STOP_TIMEOUT = 8.0 # Longest stop_server() waits after a control-socket stop before falling back to signals
+# The CGI is anonymous: anything not listed here (reload, and the stacks / profile / spans diagnostics) is refused
+# over the web and only runs from a shell on the server, e.g. "python3 server_manager.py spans enable=on".
+WEB_ACTIONS = ("start", "stop", "status")
 
 def log_manager_activity(message):
     # This output (stderr) usually goes to Apache's error log for CGI scripts
@@ -42,9 +52,72 @@ def cleanup_stale_files(reason=""):
             log_manager_activity("Stale LOCK_FILE removed.")
         except OSError as e:
             log_manager_activity(f"Error removing stale LOCK_FILE: {e}")
+    if os.path.exists(WORKERS_FILE):
+        try:
+            os.remove(WORKERS_FILE)
+            log_manager_activity("Stale WORKERS_FILE removed.")
+        except OSError as e:
+            log_manager_activity(f"Error removing stale WORKERS_FILE: {e}")
+
+def read_worker_pids():
+    # Worker PIDs of a --workers server group; empty for a single-process server.
+    if not os.path.exists(WORKERS_FILE):
+        return []
+    try:
+        with open(WORKERS_FILE, 'r') as f:
+            return [int(line) for line in f.read().split() if line.strip()]
+    except (IOError, ValueError) as e:
+        log_manager_activity(f"Error reading WORKERS_FILE: {e}")
+        return []
+
+def stop_orphan_workers():
+    # Workers exit on their own when the supervisor dies, but make sure none outlives a SIGKILLed supervisor.
+    psutil = psutil_module()
+    for worker_pid in read_worker_pids():
+        try:
+            if psutil.pid_exists(worker_pid):
+                log_manager_activity(f"Terminating leftover worker {worker_pid}.")
+                psutil.Process(worker_pid).terminate()
+        except psutil.Error as e:
+            log_manager_activity(f"Error terminating worker {worker_pid}: {e}")
+
 
+def psutil_module():
+    # Only the fallback paths (server not answering on the control socket) need psutil, so import it on demand.
+    import psutil
+    return psutil
+
+def control_request(action, socket_timeout=CONTROL_TIMEOUT, **fields):
+    # Returns the server's JSON reply, or None when nothing answers on the control socket.
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(socket_timeout)
+            sock.connect(CONTROL_SOCKET)
+            sock.sendall(json.dumps({"action": action, **fields}).encode('utf-8') + b"\n")
+            reply = sock.makefile('rb').readline()
+        return json.loads(reply) if reply else None
+    except (OSError, ValueError) as e:
+        log_manager_activity(f"Control socket request '{action}' got no answer: {e}")
+        return None
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
 
 def get_server_status():
+    status_info = control_request("status")
+    if status_info:
+        return status_info
+    return get_server_status_from_files()
+
+def get_server_status_from_files():
+    # Fallback when the control socket does not answer: PID/lock files and the process table.
+    psutil = psutil_module()
     log_manager_activity(f"Checking status. PID file: {PID_FILE}, Lock file: {LOCK_FILE}")
     pid_from_file = None
     if os.path.exists(PID_FILE):
@@ -72,7 +145,11 @@ def get_server_status():
                 
                 if is_our_script:
                     log_manager_activity(f"Process {pid_from_file} is active and matches server script: {cmdline}")
-                    return {"status": "running", "pid": pid_from_file}
+                    status_info = {"status": "running", "pid": pid_from_file}
+                    workers = [worker_pid for worker_pid in read_worker_pids() if psutil.pid_exists(worker_pid)]
+                    if workers:
+                        status_info["workers"] = workers
+                    return status_info
                 else:
                     log_manager_activity(f"Process {pid_from_file} is active but command line ({cmdline}) doesn't match our server. Stale PID?")
                     if not os.path.exists(LOCK_FILE):
@@ -129,37 +206,13 @@ def start_server():
              return {"status": "already_running", "pid": status_info.get("pid"), "message": "Server was already running (revealed after lock cleanup)."}
 
     try:
-        log_manager_activity(f"Executing: {PYTHON_EXECUTABLE} {SERVER_SCRIPT_PATH}")
-
-        # --- BEGIN PYTHONPATH MODIFICATION ---
-        my_env = os.environ.copy() 
-        # This is where pip3 installed SimpleWebSocketServer for Python 3.12 on your system
-        path_to_local_libs = "/usr/local/lib/python3.12/dist-packages" 
-
-        current_pythonpath = my_env.get("PYTHONPATH", "")
-        if path_to_local_libs not in current_pythonpath.split(os.pathsep):
-            if current_pythonpath: # if PYTHONPATH already has something
-                my_env["PYTHONPATH"] = f"{path_to_local_libs}{os.pathsep}{current_pythonpath}"
-            else: # if PYTHONPATH was empty or not set
-                my_env["PYTHONPATH"] = path_to_local_libs
-        
-        log_manager_activity(f"Using PYTHONPATH for Popen: {my_env.get('PYTHONPATH')}")
-        # --- END PYTHONPATH MODIFICATION ---
-
-        process = subprocess.Popen(
-            [PYTHON_EXECUTABLE, SERVER_SCRIPT_PATH],
-            env=my_env, # Pass the modified environment to the subprocess
-            start_new_session=True 
-        )
-        log_manager_activity(f"Popen called. Server.py process group started (Popen PID: {process.pid}). Server should manage its own PID/Lock files now.")
+        process = launch_server_process()
         
-        time.sleep(2.5) 
-        
-        status_after_start = get_server_status()
-        if status_after_start["status"] == "running":
-             return {"status": "started", "pid": status_after_start.get("pid"), "message": "Server started successfully and reported running."}
+        ready_info = wait_until_ready(process)
+        if ready_info:
+             return {"status": "started", "pid": ready_info.get("pid"), "message": "Server started successfully and reported ready."}
         else:
-            log_manager_activity(f"Server did NOT start correctly. Post-start status: {status_after_start.get('status', 'unknown')}. Check server activity log: {ACTIVITY_LOG_SERVER}")
+            log_manager_activity(f"Server did NOT report ready within {SERVER_START_TIMEOUT}s (exit code: {process.poll()}). Check server activity log: {ACTIVITY_LOG_SERVER}")
             activity_details = ""
             if os.path.exists(ACTIVITY_LOG_SERVER):
                 try:
@@ -176,8 +229,83 @@ def start_server():
         log_manager_activity(f"Exception during Popen or server start: {e}")
         return {"status": "error_popen", "message": f"Failed to start server process: {str(e)}"}
 
+def reload_server():
+    # Graceful reload: a new server.py takes the listening sockets over from the running one, which then drains.
+    log_manager_activity("Attempting graceful reload...")
+    status_info = control_request("status")
+    if not status_info:
+        return {"status": "not_running", "message": "No server answering on the control socket; use start."}
+    if status_info.get("workers"):
+        return {"status": "error_reload_unsupported", "message": "Graceful reload needs a single-process server (no --workers)."}
+    try:
+        process = launch_server_process(["--takeover"])
+    except Exception as e:
+        log_manager_activity(f"Exception during Popen for reload: {e}")
+        return {"status": "error_popen", "message": f"Failed to start server process: {str(e)}"}
+    ready_info = wait_until_ready(process)
+    if ready_info:
+        return {"status": "reloaded", "pid": ready_info.get("pid"), "previous_pid": status_info.get("pid"),
+                "message": "New server took over; the previous one is draining its connections."}
+    log_manager_activity(f"Reload did NOT complete within {SERVER_START_TIMEOUT}s (exit code: {process.poll()}). Check server activity log: {ACTIVITY_LOG_SERVER}")
+    return {"status": "error_reloading", "message": "New server did not take over; the previous one keeps serving."}
+
+def launch_server_process(extra_args=()):
+    command = [PYTHON_EXECUTABLE, SERVER_SCRIPT_PATH] + SERVER_ARGS + list(extra_args)
+    log_manager_activity(f"Executing: {' '.join(command)}")
+
+    # --- BEGIN PYTHONPATH MODIFICATION ---
+    my_env = os.environ.copy() 
+    # This is where pip3 installed SimpleWebSocketServer for Python 3.12 on your system
+    path_to_local_libs = "/usr/local/lib/python3.12/dist-packages" 
+
+    current_pythonpath = my_env.get("PYTHONPATH", "")
+    if path_to_local_libs not in current_pythonpath.split(os.pathsep):
+        if current_pythonpath: # if PYTHONPATH already has something
+            my_env["PYTHONPATH"] = f"{path_to_local_libs}{os.pathsep}{current_pythonpath}"
+        else: # if PYTHONPATH was empty or not set
+            my_env["PYTHONPATH"] = path_to_local_libs
+    
+    log_manager_activity(f"Using PYTHONPATH for Popen: {my_env.get('PYTHONPATH')}")
+    # --- END PYTHONPATH MODIFICATION ---
+
+    process = subprocess.Popen(
+        command,
+        env=my_env, # Pass the modified environment to the subprocess
+        start_new_session=True 
+    )
+    log_manager_activity(f"Popen called. Server.py process group started (Popen PID: {process.pid}). Server should manage its own PID/Lock files now.")
+    return process
+
+def wait_until_ready(process):
+    # The server answers "ready" once its listeners are up; until it binds the control socket, connects just fail.
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return None # Exited (lock held by another instance, port in use, ...)
+        if os.path.exists(CONTROL_SOCKET):
+            remaining = deadline - time.monotonic()
+            reply = control_request("ready", socket_timeout=remaining + 1, timeout=remaining)
+            # On reload the previous server answers until the new one binds the socket, hence the PID check
+            if reply and reply.get("ready") and reply.get("pid") == process.pid:
+                return reply
+        time.sleep(0.05)
+    return None
+
 def stop_server():
     log_manager_activity("Attempting to stop server...")
+    reply = control_request("stop")
+    if reply and reply.get("pid"):
+        deadline = time.monotonic() + SERVER_STOP_TIMEOUT
+        while pid_alive(reply["pid"]) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if not pid_alive(reply["pid"]):
+            log_manager_activity(f"Server {reply['pid']} stopped via the control socket.")
+            return {"status": "stopped", "message": "Server stopped."}
+        log_manager_activity(f"Server {reply['pid']} still running {SERVER_STOP_TIMEOUT}s after the stop request. Signalling it.")
+    return stop_server_with_signals()
+
+def stop_server_with_signals():
+    psutil = psutil_module()
     pid_to_stop = None
 
     if os.path.exists(PID_FILE):
@@ -226,6 +354,7 @@ def stop_server():
                     log_manager_activity(f"Process {pid_to_stop} (SIGTERM timeout), sending SIGKILL...")
                     proc.kill() 
                     log_manager_activity(f"Process {pid_to_stop} killed with SIGKILL.")
+                    stop_orphan_workers()
                 
                 time.sleep(0.5) 
                 cleanup_stale_files("Post-stop command by manager")
@@ -246,25 +375,70 @@ def stop_server():
         cleanup_stale_files("PID from file not active during stop")
         return {"status": "already_stopped", "message": "Server was not running (PID not active)."}
 
-def main():
-    print("Content-Type: application/json")
-    print() 
+def signal_server(signum, message):
+    # SIGUSR1: stack dump, SIGUSR2: sampling profile; server.py writes both to TMP_DIR and logs the file name.
+    try:
+        with open(PID_FILE, 'r') as f:
+            pid = int(f.read().strip())
+        os.kill(pid, signum)
+    except (IOError, ValueError, OSError) as e:
+        log_manager_activity(f"Could not send {signum.name} to the server: {e}")
+        return {"status": "error", "message": f"Could not signal the server: {e}"}
+    log_manager_activity(f"Sent {signum.name} to server {pid}.")
+    return {"status": "signalled", "pid": pid, "message": message}
 
-    form = cgi.FieldStorage()
-    action = form.getvalue("action")
-    response = {}
-    
-    log_manager_activity(f"Received action: {action}")
+def set_spans(enable):
+    # enable: "on", "off" or None (report only)
+    fields = {} if enable is None else {"enable": enable == "on"}
+    reply = control_request("spans", **fields)
+    if not reply:
+        return {"status": "not_running", "message": "No server answering on the control socket."}
+    return {"status": "ok", **reply}
 
+def run_action(action, params):
     if action == "start":
-        response = start_server()
+        return start_server()
     elif action == "stop":
-        response = stop_server()
+        return stop_server()
+    elif action == "reload":
+        return reload_server()
     elif action == "status":
-        response = get_server_status() 
+        return get_server_status()
+    elif action == "stacks":
+        return signal_server(signal.SIGUSR1, f"Stack traces are written to {TMP_DIR}/stacks-<pid>-<time>.txt.")
+    elif action == "profile":
+        return signal_server(signal.SIGUSR2, f"Profiler toggled; the profile is written to {TMP_DIR}/profile-<pid>-<time>.folded when it stops.")
+    elif action == "spans":
+        return set_spans(params.get("enable", [None])[0])
+    return {"status": "error", "message": "Invalid action specified"}
+
+def main():
+    if "GATEWAY_INTERFACE" not in os.environ:
+        # Command line: server_manager.py <action> [name=value ...]; the JSON reply goes to stdout
+        action = sys.argv[1] if len(sys.argv) > 1 else None
+        log_manager_activity(f"Received action from the command line: {action}")
+        print(json.dumps(run_action(action, urllib.parse.parse_qs("&".join(sys.argv[2:])))))
+        return
+
+    # Plain query-string/form parsing: the cgi module is deprecated and slow to import
+    params = urllib.parse.parse_qs(os.environ.get("QUERY_STRING", ""))
+    if os.environ.get("REQUEST_METHOD") == "POST":
+        length = int(os.environ.get("CONTENT_LENGTH") or 0)
+        params.update(urllib.parse.parse_qs(sys.stdin.read(length)))
+    action = params.get("action", [None])[0]
+
+    log_manager_activity(f"Received action: {action} from {os.environ.get('REMOTE_ADDR', 'unknown')}")
+
+    forbidden = action is not None and action not in WEB_ACTIONS
+    if forbidden:
+        print("Status: 403 Forbidden")
+    print("Content-Type: application/json")
+    print()
+
+    if forbidden:
+        response = {"status": "error_forbidden", "message": f"'{action}' is not available over the web; run it from the command line on the server."}
     else:
-        response = {"status": "error", "message": "Invalid action specified"}
-    
+        response = run_action(action, params)
     log_manager_activity(f"Responding with: {json.dumps(response)}")
     print(json.dumps(response))
 
@@ -0,0 +1,431 @@
+# Unit tests for the parts of py/server.py that need no sockets or running loop: framing, routing, replay,
+# payload encodings, admission control, the journal format, the timer wheel, the shared-memory ring and peer
+# deduplication. Run from atividades_semestre/aa11 with "python3 -m pytest tests".
+import asyncio
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import pytest
+
+PY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "py")
+sys.path.insert(0, PY_DIR)
+
+# server.py creates its TMP_DIR and points stdout/stderr at /dev/null on import: keep both away from the project
+# and from pytest's output (under capture, those are pytest's own files).
+os.environ["RELAY_TMP_DIR"] = tempfile.mkdtemp(prefix="relay-tests-")
+_redirected_fds = [(fd, os.dup(fd)) for fd in {sys.stdout.fileno(), sys.stderr.fileno()}]
+try:
+    import server
+finally:
+    for fd, saved in _redirected_fds:
+        os.dup2(saved, fd)
+        os.close(saved)
+import local_producer
+
+
+def unframe(frame):
+    # (opcode, compressed, payload) of an unmasked server frame built by build_ws_frame
+    opcode, compressed = frame[0] & 0x0F, bool(frame[0] & 0x40)
+    length, offset = frame[1] & 0x7F, 2
+    if length == 126:
+        length, offset = int.from_bytes(frame[2:4], "big"), 4
+    elif length == 127:
+        length, offset = int.from_bytes(frame[2:10], "big"), 10
+    payload = bytes(frame[offset:offset + length])
+    return opcode, compressed, server.inflate_payload(payload) if compressed else payload
+
+
+# --- TcpFrameParser ---
+def feed(parser, data):
+    frames = []
+    while data:
+        buffer = parser.get_buffer()
+        count = min(len(buffer), len(data))
+        buffer[:count] = data[:count]
+        data = data[count:]
+        frames += [bytes(frame) for frame in parser.feed(count)]
+    return frames
+
+def test_newline_framing_across_reads():
+    parser = server.TcpFrameParser("newline", 1024)
+    assert feed(parser, b"a\nbc") == [b"a"]
+    assert feed(parser, b"d\n\nef\n") == [b"bcd", b"ef"] # Empty lines are skipped
+    assert feed(parser, b"g") == []
+    assert feed(parser, b"\n") == [b"g"]
+
+def test_length_prefixed_framing_across_reads():
+    parser = server.TcpFrameParser("length-prefixed", 1024)
+    stream = b"".join(len(body).to_bytes(4, "big") + body for body in (b"one", b"", b"three"))
+    frames = []
+    for index in range(len(stream)):
+        frames += feed(parser, stream[index:index + 1])
+    assert frames == [b"one", b"", b"three"]
+
+def test_length_prefixed_frame_larger_than_the_buffer():
+    parser = server.TcpFrameParser("length-prefixed", 4 * server.TCP_RECV_BUFFER_SIZE)
+    body = bytes(range(256)) * (2 * server.TCP_RECV_BUFFER_SIZE // 256)
+    assert feed(parser, len(body).to_bytes(4, "big") + body + b"\x00\x00\x00\x01x") == [body, b"x"]
+
+def test_raw_framing_hands_out_each_read():
+    parser = server.TcpFrameParser("raw", 1024)
+    assert feed(parser, b"abc") == [b"abc"]
+    assert feed(parser, b"d\ne") == [b"d\ne"]
+
+def test_oversized_frames_are_refused():
+    with pytest.raises(server.FramingError):
+        feed(server.TcpFrameParser("newline", 8), b"123456789")
+    with pytest.raises(server.FramingError):
+        feed(server.TcpFrameParser("length-prefixed", 8), (9).to_bytes(4, "big"))
+    with pytest.raises(ValueError):
+        server.TcpFrameParser("xml", 8)
+
+
+# --- SubscriptionRouter / subscriptions_match ---
+class FakeClient:
+    def __init__(self, name):
+        self.name = name
+        self.subscriptions = server.NO_SUBSCRIPTIONS
+        self.coalesce = False
+
+    def __repr__(self):
+        return self.name
+
+def message(msg_type="udp", ip="10.0.0.1", port=8081, data="temperature 21"):
+    return {"type": msg_type, "ip": ip, "port": port, "data": data}
+
+def test_router_separates_unfiltered_and_matching_clients():
+    router = server.SubscriptionRouter()
+    everyone, temperatures, one_host = FakeClient("everyone"), FakeClient("temperatures"), FakeClient("one_host")
+    for client in (everyone, temperatures, one_host):
+        router.add_client(client)
+    router.subscribe(temperatures, server.parse_subscription({"type": "UDP", "prefix": "temp"}))
+    router.subscribe(one_host, server.parse_subscription({"ip": "10.0.0.2", "port": "8080"}))
+    assert router.has_filters()
+
+    unfiltered, matched = router.match("udp", "10.0.0.1", 8081, "temperature 21")
+    assert unfiltered == {everyone} and set(matched) == {temperatures}
+    unfiltered, matched = router.match("tcp", "10.0.0.2", 8080, "temperature 21")
+    assert unfiltered == {everyone} and set(matched) == {one_host}
+    assert not router.match("tcp", "10.0.0.1", 8080, "humidity")[1]
+
+    router.unsubscribe_all(temperatures)
+    router.remove_client(one_host)
+    assert not router.has_filters()
+    assert router.match("udp", "10.0.0.1", 8081, "temperature 21") == ({everyone, temperatures}, ())
+
+def test_router_agrees_with_subscriptions_match():
+    rng = random.Random(7)
+    router = server.SubscriptionRouter()
+    clients = [FakeClient(f"c{index}") for index in range(40)]
+    for client in clients:
+        router.add_client(client)
+        for _ in range(rng.randint(0, 3)):
+            router.subscribe(client, server.parse_subscription({
+                "type": rng.choice([None, "udp", "tcp"]), "ip": rng.choice([None, "10.0.0.1", "10.0.0.2"]),
+                "port": rng.choice([None, 8080, 8081]), "prefix": rng.choice(["", "t", "temp", "hum"]),
+            }))
+    for _ in range(200):
+        msg = message(rng.choice(["udp", "tcp"]), rng.choice(["10.0.0.1", "10.0.0.2"]), rng.choice([8080, 8081]),
+                      rng.choice(["temperature", "tide", "humidity", ""]))
+        unfiltered, matched = router.match(msg["type"], msg["ip"], msg["port"], msg["data"])
+        expected = {client for client in clients if client.subscriptions and server.subscriptions_match(client.subscriptions, msg)}
+        assert set(matched) == expected
+        assert unfiltered == {client for client in clients if not client.subscriptions}
+
+def test_parse_subscription_validates_fields():
+    assert server.parse_subscription({"type": "TCP", "port": "8080"}) == ("tcp", None, 8080, "")
+    for request in ({"port": "80a"}, {"port": True}, {"type": 5}, {"prefix": 3}):
+        with pytest.raises(ValueError):
+            server.parse_subscription(request)
+
+
+# --- ReplayBuffer / build_replay_payloads ---
+def test_replay_buffer_bounds_and_gap():
+    replay = server.ReplayBuffer(3, 1 << 20)
+    for seq in range(1, 6):
+        replay.append(seq, b'{"seq": %d}' % seq)
+    assert [seq for seq, _ in replay.since(2)] == [3, 4, 5]
+    assert [seq for seq, _ in replay.last(2)] == [4, 5]
+    assert replay.last(0) == []
+    assert replay.gap_seq == 2 and replay.last_seq == 5
+    assert replay.truncated_after(1) and not replay.truncated_after(2)
+
+    by_bytes = server.ReplayBuffer(100, 10)
+    for seq in range(1, 4):
+        by_bytes.append(seq, b"12345")
+    assert [seq for seq, _ in by_bytes.entries] == [2, 3] and by_bytes.total_bytes == 10
+
+def test_replay_buffer_with_interleaved_worker_seqs():
+    # With --workers a process sees every worker's seqs, so the numbers it holds are not contiguous
+    replay = server.ReplayBuffer(100, 1 << 20)
+    for seq in (4, 7, 10, 13):
+        replay.append(seq, b"{}")
+    assert not replay.truncated_after(0)
+    assert [seq for seq, _ in replay.since(7)] == [10, 13]
+
+def test_replay_payloads_split_and_flag():
+    entries = [(seq, json.dumps({"seq": seq, "data": "x" * 40}).encode()) for seq in range(1, 11)]
+    (single,) = server.build_replay_payloads(entries, False)
+    decoded = json.loads(single)
+    assert decoded["event"] == "replay" and decoded["final"] and not decoded["truncated"]
+    assert [item["seq"] for item in decoded["messages"]] == list(range(1, 11))
+
+    saved = server.REPLAY_FRAME_MAX_BYTES
+    server.REPLAY_FRAME_MAX_BYTES = 200
+    try:
+        frames = [json.loads(frame) for frame in server.build_replay_payloads(entries, True)]
+    finally:
+        server.REPLAY_FRAME_MAX_BYTES = saved
+    assert len(frames) > 1
+    assert [frame["final"] for frame in frames] == [False] * (len(frames) - 1) + [True]
+    assert all(frame["truncated"] for frame in frames)
+    assert [item["seq"] for frame in frames for item in frame["messages"]] == list(range(1, 11))
+
+    assert json.loads(server.build_replay_payloads([], False)[0])["messages"] == []
+
+
+# --- Payload encodings and batch frames ---
+def test_binary_message_layout():
+    timestamp = "2026-01-02T03:04:05.678+00:00"
+    encoded = server.encode_binary_message({"seq": 42, "timestamp": timestamp, "port": 8081, "type": "udp",
+                                            "ip": "10.0.0.1", "data": "température"})
+    version, seq, millis, port, type_length, ip_length = server.BINARY_MESSAGE_HEADER.unpack_from(encoded)
+    assert (version, seq, port) == (server.BINARY_MESSAGE_VERSION, 42, 8081)
+    assert millis == datetime.datetime.fromisoformat(timestamp).timestamp() * 1000
+    rest = encoded[server.BINARY_MESSAGE_HEADER.size:]
+    assert rest[:type_length] == b"udp"
+    assert rest[type_length:type_length + ip_length] == b"10.0.0.1"
+    assert rest[type_length + ip_length:].decode("utf-8") == "température"
+
+def batch_entries(count):
+    entries = []
+    for seq in range(1, count + 1):
+        msg = {"seq": seq, "type": "udp", "ip": "10.0.0.1", "port": 8081, "timestamp": "2026-01-02T03:04:05.678+00:00",
+               "data": f"reading {seq}"}
+        entries.append((seq, json.dumps(msg).encode(), msg if seq % 2 else None)) # Bus messages arrive unparsed
+    return entries
+
+def test_json_batch_frame():
+    entries = batch_entries(3)
+    opcode, compressed, payload = unframe(server.build_batch_frame(("json", False), entries, {}))
+    assert opcode == server.TEXT and not compressed
+    decoded = json.loads(payload)
+    assert decoded["type"] == "batch"
+    assert decoded["messages"] == [json.loads(message_bytes) for _, message_bytes, _ in entries]
+
+def test_binary_batch_frame():
+    entries = batch_entries(3)
+    cache = {}
+    opcode, _, payload = unframe(server.build_batch_frame(("binary", False), entries, cache))
+    assert opcode == server.BINARY and set(cache) == {1, 2, 3}
+    version, count = server.BINARY_BATCH_HEADER.unpack_from(payload)
+    assert (version, count) == (server.BINARY_BATCH_VERSION, 3)
+    offset = server.BINARY_BATCH_HEADER.size
+    for seq, message_bytes, _ in entries:
+        (length,) = server.BINARY_BATCH_LENGTH.unpack_from(payload, offset)
+        offset += server.BINARY_BATCH_LENGTH.size
+        assert payload[offset:offset + length] == server.encode_binary_message(json.loads(message_bytes))
+        offset += length
+    assert offset == len(payload)
+
+def test_deflated_batch_frame():
+    entries = batch_entries(20)
+    opcode, compressed, payload = unframe(server.build_batch_frame(("json", True), entries, {}))
+    assert opcode == server.TEXT and compressed
+    assert len(json.loads(payload)["messages"]) == 20
+
+
+# --- TokenBuckets ---
+def test_message_bucket_refills_at_its_rate():
+    buckets = server.TokenBuckets(10, 0, 0.0)
+    assert all(buckets.take(1, 0.0) for _ in range(10))
+    assert not buckets.take(1, 0.0)
+    assert buckets.take(1, 0.1)
+    assert not buckets.take(1, 0.1)
+
+def test_byte_bucket_and_oversized_messages():
+    buckets = server.TokenBuckets(0, 100, 0.0)
+    assert buckets.take(60, 0.0)
+    assert not buckets.take(60, 0.0)
+    assert buckets.take(60, 0.2)
+    full = server.TokenBuckets(0, 100, 0.0)
+    assert full.take(500, 0.0) # Larger than the bucket: passes only when it is full...
+    assert not full.take(1, 0.0) # ...and leaves it in debt
+
+def test_both_buckets_or_neither():
+    buckets = server.TokenBuckets(5, 100, 0.0)
+    assert buckets.take(100, 0.0)
+    messages = buckets.messages
+    assert not buckets.take(10, 0.0)
+    assert buckets.messages == messages
+    assert buckets.idle(server.INGEST_BURST_SECONDS) and not buckets.idle(0.0)
+
+
+# --- Journal ---
+def write_journal(directory, records):
+    writer = server.JournalWriter(directory)
+    os.makedirs(directory, exist_ok=True)
+    writer.roll()
+    for record in records:
+        writer.write_record(*record)
+    writer.flush()
+    writer.close()
+    return writer.base
+
+def test_journal_round_trip(tmp_path):
+    start = time.time() + 1
+    records = [(start + index, index + 1, "10.0.0.%d" % (index % 2), json.dumps({"seq": index + 1}).encode())
+               for index in range(10)]
+    write_journal(str(tmp_path), records)
+
+    everything = list(server.read_journal_directory(str(tmp_path), None, None, None))
+    assert [(timestamp, seq, payload) for timestamp, seq, _, payload in records] == everything
+    in_range = server.read_journal_directory(str(tmp_path), start + 2, start + 5, None)
+    assert [seq for _, seq, _ in in_range] == [3, 4, 5, 6]
+    one_ip = server.read_journal_directory(str(tmp_path), None, None, "10.0.0.1")
+    assert [seq for _, seq, _ in one_ip] == [2, 4, 6, 8, 10]
+
+def test_journal_index_skips_to_the_range(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "JOURNAL_INDEX_INTERVAL_BYTES", 64)
+    start = time.time() + 1
+    base = write_journal(str(tmp_path), [(start + index, index + 1, "", b"x" * 50) for index in range(100)])
+    assert os.path.getsize(base + ".idx") > server.JOURNAL_INDEX_ENTRY.size
+    assert server.journal_scan_offset(base, start) == 0
+    assert server.journal_scan_offset(base, start + 50) > 0
+    assert [seq for _, seq, _ in server.read_journal_segment(base, start + 50, start + 52, None)] == [51, 52, 53]
+
+def test_journal_reader_stops_at_a_torn_tail(tmp_path):
+    start = time.time() + 1
+    base = write_journal(str(tmp_path), [(start, 1, "", b'{"seq": 1}'), (start + 1, 2, "", b'{"seq": 2}')])
+    with open(base + ".seg", "ab") as f:
+        f.write(server.JOURNAL_RECORD_HEADER.pack(100, 0, 3, start + 2, 0) + b"partial")
+    assert [seq for _, seq, _ in server.read_journal_segment(base, None, None, None)] == [1, 2]
+
+def test_parse_journal_time():
+    assert server.parse_journal_time(None) is None and server.parse_journal_time("") is None
+    assert server.parse_journal_time(5) == 5.0
+    assert server.parse_journal_time("12.5") == 12.5
+    assert server.parse_journal_time("1970-01-01T00:01:00Z") == 60.0
+    assert server.parse_journal_time("1970-01-01T01:00:00+01:00") == 0.0
+    with pytest.raises(ValueError):
+        server.parse_journal_time("yesterday")
+
+
+# --- TimerWheel ---
+class FakeLoop:
+    class Handle:
+        def cancel(self):
+            pass
+
+    def time(self):
+        return 0.0
+
+    def call_at(self, when, callback):
+        return self.Handle()
+
+class WheelEntry:
+    def __init__(self, delays):
+        self.wheel_slot = None
+        self.delays = list(delays) # What expire() returns on each call
+        self.expired = 0
+
+    def expire(self, now):
+        self.expired += 1
+        return self.delays.pop(0) if self.delays else None
+
+def turn(wheel, ticks):
+    for _ in range(ticks):
+        wheel.advance()
+
+def test_timer_wheel_is_never_early():
+    wheel = server.TimerWheel(1.0, 8)
+    wheel.start(FakeLoop())
+    entry = WheelEntry([])
+    wheel.schedule(entry, 2.5)
+    turn(wheel, 2)
+    assert entry.expired == 0
+    turn(wheel, 1)
+    assert entry.expired == 1 and entry.wheel_slot is None
+
+def test_timer_wheel_reschedules_and_cancels():
+    wheel = server.TimerWheel(1.0, 8)
+    wheel.start(FakeLoop())
+    entry, cancelled = WheelEntry([1.0]), WheelEntry([])
+    wheel.schedule(entry, 0)
+    wheel.schedule(cancelled, 0)
+    wheel.schedule(entry, 0) # Moves the entry rather than adding it twice
+    assert sum(entry in slot for slot in wheel.slots) == 1
+    wheel.cancel(cancelled)
+    turn(wheel, 1)
+    assert entry.expired == 1 and entry.wheel_slot is not None # expire() asked to be looked at again
+    turn(wheel, 2)
+    assert entry.expired == 2 and cancelled.expired == 0
+
+def test_timer_wheel_long_delays_take_extra_turns():
+    # Beyond TICK * SLOTS the entry is looked at once per turn, and expire() asks for what is left each time
+    wheel = server.TimerWheel(1.0, 4)
+    wheel.start(FakeLoop())
+    entry = WheelEntry([4.0])
+    wheel.schedule(entry, 7.0)
+    turn(wheel, 3)
+    assert entry.expired == 1
+    turn(wheel, 2)
+    assert entry.expired == 1
+    turn(wheel, 1)
+    assert entry.expired == 2 and entry.wheel_slot is None
+
+
+# --- ShmRingWriter / ShmRingReader ---
+def test_shm_ring_round_trip_with_wraparound(tmp_path, monkeypatch):
+    received = []
+    monkeypatch.setattr(server, "ingest_local_message", lambda protocol, data, addr: received.append(bytes(data)))
+    path = str(tmp_path / "ring")
+    loop = asyncio.new_event_loop()
+    reader = server.ShmRingReader(path, 1000) # Rounded down to 8 bytes
+    reader.open(loop)
+    writer = local_producer.ShmRingWriter(path)
+    try:
+        assert writer.capacity == 1000 - 1000 % 8
+        sent = []
+        for index in range(200):
+            data = b"message %d " % index + b"x" * (index % 37)
+            while not writer.try_send(data):
+                reader.drain() # Full: the producer waits for the reader
+            sent.append(data)
+        reader.drain()
+        assert received == sent
+        assert writer.write_pos > writer.capacity # The ring wrapped at least once
+        with pytest.raises(ValueError):
+            writer.try_send(b"x" * writer.capacity)
+    finally:
+        writer.close()
+        reader.close()
+        loop.close()
+
+
+# --- PeerDedup ---
+def test_peer_dedup_drops_copies_and_old_records():
+    dedup = server.PeerDedup(4, 10)
+    origin = (b"node-a", 1)
+    assert dedup.first_sighting(origin, 5)
+    assert not dedup.first_sighting(origin, 5)
+    assert dedup.first_sighting(origin, 3) # Overtaken on another path, still inside the window
+    assert not dedup.first_sighting(origin, 3)
+    assert dedup.first_sighting(origin, 9)
+    assert not dedup.first_sighting(origin, 5) # At the window's edge: counts as seen
+    assert dedup.first_sighting((b"node-a", 2), 5) # A restarted node (new epoch) starts over
+
+def test_peer_dedup_prunes_and_bounds_origins():
+    dedup = server.PeerDedup(4, 2)
+    origin = (b"node-a", 1)
+    for seq in range(1, 100):
+        assert dedup.first_sighting(origin, seq)
+    assert len(dedup.origins[origin][1]) <= 2 * 4
+    dedup.first_sighting((b"node-b", 1), 1)
+    dedup.first_sighting((b"node-c", 1), 1)
+    assert set(dedup.origins) == {(b"node-b", 1), (b"node-c", 1)}